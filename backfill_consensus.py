@@ -0,0 +1,169 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer, threads
+from geolocation import Geolocator, load_database
+from consensus_archive import ConsensusArchive, load_consensus, read_relays, read_valid_after
+from get_consensus import BandwidthAverages, classify_relays, relay_flag
+from storage import open_storage
+
+import multiprocessing
+import datetime
+import click
+import os
+
+def parse_consensus(consensus_path):
+    """
+    Parse one consensus file, runs in a worker process of the backfill pool.
+    The "above average" flag is computed against the averages of the same
+    consensus, there is no prior table state for historic consensuses.
+
+    Returns (valid_after, rows) with rows of (fp, address, bandwidth,
+    above_avg_bw, flag), or (None, []) if the file could not be parsed.
+
+    Arguments:
+        consensus_path: path of a plain or gzip compressed consensus file
+    """
+    try:
+        consensus_file = load_consensus(consensus_path)
+        valid_after = read_valid_after(consensus_file)
+        relays = list(read_relays(consensus_file))
+    except Exception as err:
+        print('Could not parse ', consensus_path, err)
+        return None, []
+
+    averages = BandwidthAverages()
+    for relay in relays:
+        averages.add(relay_flag(relay), relay.bandwidth)
+
+    rows = []
+    for relay, flag, bw_flag in classify_relays(relays, averages.thresholds()):
+        rows.append((relay.fingerprint, relay.address, relay.bandwidth, bw_flag, flag))
+
+    return valid_after, rows
+
+HISTORY_COLUMNS = ('valid_after', 'fp', 'address', 'continent_code', 'country_code', 'bandwidth', 'above_avg_bw', 'flag')
+
+def write_history(txn, insert, rows, batch_size=1000):
+    for index in xrange(0, len(rows), batch_size):
+        txn.executemany(insert, rows[index:index + batch_size])
+
+def next_result(results):
+    try:
+        return next(results)
+    except StopIteration:
+        return None
+
+@defer.inlineCallbacks
+def backfill(reactor, dbpool, db_name, consensus_paths, pool, locator):
+    """
+    Parse historic consensus files in parallel and write them to the
+    fingerprints_history table, one version of every relay per consensus
+    valid-after time. Every worker of the process pool parses one file at a
+    time, the main process locates the relays and writes each consensus in
+    its own transaction while the workers continue with the next files.
+
+    Arguments:
+        reactor: reactor object for @inlineCallbacks, import in main
+        dbpool: connection to database
+        db_name: database name
+        consensus_paths: list of consensus files to ingest
+        pool: multiprocessing pool, created in main before the reactor runs
+        locator: Geolocator for the relay addresses
+    """
+    insert = dbpool.upsert('fingerprints_history', HISTORY_COLUMNS, ('valid_after', 'fp'))
+    results = pool.imap_unordered(parse_consensus, consensus_paths)
+    written = 0
+
+    with click.progressbar(length=len(consensus_paths), label='Backfilling consensuses') as bar:
+        while True:
+            result = yield threads.deferToThread(next_result, results)
+            if result is None:
+                break
+            bar.update(1)
+
+            valid_after, relays = result
+            if valid_after is None:
+                continue
+
+            rows = []
+            for fingerprint, address, bandwidth, bw_flag, flag in relays:
+                location = locator.lookup(address)
+                if location is None and locator.service_url:
+                    location = yield threads.deferToThread(locator.fetch, address)
+                if location is None:
+                    continue
+
+                rows.append((valid_after, fingerprint, address, location[0], location[1], bandwidth, bw_flag, flag))
+
+            try:
+                yield dbpool.runInteraction(write_history, insert, rows)
+                written += 1
+            except Exception as err:
+                print('Problem writing consensus {} to db: '.format(valid_after), err)
+
+    pool.close()
+    print('Wrote {} of {} consensuses to fingerprints_history'.format(written, len(consensus_paths)))
+
+def find_consensus_files(consensus_dir):
+    """
+    All (plain or gzip compressed) consensus files below consensus_dir.
+    """
+    paths = []
+    for root, dirs, files in os.walk(consensus_dir):
+        for filename in files:
+            if filename.endswith('-consensus') or filename.endswith('-consensus.gz'):
+                paths.append(os.path.join(root, filename))
+
+    return sorted(paths)
+
+def parse_date(value):
+    if value is None:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+@click.command()
+@click.option('--consensus-dir', default=None, type=str, help='directory with consensus files to ingest')
+@click.option('--archive-dir', default=None, type=str, help='consensus archive directory, used with --start and --end')
+@click.option('--start', default=None, type=str, help='first day to ingest from the archive (YYYY-MM-DD)')
+@click.option('--end', default=None, type=str, help='last day to ingest from the archive (YYYY-MM-DD)')
+@click.option('--workers', default=None, type=int, help='number of parser processes, defaults to the number of cores')
+@click.option('--db-name', default=None, type=str, help='Name of DB')
+@click.option('--db-user', default=None, type=str, help='Username DB')
+@click.option('--db-passwd', default=None, type=str, help='Password DB')
+@click.option('--db-port', default=None, type=int, help='DB connection port')
+@click.option('--db-host', default=None, type=str, help='DB connection host')
+@click.option('--db-file', default=None, type=str, help='SQLite database file, used instead of the MySQL server')
+@click.option('--geoip-db', default=None, type=str, help='local IP range database (range file, MaxMind csv or mmdb)')
+@click.option('--geoip-format', default=None, type=click.Choice(['range', 'maxmind-csv', 'mmdb']), help='format of --geoip-db, guessed if omitted')
+@click.option('--location-service-url', default='', type=str, help='json location service used for addresses missing in --geoip-db')
+def main(consensus_dir, archive_dir, start, end, workers, db_name, db_user, db_passwd, db_port, db_host, db_file, geoip_db, geoip_format, location_service_url):
+    from twisted.internet import reactor
+
+    if archive_dir is not None:
+        end = parse_date(end)
+        if end is not None:
+            end = end + datetime.timedelta(days=1, seconds=-1)
+        consensus_paths = ConsensusArchive(archive_dir).entries(parse_date(start), end)
+    elif consensus_dir is not None:
+        consensus_paths = find_consensus_files(consensus_dir)
+    else:
+        raise click.UsageError('either --consensus-dir or --archive-dir is required')
+
+    # fork the workers before the reactor starts its threads
+    pool = multiprocessing.Pool(workers)
+
+    dbpool = open_storage(db_name, db_user, db_passwd, db_port, db_host, db_file)
+    db_name = dbpool.db_name
+
+    database = None
+    if geoip_db is not None:
+        database = load_database(geoip_db, geoip_format)
+    locator = Geolocator(database, location_service_url, 65536)
+
+    d = backfill(reactor, dbpool, db_name, consensus_paths, pool, locator)
+    d.addCallback(lambda ign: reactor.stop())
+
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
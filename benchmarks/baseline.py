@@ -0,0 +1,54 @@
+#!/usr/bin/env/python
+
+import json
+import os
+
+def save_results(path, results):
+    """
+    Write the results of a benchmark as json, atomically like the campaign
+    checkpoint.
+    """
+    part_path = path + '.part'
+    with open(part_path, 'w') as part_file:
+        json.dump(results, part_file, indent=2, sort_keys=True)
+    os.rename(part_path, path)
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+def compare(results, baseline, metrics, tolerance=0.2):
+    """
+    Regressions of results against a baseline: every metric that is worse
+    than the baseline by more than tolerance (0.2 = 20%) as (name, value,
+    baseline value). metrics maps the name of a metric to True if higher is
+    better, like circuits per second, and False if lower is better, like
+    latencies. Metrics missing in one of the runs are not compared.
+    """
+    regressions = []
+    for name, higher_is_better in sorted(metrics.items()):
+        value = results.get(name)
+        reference = baseline.get(name)
+        if value is None or reference is None:
+            continue
+
+        if higher_is_better:
+            worse = value < reference * (1 - tolerance)
+        else:
+            worse = value > reference * (1 + tolerance)
+        if worse:
+            regressions.append((name, value, reference))
+
+    return regressions
+
+def check_baseline(results, baseline_path, metrics, tolerance=0.2):
+    """
+    Print the regressions against the baseline file, returns True if there
+    are none.
+    """
+    regressions = compare(results, load_results(baseline_path), metrics, tolerance)
+    for name, value, reference in regressions:
+        print('Regression of {}: {:.3f} (baseline {:.3f})'.format(name, value, reference))
+    if not regressions:
+        print('No regressions against {} (tolerance {:.0%})'.format(baseline_path, tolerance))
+    return not regressions
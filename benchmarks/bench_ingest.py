@@ -0,0 +1,195 @@
+#!/usr/bin/env/python
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consensus_archive import load_consensus, read_relays
+from geolocation import Geolocator, RangeDatabase
+from get_consensus import BandwidthAverages, FingerprintLoader, classify_relays, guard_flag, relay_flag
+from get_circuits import SELECTIONS, RelayTable, generate_circuits
+from storage import SQLiteStorage
+from baseline import check_baseline, save_results
+
+import platform
+import tempfile
+import shutil
+import datetime
+import base64
+import random
+import socket
+import struct
+import click
+import time
+
+# relays in a consensus of today's network
+NETWORK_SIZE = 7000
+
+# locations of the synthetic geoip database, every selection of
+# get_circuits.py is covered
+LOCATIONS = [
+    ('EU', 'DE'), ('NA', 'US'), ('EU', 'FR'), ('EU', 'NL'), ('EU', 'RU'), ('EU', 'GB'), ('NA', 'CA'), ('EU', 'CH'),
+    ('EU', 'UA'), ('EU', 'SE'), ('OC', 'AU'), ('SA', 'BR'), ('AS', 'JP'), ('AS', 'SG'), ('AF', 'ZA'),
+]
+
+STAGES = ['parse', 'geolocate', 'bandwidth_average', 'load', 'relay_table', 'form_circuits', 'weighted_circuits']
+
+def synthetic_ranges(count, rng):
+    """
+    count ranges of equal size covering the IPv4 space, each with a random
+    location, like a geoip range file.
+    """
+    size = (1 << 32) // count
+    return [(index * size, (index + 1) * size - 1, rng.choice(LOCATIONS)) for index in xrange(count)]
+
+def synthetic_consensus(relays, rng, valid_after=None):
+    """
+    A consensus document with relays random router entries: random
+    fingerprints and addresses, the Exit flag on about a fifth and the Guard
+    flag on about two fifths of the relays, and log-normal bandwidths.
+    Returns the document as bytes.
+    """
+    valid_after = valid_after or datetime.datetime(2020, 1, 1)
+    published = valid_after.strftime('%Y-%m-%d %H:%M:%S')
+
+    lines = [
+        'network-status-version 3',
+        'vote-status consensus',
+        'consensus-method 28',
+        'valid-after {}'.format(published),
+        'fresh-until {}'.format((valid_after + datetime.timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')),
+        'valid-until {}'.format((valid_after + datetime.timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:%S')),
+        'known-flags Exit Fast Guard Running Stable Valid',
+    ]
+
+    for index in xrange(relays):
+        identity = base64.b64encode(struct.pack('!QQI', index, rng.getrandbits(64), rng.getrandbits(32))).rstrip('=')
+        digest = base64.b64encode(struct.pack('!QQI', rng.getrandbits(64), rng.getrandbits(64), rng.getrandbits(32))).rstrip('=')
+        address = socket.inet_ntoa(struct.pack('!I', rng.randint(1 << 24, (224 << 24) - 1)))
+
+        flags = ['Fast', 'Running', 'Stable', 'Valid']
+        if rng.random() < 0.2:
+            flags.append('Exit')
+        if rng.random() < 0.4:
+            flags.append('Guard')
+
+        lines.append('r relay{} {} {} {} {} 9001 0'.format(index, identity, digest, published, address))
+        lines.append('s {}'.format(' '.join(sorted(flags))))
+        lines.append('w Bandwidth={}'.format(int(rng.lognormvariate(8, 1.5))))
+
+    lines.append('directory-footer')
+    lines.append('bandwidth-weights Wgd=0 Wgg=5916 Wmd=0 Wme=0 Wmg=4084 Wmm=10000 Wee=10000')
+    return '\n'.join(lines) + '\n'
+
+def timed(times, stage, function, *args):
+    start = time.time()
+    result = function(*args)
+    times[stage] = time.time() - start
+    return result
+
+def run_stages(consensus_path, database, weighted, seed):
+    """
+    Run the ingest of get_consensus.py and the circuit generation of
+    get_circuits.py on one consensus, stage by stage. Returns the seconds of
+    every stage and the number of relays and circuits.
+    """
+    times = {}
+
+    relays = timed(times, 'parse', lambda: list(read_relays(load_consensus(consensus_path))))
+
+    locator = Geolocator(database)
+    locations = timed(times, 'geolocate', lambda: [locator.lookup(relay.address) for relay in relays])
+
+    def average():
+        averages = BandwidthAverages()
+        for relay in relays:
+            averages.add(relay_flag(relay), relay.bandwidth)
+        return list(classify_relays(relays, averages.thresholds()))
+    classified = timed(times, 'bandwidth_average', average)
+
+    directory = tempfile.mkdtemp(prefix='bench-')
+    storage = SQLiteStorage(os.path.join(directory, 'bench.sqlite'))
+    connection = storage.dbpool.connect()
+    def load():
+        loader = FingerprintLoader(storage, storage.db_name, datetime.datetime(2020, 1, 1))
+        for (relay, flag, bw_flag), location in zip(classified, locations):
+            loader.add(relay.fingerprint, relay.address, location[0], location[1], relay.bandwidth, bw_flag, flag, guard_flag(relay))
+        loader._load(storage.cursor(connection.cursor()))
+        connection.commit()
+    try:
+        timed(times, 'load', load)
+    finally:
+        connection.close()
+        shutil.rmtree(directory)
+
+    rows = [(fid, relay.fingerprint, bw_flag, flag, location[0], location[1], relay.bandwidth, relay.address, guard_flag(relay))
+        for fid, ((relay, flag, bw_flag), location) in enumerate(zip(classified, locations))]
+    table = timed(times, 'relay_table', RelayTable, rows)
+
+    circuits = timed(times, 'form_circuits', lambda: sum(len(circuits) for strategy, geo_code, circuits in generate_circuits(table, SELECTIONS)))
+
+    if weighted > 0:
+        from get_circuits import generate_weighted_circuits
+        timed(times, 'weighted_circuits', lambda: sum(len(circuits) for strategy, geo_code, circuits in
+            generate_weighted_circuits(table, SELECTIONS, weighted, seed=seed)))
+
+    return times, len(relays), circuits
+
+def run_benchmark(scales, ranges, rounds, weighted, seed):
+    """
+    Time the stages for a synthetic consensus at every scale (1 = today's
+    network). Every stage is run rounds times, the fastest run counts.
+    Returns a flat dict with <stage>_<scale>x seconds and the sizes.
+    """
+    rng = random.Random(seed)
+    database = RangeDatabase(synthetic_ranges(ranges, rng))
+
+    results = {}
+    for scale in scales:
+        relays = int(NETWORK_SIZE * scale)
+        consensus_file = tempfile.NamedTemporaryFile(suffix='-consensus', delete=False)
+        try:
+            consensus_file.write(synthetic_consensus(relays, rng))
+            consensus_file.close()
+
+            best = {}
+            for round_index in xrange(rounds):
+                times, parsed, circuits = run_stages(consensus_file.name, database, weighted, seed)
+                for stage, seconds in times.items():
+                    best[stage] = min(seconds, best.get(stage, seconds))
+        finally:
+            os.unlink(consensus_file.name)
+
+        for stage, seconds in best.items():
+            results['{}_{}x'.format(stage, scale)] = seconds
+        results['relays_{}x'.format(scale)] = parsed
+        results['circuits_{}x'.format(scale)] = circuits
+        print('{}x: {} relays, {} circuits, '.format(scale, parsed, circuits) +
+            ', '.join('{} {:.3f}s'.format(stage, best[stage]) for stage in STAGES if stage in best))
+
+    return results
+
+@click.command()
+@click.option('--scale', default=None, type=int, multiple=True, help='network size as multiple of today\'s network, can be repeated (default 1, 10 and 100)')
+@click.option('--ranges', default=300000, type=int, help='ranges of the synthetic geoip database')
+@click.option('--rounds', default=1, type=int, help='runs of every stage, the fastest counts')
+@click.option('--weighted', default=0, type=int, help='also time this many bandwidth weighted circuits per selection, needs numpy')
+@click.option('--seed', default=1, type=int, help='random seed of the synthetic network')
+@click.option('--output', default=None, type=str, help='json file for the results')
+@click.option('--baseline', default=None, type=str, help='json results of an earlier run, exit with 1 on a regression')
+@click.option('--tolerance', default=0.2, type=float, help='allowed regression against the baseline (0.2 = 20%)')
+def main(scale, ranges, rounds, weighted, seed, output, baseline, tolerance):
+    results = run_benchmark(list(scale) or [1, 10, 100], ranges, rounds, weighted, seed)
+    results['options'] = {'ranges': ranges, 'rounds': rounds, 'weighted': weighted, 'seed': seed}
+    results['python'] = platform.python_version()
+
+    if output is not None:
+        save_results(output, results)
+    if baseline is not None:
+        metrics = dict((name, False) for name in results if name.rsplit('_', 1)[0] in STAGES)
+        if not check_baseline(results, baseline, metrics, tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
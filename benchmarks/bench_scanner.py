@@ -0,0 +1,188 @@
+#!/usr/bin/env/python
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer
+from twisted.internet.defer import returnValue
+from connect_tor import RetryBudget, Sampling, TorInstance, connect_tor
+from result_writer import ResultWriter
+from latency_summary import LatencyHistogram, LatencySummaries
+from relay_health import RelayHealth
+from metrics import ReactorLagMonitor
+from fake_tor import FakeTor, TargetFile, listen
+from recording_db import RecordingPool
+from get_circuits import load_circuits
+from storage import SQLiteStorage
+from baseline import check_baseline, save_results
+
+import platform
+import tempfile
+import shutil
+import click
+import time
+
+# metric name: True if higher is better
+METRICS = {
+    'circuits_per_second': True,
+    'requests_per_second': True,
+    'db_write_p95': False,
+    'reactor_lag_p99': False,
+}
+
+def summary(histogram, name):
+    if not len(histogram):
+        return {}
+    return {
+        name + '_mean': histogram.mean(),
+        name + '_p50': histogram.percentile(50),
+        name + '_p95': histogram.percentile(95),
+        name + '_p99': histogram.percentile(99),
+    }
+
+def fill_database(txn, storage, relays, circuits, strategy, geo_codes):
+    """
+    Write the relays of the fake network to fingerprints and circuits of
+    them for every geo code to circuits.
+    """
+    txn.executemany('INSERT INTO {}.fingerprints (fp, address, continent_code, country_code, bandwidth, above_avg_bw, flag, valid_after) '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s, %s);'.format(storage.db_name),
+        [(fp, '10.{}.{}.{}'.format(index >> 16 & 255, index >> 8 & 255, index & 255), 'EU', 'DE', 1000.0, True, 'relay', '2020-01-01 00:00:00')
+            for index, fp in enumerate(relays)])
+    txn.execute('SELECT fp, fid FROM {}.fingerprints;'.format(storage.db_name))
+    fids = dict(txn.fetchall())
+
+    rows = []
+    for geo_code in geo_codes:
+        rows.extend((fids[relays[3 * i % len(relays)]], fids[relays[(3 * i + 1) % len(relays)]], fids[relays[(3 * i + 2) % len(relays)]],
+            strategy, geo_code or '') for i in xrange(circuits))
+    load_circuits(txn, storage, rows)
+
+@defer.inlineCallbacks
+def run_benchmark(reactor, strategy, geo_codes, repetitions, concurrency, prefetch, persistent, instances, build_delay,
+        failure_rate, stream_delay, response_delay, db, db_latency, circuits):
+    """
+    Start the fake tor daemons and the http target, run connect_tor against
+    them and return the throughput and latency numbers. The database is a
+    SQLiteStorage in a temporary directory or, with db 'recording', only the
+    canned RecordingPool; a RecordingPool in front of it counts the writes.
+    """
+    target = TargetFile(reactor, 500, response_delay)
+    tors = []
+    tor_instances = []
+    for index in xrange(instances):
+        tor = FakeTor(reactor, build_delay, failure_rate, stream_delay)
+        control_port, socks_port, http_port = listen(reactor, tor, target)
+        tors.append(tor)
+        tor_instances.append(TorInstance(reactor, control_port, socks_port))
+    uri = 'http://127.0.0.1:{}/file.bin'.format(http_port)
+
+    relays = tors[0].relays
+    storage = None
+    if db == 'sqlite':
+        directory = tempfile.mkdtemp(prefix='bench-')
+        storage = SQLiteStorage(os.path.join(directory, 'bench.sqlite'))
+        yield storage.runInteraction(fill_database, storage, relays, circuits, strategy, geo_codes)
+        dbpool = RecordingPool(latency=db_latency, storage=storage)
+    else:
+        rows = [(relays[3 * i % len(relays)], relays[(3 * i + 1) % len(relays)], relays[(3 * i + 2) % len(relays)], '')
+            for i in xrange(circuits)]
+        dbpool = RecordingPool(rows, db_latency)
+
+    writer = ResultWriter(dbpool, dbpool.db_name, spill_path=os.devnull)
+    summaries = LatencySummaries(dbpool, dbpool.db_name, persist_interval=5)
+    health = RelayHealth(dbpool, dbpool.db_name, persist_interval=5)
+    sampling = Sampling()
+    retry = RetryBudget()
+
+    lags = LatencyHistogram()
+    lag = ReactorLagMonitor(reactor, 0.1, lags=lags)
+    lag.start()
+    writer.start(reactor)
+    summaries.start(reactor)
+    health.start(reactor)
+
+    start = time.time()
+    try:
+        measurements = yield connect_tor(reactor, tor_instances, dbpool, dbpool.db_name, writer, summaries, strategy, geo_codes, repetitions, 'da',
+            concurrency, prefetch, persistent, sampling, health, retry, uri)
+    finally:
+        elapsed = time.time() - start
+        lag.stop()
+        yield health.stop()
+        yield summaries.stop()
+        yield writer.stop()
+        if storage is not None:
+            storage.close()
+            shutil.rmtree(directory)
+
+    builds = sum(measurement.builds for measurement in measurements)
+    results = {
+        'elapsed': elapsed,
+        'repetitions': sum(measurement.completed for measurement in measurements),
+        'circuits_built': builds,
+        'circuits_launched': sum(tor.circuits_launched for tor in tors),
+        'circuits_failed': sum(tor.circuits_failed for tor in tors),
+        'requests': dbpool.rows.get('request_phases', 0),
+        'circuits_per_second': builds / elapsed,
+        'requests_per_second': dbpool.rows.get('request_phases', 0) / elapsed,
+        'db_writes': len(dbpool.write_times),
+        'db_rows': dbpool.rows,
+    }
+    results.update(summary(dbpool.write_times, 'db_write'))
+    results.update(summary(lags, 'reactor_lag'))
+    returnValue(results)
+
+@click.command()
+@click.option('--strategy', default='continent_code', type=str, help='strategy of the measurement, weighted lets the fake tor pick the relays')
+@click.option('--geo-code', default=None, type=str, multiple=True, help='geo codes of the measurement, can be repeated')
+@click.option('--repetitions', default=100, type=int, help='repetitions per geo code')
+@click.option('--concurrency', default=4, type=int, help='circuits built and measured at the same time per tor instance')
+@click.option('--prefetch', default=0, type=int, help='circuits built ahead per tor instance')
+@click.option('--persistent', is_flag=True, help='reuse one connection for all requests of a circuit')
+@click.option('--instances', default=1, type=int, help='number of fake tor instances')
+@click.option('--build-delay', default=300.0, type=float, help='mean circuit build time of the fake tor in ms')
+@click.option('--failure-rate', default=0.1, type=float, help='fraction of circuits the fake tor fails')
+@click.option('--stream-delay', default=50.0, type=float, help='ms until the fake tor connected a stream')
+@click.option('--response-delay', default=0.0, type=float, help='ms until the http target answers')
+@click.option('--db', default='sqlite', type=click.Choice(['sqlite', 'recording']), help='temporary SQLite database or the canned recording stand-in')
+@click.option('--db-latency', default=0.0, type=float, help='ms every db statement takes on top')
+@click.option('--circuits', default=1000, type=int, help='circuits in the fake circuits table')
+@click.option('--output', default=None, type=str, help='json file for the results')
+@click.option('--baseline', default=None, type=str, help='json results of an earlier run, exit with 1 on a regression')
+@click.option('--tolerance', default=0.2, type=float, help='allowed regression against the baseline (0.2 = 20%)')
+def main(strategy, geo_code, repetitions, concurrency, prefetch, persistent, instances, build_delay, failure_rate, stream_delay,
+        response_delay, db, db_latency, circuits, output, baseline, tolerance):
+    from twisted.internet import reactor
+
+    outcome = {}
+    def finished(results):
+        results['options'] = {
+            'strategy': strategy, 'geo_codes': list(geo_code), 'repetitions': repetitions, 'concurrency': concurrency,
+            'prefetch': prefetch, 'persistent': persistent, 'instances': instances, 'build_delay': build_delay,
+            'failure_rate': failure_rate, 'stream_delay': stream_delay, 'response_delay': response_delay,
+            'db': db, 'db_latency': db_latency, 'circuits': circuits,
+        }
+        results['python'] = platform.python_version()
+        for name in sorted(results):
+            if name not in ('options', 'db_rows'):
+                print('{}: {}'.format(name, results[name]))
+
+        if output is not None:
+            save_results(output, results)
+        if baseline is not None:
+            outcome['ok'] = check_baseline(results, baseline, METRICS, tolerance)
+
+    d = run_benchmark(reactor, strategy, list(geo_code) or ['EU'], repetitions, concurrency, prefetch, persistent, instances,
+        build_delay, failure_rate, stream_delay, response_delay, db, db_latency, circuits)
+    d.addCallback(finished)
+    d.addErrback(lambda failure: (failure.printTraceback(), outcome.update(ok=False)))
+    d.addBoth(lambda ign: reactor.stop())
+
+    reactor.run()
+    sys.exit(0 if outcome.get('ok', True) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer, protocol, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.web import resource, server
+
+import hashlib
+import random
+import struct
+import socket
+import os
+
+def fake_fingerprint(index):
+    return hashlib.sha1(b'relay%d' % index).hexdigest().upper()
+
+class FakeTor():
+    """
+    Stand-in for a tor daemon that answers the part of the control protocol
+    txtorcon and connect_tor.py use, without any network: bootstrap GETINFOs,
+    SETEVENTS, EXTENDCIRCUIT, CLOSECIRCUIT and ATTACHSTREAM. Circuits are
+    "built" after a random delay around build_delay ms and fail with
+    failure_rate, hop by hop with the CIRC events tor sends. Streams opened on
+    the socks port are announced with STREAM events, attached by the
+    controller and connected directly to their target after stream_delay ms.
+
+    Arguments:
+        reactor: reactor object
+        build_delay: mean build time of a circuit in ms
+        failure_rate: probability that a circuit fails
+        stream_delay: delay until a stream is connected in ms
+        relays: number of fake relays for circuits tor picks itself
+    """
+    def __init__(self, reactor, build_delay=300.0, failure_rate=0.1, stream_delay=50.0, relays=1000):
+        self.reactor = reactor
+        self.build_delay = build_delay
+        self.failure_rate = failure_rate
+        self.stream_delay = stream_delay
+        self.relays = [fake_fingerprint(index) for index in xrange(relays)]
+
+        self.controllers = []
+        self.circuits = {}
+        self.streams = {}
+        self.next_circuit = 1
+        self.next_stream = 1
+
+        self.circuits_launched = 0
+        self.circuits_failed = 0
+        self.streams_opened = 0
+
+    def event(self, name, line):
+        for controller in self.controllers:
+            if name in controller.events:
+                controller.sendLine('650 {} {}'.format(name, line))
+
+    def _path(self, relays):
+        return ','.join('${}~relay{}'.format(fp, fp[:6]) for fp in relays)
+
+    def _delay(self, mean):
+        return random.lognormvariate(0, 0.5) * mean / 1000.0 * 0.8825
+
+    def extend_circuit(self, relays):
+        if not relays:
+            relays = random.sample(self.relays, 3)
+
+        circuit_id = self.next_circuit
+        self.next_circuit += 1
+        self.circuits[circuit_id] = relays
+        self.circuits_launched += 1
+
+        self.reactor.callLater(0, self.event, 'CIRC', '{} LAUNCHED PURPOSE=GENERAL'.format(circuit_id))
+
+        fail_at = None
+        if random.random() < self.failure_rate:
+            fail_at = random.randrange(len(relays))
+
+        delay = self._delay(self.build_delay)
+        for hop in xrange(len(relays)):
+            when = delay * (hop + 1) / len(relays)
+            if hop == fail_at:
+                self.reactor.callLater(when, self._fail, circuit_id, hop)
+                break
+            self.reactor.callLater(when, self._extended, circuit_id, hop)
+
+        return circuit_id
+
+    def _extended(self, circuit_id, hop):
+        relays = self.circuits.get(circuit_id)
+        if relays is None:
+            return
+        status = 'BUILT' if hop == len(relays) - 1 else 'EXTENDED'
+        self.event('CIRC', '{} {} {} PURPOSE=GENERAL'.format(circuit_id, status, self._path(relays[:hop + 1])))
+
+    def _fail(self, circuit_id, hop):
+        relays = self.circuits.pop(circuit_id, None)
+        if relays is None:
+            return
+        self.circuits_failed += 1
+        path = self._path(relays[:hop])
+        self.event('CIRC', '{} FAILED {}PURPOSE=GENERAL REASON=TIMEOUT'.format(circuit_id, path + ' ' if path else ''))
+
+    def close_circuit(self, circuit_id):
+        relays = self.circuits.pop(circuit_id, None)
+        if relays is None:
+            return False
+        self.reactor.callLater(0, self.event, 'CIRC', '{} CLOSED {} PURPOSE=GENERAL REASON=REQUESTED'.format(circuit_id, self._path(relays)))
+        return True
+
+    def open_stream(self, socks, target, source):
+        stream_id = self.next_stream
+        self.next_stream += 1
+        self.streams[stream_id] = (socks, target)
+        self.streams_opened += 1
+
+        self.event('STREAM', '{} NEW 0 {} SOURCE_ADDR={}:{} PURPOSE=USER'.format(stream_id, target, source.host, source.port))
+        return stream_id
+
+    def attach_stream(self, stream_id, circuit_id):
+        try:
+            socks, target = self.streams[stream_id]
+        except KeyError:
+            return False
+
+        self.event('STREAM', '{} SENTCONNECT {} {}'.format(stream_id, circuit_id, target))
+        self.reactor.callLater(self.stream_delay / 1000.0, self._connect_stream, stream_id, circuit_id)
+        return True
+
+    @defer.inlineCallbacks
+    def _connect_stream(self, stream_id, circuit_id):
+        socks, target = self.streams[stream_id]
+        host, port = target.rsplit(':', 1)
+        try:
+            yield socks.connect_target(host, int(port))
+        except Exception:
+            self.event('STREAM', '{} FAILED {} {} REASON=CONNECTREFUSED'.format(stream_id, circuit_id, target))
+            self.streams.pop(stream_id, None)
+            return
+        self.event('STREAM', '{} SUCCEEDED {} {}'.format(stream_id, circuit_id, target))
+
+    def close_stream(self, stream_id):
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None:
+            self.event('STREAM', '{} CLOSED 0 {} REASON=DONE'.format(stream_id, stream[1]))
+
+    def control_factory(self):
+        factory = protocol.Factory()
+        factory.protocol = lambda: FakeControlProtocol(self)
+        return factory
+
+    def socks_factory(self):
+        factory = protocol.Factory()
+        factory.protocol = lambda: FakeSocksProtocol(self)
+        return factory
+
+GETINFO_LISTS = ('ns/all', 'circuit-status', 'stream-status', 'address-mappings/all', 'entry-guards', 'config/names', 'config/defaults')
+
+class FakeControlProtocol(LineOnlyReceiver):
+    """
+    One control connection to the FakeTor.
+    """
+    delimiter = b'\r\n'
+
+    def __init__(self, tor):
+        self.tor = tor
+        self.events = set()
+
+    def connectionMade(self):
+        self.tor.controllers.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.tor.controllers:
+            self.tor.controllers.remove(self)
+
+    def lineReceived(self, line):
+        words = line.split()
+        if not words:
+            return
+        command = words[0].upper()
+        handler = getattr(self, 'do_' + command, None)
+        if handler is None:
+            self.sendLine('250 OK')
+        else:
+            handler(words[1:])
+
+    def do_PROTOCOLINFO(self, args):
+        self.sendLine('250-PROTOCOLINFO 1')
+        self.sendLine('250-AUTH METHODS=NULL')
+        self.sendLine('250-VERSION Tor="0.4.8.9"')
+        self.sendLine('250 OK')
+
+    def do_GETINFO(self, keys):
+        for key in keys:
+            if key in GETINFO_LISTS:
+                self.sendLine('250+{}='.format(key))
+                self.sendLine('.')
+            elif key == 'version':
+                self.sendLine('250-version=0.4.8.9')
+            elif key == 'signal/names':
+                self.sendLine('250-signal/names=RELOAD SHUTDOWN DUMP DEBUG HALT HUP INT USR1 USR2 TERM NEWNYM CLEARDNSCACHE HEARTBEAT')
+            elif key == 'events/names':
+                self.sendLine('250-events/names=CIRC CIRC_MINOR STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR NEWDESC ADDRMAP NEWCONSENSUS NS GUARD STATUS_GENERAL STATUS_CLIENT STATUS_SERVER CONF_CHANGED')
+            elif key == 'process/pid':
+                self.sendLine('250-process/pid={}'.format(os.getpid()))
+            else:
+                self.sendLine('552 Unrecognized key "{}"'.format(key))
+                return
+        self.sendLine('250 OK')
+
+    def do_SETEVENTS(self, events):
+        self.events = set(event.upper() for event in events if event.upper() != 'EXTENDED')
+        self.sendLine('250 OK')
+
+    def do_EXTENDCIRCUIT(self, args):
+        relays = []
+        if len(args) > 1 and not args[1].startswith('purpose='):
+            relays = [fp.lstrip('$') for fp in args[1].split(',')]
+        circuit_id = self.tor.extend_circuit(relays)
+        self.sendLine('250 EXTENDED {}'.format(circuit_id))
+
+    def do_CLOSECIRCUIT(self, args):
+        if self.tor.close_circuit(int(args[0])):
+            self.sendLine('250 OK')
+        else:
+            self.sendLine('552 Unknown circuit "{}"'.format(args[0]))
+
+    def do_ATTACHSTREAM(self, args):
+        if self.tor.attach_stream(int(args[0]), int(args[1])):
+            self.sendLine('250 OK')
+        else:
+            self.sendLine('552 Unknown stream "{}"'.format(args[0]))
+
+    def do_QUIT(self, args):
+        self.sendLine('250 closing connection')
+        self.transport.loseConnection()
+
+class ProxyProtocol(protocol.Protocol):
+    """
+    Connection from the fake socks port to the target of a stream.
+    """
+    def __init__(self, peer):
+        self.peer = peer
+
+    def dataReceived(self, data):
+        self.peer.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.peer.target_lost()
+
+class FakeSocksProtocol(protocol.Protocol):
+    """
+    SOCKS5 port of the FakeTor (no authentication, CONNECT only). A CONNECT
+    opens a stream that waits for the controller to attach it, afterwards
+    the bytes are relayed to the target.
+    """
+    def __init__(self, tor):
+        self.tor = tor
+        self.buffer = b''
+        self.state = 'greeting'
+        self.stream_id = None
+        self.target = None
+
+    def dataReceived(self, data):
+        if self.state == 'relay':
+            self.target.transport.write(data)
+            return
+
+        self.buffer += data
+        if self.state == 'greeting' and len(self.buffer) >= 2:
+            methods = ord(self.buffer[1:2])
+            if len(self.buffer) >= 2 + methods:
+                self.buffer = self.buffer[2 + methods:]
+                self.transport.write(b'\x05\x00')
+                self.state = 'request'
+
+        if self.state == 'request':
+            target = self._parse_request()
+            if target is not None:
+                self.state = 'waiting'
+                self.stream_id = self.tor.open_stream(self, target, self.transport.getPeer())
+
+    def _parse_request(self):
+        if len(self.buffer) < 5:
+            return None
+
+        address_type = ord(self.buffer[3:4])
+        if address_type == 1:
+            end = 8
+            host = socket.inet_ntoa(self.buffer[4:8])
+        elif address_type == 3:
+            end = 5 + ord(self.buffer[4:5])
+            host = self.buffer[5:end]
+        else:
+            self.transport.loseConnection()
+            return None
+
+        if len(self.buffer) < end + 2:
+            return None
+        port = struct.unpack('!H', self.buffer[end:end + 2])[0]
+        self.buffer = self.buffer[end + 2:]
+        return '{}:{}'.format(host, port)
+
+    @defer.inlineCallbacks
+    def connect_target(self, host, port):
+        endpoint = TCP4ClientEndpoint(self.tor.reactor, host, port)
+        try:
+            self.target = yield endpoint.connect(protocol.Factory.forProtocol(lambda: ProxyProtocol(self)))
+        except Exception:
+            self.transport.write(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+            self.transport.loseConnection()
+            raise
+
+        self.transport.write(b'\x05\x00\x00\x01\x7f\x00\x00\x01' + struct.pack('!H', port))
+        self.state = 'relay'
+        if self.buffer:
+            self.target.transport.write(self.buffer)
+            self.buffer = b''
+
+    def target_lost(self):
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.target is not None:
+            self.target.transport.loseConnection()
+        if self.stream_id is not None:
+            self.tor.close_stream(self.stream_id)
+
+class TargetFile(resource.Resource):
+    """
+    The file the scanner downloads, size bytes of zeros, served after
+    delay ms.
+    """
+    isLeaf = True
+
+    def __init__(self, reactor, size=500, delay=0.0):
+        resource.Resource.__init__(self)
+        self.reactor = reactor
+        self.body = b'\x00' * size
+        self.delay = delay
+        self.requests = 0
+
+    def render_GET(self, request):
+        self.requests += 1
+        request.setHeader(b'content-type', b'application/octet-stream')
+        if self.delay <= 0:
+            return self.body
+
+        d = task.deferLater(self.reactor, self.delay / 1000.0, lambda: None)
+        d.addCallback(lambda ign: (request.write(self.body), request.finish()))
+        return server.NOT_DONE_YET
+
+def listen(reactor, tor, target):
+    """
+    Listen with the control port, the socks port and the http target on free
+    local ports. Returns (control_port, socks_port, http_port).
+    """
+    control = reactor.listenTCP(0, tor.control_factory(), interface='127.0.0.1')
+    socks = reactor.listenTCP(0, tor.socks_factory(), interface='127.0.0.1')
+    http = reactor.listenTCP(0, server.Site(target), interface='127.0.0.1')
+    return control.getHost().port, socks.getHost().port, http.getHost().port
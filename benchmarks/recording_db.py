@@ -0,0 +1,134 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer, threads
+from twisted.internet.defer import returnValue
+from latency_summary import LatencyHistogram
+
+import time
+
+class RecordingCursor():
+    """
+    Cursor of the RecordingPool. Writes are counted per table. In front of a
+    Storage every statement goes on to the cursor of the database, without
+    one reads get canned rows: the circuits of the fake network for every
+    strategy and geo code and nothing for everything else.
+    """
+    def __init__(self, pool, cursor=None):
+        self.pool = pool
+        self.cursor = cursor
+        self.rows = []
+        self.rowcount = 0
+
+    def _sleep(self):
+        if self.pool.latency > 0:
+            time.sleep(self.pool.latency / 1000.0)
+
+    def execute(self, sql, params=None):
+        self._sleep()
+        words = sql.split()
+        command = words[0].upper()
+
+        if command == 'INSERT':
+            self.pool.count(words[2], 1)
+        if self.cursor is not None:
+            self.cursor.execute(sql, *([] if params is None else [params]))
+            self.rowcount = self.cursor.rowcount
+            return
+
+        self.rows = []
+        self.rowcount = 0
+        if command == 'SELECT':
+            if '.circuits c' in sql:
+                self.rows = self.pool.circuits
+            self.rowcount = len(self.rows)
+        elif command == 'INSERT':
+            self.rowcount = 1
+
+    def executemany(self, sql, rows):
+        self._sleep()
+        rows = list(rows)
+        self.pool.count(sql.split()[2], len(rows))
+        if self.cursor is not None:
+            self.cursor.executemany(sql, rows)
+        self.rowcount = len(rows)
+
+    def fetchall(self):
+        if self.cursor is not None:
+            return self.cursor.fetchall()
+        return list(self.rows)
+
+    def fetchone(self):
+        if self.cursor is not None:
+            return self.cursor.fetchone()
+        return self.rows[0] if self.rows else None
+
+class RecordingPool():
+    """
+    Records the database work of the scanner: the rows written per table
+    and the time from runInteraction to its result for interactions that
+    write. Every statement sleeps latency ms on top, to model a database
+    over the network.
+
+    With a Storage the statements run on its database. Without one the pool
+    is a stand-in for the Storage of the scanner: interactions run in the
+    reactor thread pool like with adbapi and reads get canned rows. The
+    cursor can also be used directly, without a reactor, to run the
+    transaction functions of the scripts synchronously.
+
+    Arguments:
+        circuits: rows returned for the circuits query without a storage
+        latency: ms every statement takes on top
+        storage: Storage of the database, may be None
+    """
+    def __init__(self, circuits=None, latency=0.0, storage=None):
+        self.circuits = circuits or []
+        self.latency = latency
+        self.storage = storage
+        self.db_name = 'bench' if storage is None else storage.db_name
+        self.rows = {}
+        self.write_times = LatencyHistogram()
+
+    def count(self, table, rows):
+        table = table.split('.')[-1]
+        self.rows[table] = self.rows.get(table, 0) + rows
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def _run(self, interaction, *args, **kw):
+        return interaction(self.cursor(), *args, **kw)
+
+    def _record(self, txn, interaction, *args, **kw):
+        return interaction(RecordingCursor(self, txn), *args, **kw)
+
+    @defer.inlineCallbacks
+    def runInteraction(self, interaction, *args, **kw):
+        start = time.time()
+        written = sum(self.rows.values())
+        if self.storage is not None:
+            result = yield self.storage.runInteraction(self._record, interaction, *args, **kw)
+        else:
+            result = yield threads.deferToThread(self._run, interaction, *args, **kw)
+        if sum(self.rows.values()) > written:
+            self.write_times.record((time.time() - start) * 1000)
+        returnValue(result)
+
+    def runQuery(self, sql, *args):
+        def query(txn):
+            txn.execute(sql, *args)
+            return txn.fetchall()
+        return self.runInteraction(query)
+
+    @property
+    def for_update(self):
+        return '' if self.storage is None else self.storage.for_update
+
+    def upsert(self, table, columns, keys, add=()):
+        if self.storage is not None:
+            return self.storage.upsert(table, columns, keys, add)
+        return 'INSERT INTO {}.{} ({}) VALUES ({});'.format(self.db_name, table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+
+    def table_version(self, table):
+        if self.storage is not None:
+            return self.storage.table_version(table)
+        return defer.succeed(1)
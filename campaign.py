@@ -0,0 +1,291 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer, task
+from twisted.internet.defer import returnValue
+from connect_tor import TARGET_URI, CircuitPool, Measurement, RetryBudget, Sampling, collect_instances, connect_instances, load_health, run_workers, sample_work, write_results
+from result_writer import ResultWriter
+from latency_summary import LatencySummaries, RunningStats
+from relay_health import RelayHealth
+from metrics import InstrumentedPool, serve_metrics
+from get_circuits import STRATEGIES, SELECTIONS
+from collections import OrderedDict
+from storage import open_storage
+
+import datetime
+import click
+import json
+import os
+
+PERIODS = ['da', 'ni']
+
+def current_period(now=None):
+    """
+    'da' from 6am to 6pm local time, 'ni' from 6pm to 6am.
+    """
+    now = now or datetime.datetime.now()
+    return 'da' if 6 <= now.hour < 18 else 'ni'
+
+def seconds_to_next_period(now=None):
+    now = now or datetime.datetime.now()
+    change = now.replace(hour=6 if now.hour < 6 else 18, minute=0, second=0, microsecond=0)
+    if now.hour >= 18:
+        change = change.replace(hour=6) + datetime.timedelta(days=1)
+    return (change - now).total_seconds()
+
+class Campaign():
+    """
+    All (strategy, geo_code, period) combinations of a scan, measured by one
+    long-lived process. There is one Measurement per combination, they share
+    the tor instances, the db pool and the ResultWriter, so connection and
+    startup costs are paid once per campaign. The periods of a strategy and
+    geo code share one CircuitPool, its circuits are loaded once.
+
+    The period is not an option but read from the clock: work() interleaves
+    the repetitions of all geo codes of the current period round-robin and
+    stops when the period changes, the next round continues with the other
+    one. The completed repetitions of every combination are written to a json
+    checkpoint file, a campaign started with the same checkpoint resumes
+    where the last one stopped. With an adaptive Sampling a combination is
+    done once its latencies converged, the running statistics are part of
+    the checkpoint.
+
+    Arguments:
+        dbpool: connection to database
+        db_name: database name
+        writer: ResultWriter the results are streamed to
+        summaries: LatencySummaries the latencies are aggregated in
+        cells: list of (strategy, geo_code) combinations
+        repetitions: repetitions per combination and period
+        periods: periods to measure, out of 'da' and 'ni'
+        checkpoint_path: json file with the progress of the campaign
+        persistent: send the requests of a circuit over one connection
+        sampling: Sampling with the stop rules of the adaptive mode
+        health: RelayHealth that tracks the failures of relays
+        retry: RetryBudget of every repetition
+        uri: url of the file the requests download
+    """
+    def __init__(self, dbpool, db_name, writer, summaries, cells, repetitions, periods=PERIODS,
+            checkpoint_path='campaign.json', persistent=False, sampling=None, health=None, retry=None, uri=TARGET_URI):
+        self.writer = writer
+        self.repetitions = repetitions
+        self.periods = periods
+        self.checkpoint_path = checkpoint_path
+        self.loop = None
+
+        pools = dict((cell, CircuitPool(dbpool, db_name, cell[0], cell[1], health=health)) for cell in cells)
+
+        self.cells = OrderedDict()
+        for period in periods:
+            for strategy, geo_code in cells:
+                self.cells[(strategy, geo_code, period)] = Measurement(dbpool, db_name, strategy, geo_code, period, writer, summaries,
+                    persistent, sampling, health, retry, uri, pools[(strategy, geo_code)])
+        self.measurements = list(self.cells.values())
+
+        self.written = {}
+        self.restore()
+
+    def restore(self):
+        if not os.path.exists(self.checkpoint_path):
+            return
+
+        with open(self.checkpoint_path, 'rb') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        resumed = 0
+        for cell in checkpoint['cells']:
+            measurement = self.cells.get(tuple(cell[:3]))
+            if measurement is not None:
+                measurement.completed = cell[3]
+                if len(cell) > 4:
+                    measurement.build_stats = RunningStats(*cell[4])
+                    measurement.request_stats = RunningStats(*cell[5])
+                resumed += measurement.completed
+        print('Resuming campaign from {}: {} repetitions done'.format(self.checkpoint_path, resumed))
+
+    def save(self):
+        """
+        Write the checkpoint atomically, a crash never leaves a partial file.
+        """
+        checkpoint = {
+            'repetitions': self.repetitions,
+            'cells': [(m.strategy, m.geo_code, m.period, m.completed, m.build_stats.to_tuple(), m.request_stats.to_tuple())
+                for m in self.measurements],
+        }
+
+        partial_path = self.checkpoint_path + '.part'
+        with open(partial_path, 'wb') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.rename(partial_path, self.checkpoint_path)
+
+    def start(self, reactor, interval=60):
+        self.loop = task.LoopingCall(self.save)
+        self.loop.clock = reactor
+        self.loop.start(interval, now=False)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.save()
+
+    def remaining(self, period=None):
+        return [m for m in self.measurements
+            if (period is None or m.period == period) and m.completed < self.repetitions and not m.converged()]
+
+    def work(self, period):
+        """
+        Repetitions of the period in the order of sample_work, until all are
+        issued or the clock moved to the other period. Builds that were issued
+        but not measured (prefetched circuits of the last round) are issued
+        again in the next round.
+        """
+        measurements = self.remaining(period)
+        issued = dict((measurement, measurement.completed) for measurement in measurements)
+
+        for measurement in sample_work(measurements, self.repetitions, issued):
+            if current_period() != period:
+                return
+            yield measurement
+
+    @defer.inlineCallbacks
+    def write_round(self):
+        """
+        Queue the failure rates of the repetitions completed since the last
+        round, one circuit_failures row per combination and round.
+        """
+        for measurement in self.measurements:
+            done = measurement.completed - self.written.get(measurement, measurement.completed)
+            self.written[measurement] = measurement.completed
+            if done > 0:
+                yield write_results(self.writer, measurement, done)
+                measurement.builds = measurement.requests = measurement.circuit_fail_cnt = 0
+
+    @defer.inlineCallbacks
+    def run(self, reactor, instances, concurrency=1, prefetch=0):
+        for measurement in self.measurements:
+            self.written[measurement] = measurement.completed
+
+        while self.remaining():
+            period = current_period()
+            if period not in self.periods or not self.remaining(period):
+                wait = seconds_to_next_period()
+                print('Nothing left to measure in period {}, waiting {:.0f}s'.format(period, wait))
+                yield task.deferLater(reactor, wait + 1, lambda: None)
+                continue
+
+            before = sum(m.completed for m in self.measurements)
+            yield run_workers(reactor, instances, self.work(period), concurrency, prefetch)
+            yield self.write_round()
+            self.save()
+
+            if not any(instance.healthy for instance in instances):
+                if sum(m.completed for m in self.measurements) == before:
+                    print('No tor instance is able to measure, stopping the campaign')
+                    break
+                for instance in instances:
+                    instance.failures = 0
+
+        print('Campaign: {} of {} combinations complete'.format(
+            len(self.measurements) - len(self.remaining()), len(self.measurements)))
+
+@defer.inlineCallbacks
+def read_cells(dbpool, db_name, strategies, all_geo_codes=False):
+    """
+    (strategy, geo_code) combinations of the campaign: the SELECTIONS of
+    get_circuits.py or, with all_geo_codes, every geo code that has circuits
+    in the circuits table.
+    """
+    if not all_geo_codes:
+        returnValue([(strategy, geo_code) for strategy in strategies for geo_code in SELECTIONS[strategy]])
+
+    rows = yield dbpool.runQuery('SELECT DISTINCT strategy, geo_code FROM {}.circuits;'.format(db_name))
+    returnValue(sorted((strategy, geo_code) for strategy, geo_code in rows if strategy in strategies))
+
+@defer.inlineCallbacks
+def run_campaign(reactor, tor_control, socks, tor_instances, launch_tor, launch_base_port, tor_data_dir,
+        dbpool, db_name, writer, summaries, health, strategies, all_geo_codes, repetitions, periods, checkpoint_path,
+        checkpoint_interval, concurrency, prefetch, persistent, sampling, retry, uri=TARGET_URI):
+    cells = yield read_cells(dbpool, db_name, strategies, all_geo_codes)
+    campaign = Campaign(dbpool, db_name, writer, summaries, cells, repetitions, periods, checkpoint_path, persistent,
+        sampling, health, retry, uri)
+
+    yield writer.replay()
+    yield load_health(health)
+    writer.start(reactor)
+    summaries.start(reactor)
+    health.start(reactor)
+    campaign.start(reactor, checkpoint_interval)
+
+    instances, launched = yield collect_instances(reactor, tor_control, socks, tor_instances, launch_tor, launch_base_port, tor_data_dir)
+
+    try:
+        yield connect_instances(instances)
+        yield campaign.run(reactor, instances, concurrency, prefetch)
+    finally:
+        campaign.stop()
+        yield health.stop()
+        yield summaries.stop()
+        yield writer.stop()
+        print('Wrote {} result rows, spilled {} to {}'.format(writer.written, writer.spilled, writer.spill_path))
+
+        for instance in launched:
+            yield instance.quit()
+
+@click.command()
+@click.option('--tor-control', default=None, type=int, help='tor control port from torrc config')
+@click.option('--socks', default=None, type=int, help='socks procy from torrc config')
+@click.option('--tor-instance', default=None, type=str, multiple=True, help='CONTROL:SOCKS port pair of another tor instance, can be repeated')
+@click.option('--launch-tor', default=0, type=int, help='number of local tor instances to launch')
+@click.option('--launch-base-port', default=9250, type=int, help='first control port of launched tor instances')
+@click.option('--tor-data-dir', default=None, type=str, help='parent directory for data directories of launched tor instances')
+@click.option('--db-name', default=None, type=str, help='Name of DB')
+@click.option('--db-user', default=None, type=str, help='Username DB')
+@click.option('--db-passwd', default=None, type=str, help='Password DB')
+@click.option('--db-port', default=None, type=int, help='DB connection port')
+@click.option('--db-host', default=None, type=str, help='DB connection host')
+@click.option('--db-file', default=None, type=str, help='SQLite database file, used instead of the MySQL server')
+@click.option('--strategy', default=None, type=click.Choice(STRATEGIES), multiple=True, help='strategies of the campaign, all by default')
+@click.option('--all-geo-codes', is_flag=True, help='measure every geo code of the circuits table instead of the predefined selections')
+@click.option('--repetitions', default=10, type=int, help='Number of repetitions per parameter combination and period')
+@click.option('--period', default=None, type=click.Choice(PERIODS), multiple=True, help='periods of the campaign, both by default')
+@click.option('--checkpoint', default='campaign.json', type=str, help='progress file, the campaign resumes from it')
+@click.option('--checkpoint-interval', default=60, type=int, help='seconds between writes of the progress file')
+@click.option('--concurrency', default=1, type=int, help='number of circuits built and measured at the same time per tor instance')
+@click.option('--prefetch', default=0, type=int, help='number of circuits built ahead per tor instance')
+@click.option('--persistent', is_flag=True, help='reuse one connection for all requests of a circuit')
+@click.option('--flush-rows', default=500, type=int, help='number of buffered result rows that starts a db write')
+@click.option('--flush-interval', default=5, type=int, help='seconds between db writes of buffered results')
+@click.option('--spill-path', default='results.spill', type=str, help='file for results that could not be written to the db')
+@click.option('--summary-interval', default=60, type=int, help='seconds between merges of the latency summaries into the db')
+@click.option('--precision', default=0.0, type=float, help='stop a combination once its mean latencies are known to +-precision (e.g. 0.05), 0 to disable')
+@click.option('--min-repetitions', default=5, type=int, help='repetitions per combination before --precision may stop it')
+@click.option('--min-requests', default=10, type=int, help='requests per circuit before --precision may stop them')
+@click.option('--build-attempts', default=10, type=int, help='circuits a repetition tries before it is counted as failed')
+@click.option('--build-backoff', default=0.25, type=float, help='seconds to wait after the second failed build, doubles with every further failure')
+@click.option('--health-half-life', default=6, type=float, help='hours after which relay failures count half')
+@click.option('--uri', default=TARGET_URI, type=str, help='url of the file the requests download')
+@click.option('--metrics-port', default=None, type=int, help='local port of the metrics endpoint, off by default')
+def main(tor_control, socks, tor_instance, launch_tor, launch_base_port, tor_data_dir, db_name, db_user, db_passwd, db_port, db_host, db_file,
+        strategy, all_geo_codes, repetitions, period, checkpoint, checkpoint_interval, concurrency, prefetch, persistent,
+        flush_rows, flush_interval, spill_path, summary_interval, precision, min_repetitions, min_requests,
+        build_attempts, build_backoff, health_half_life, uri, metrics_port):
+    from twisted.internet import reactor
+
+    dbpool = InstrumentedPool(open_storage(db_name, db_user, db_passwd, db_port, db_host, db_file))
+    db_name = dbpool.db_name
+    if metrics_port is not None:
+        serve_metrics(reactor, metrics_port)
+    writer = ResultWriter(dbpool, db_name, flush_rows, flush_interval, spill_path=spill_path)
+    summaries = LatencySummaries(dbpool, db_name, summary_interval)
+    sampling = Sampling(precision, min_repetitions, min_requests)
+    health = RelayHealth(dbpool, db_name, health_half_life * 3600)
+    retry = RetryBudget(build_attempts, build_backoff)
+
+    d = run_campaign(reactor, tor_control, socks, tor_instance, launch_tor, launch_base_port, tor_data_dir,
+        dbpool, db_name, writer, summaries, health, list(strategy) or STRATEGIES, all_geo_codes, repetitions,
+        list(period) or PERIODS, checkpoint, checkpoint_interval, concurrency, prefetch, persistent, sampling, retry, uri)
+    d.addCallback(lambda ign: reactor.stop())
+
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,45 @@
 #!/usr/bin/env/python
 
 #from __future__ import print_function
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.internet.endpoints import TCP4ClientEndpoint
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.enterprise import adbapi
+from twisted.web.client import HTTPConnectionPool, readBody
+from result_writer import ResultWriter
+from latency_summary import LatencySummaries, RunningStats
+from relay_health import RelayHealth
+from metrics import REGISTRY, PROFILER, InstrumentedPool, serve_metrics
+from twisted.internet.defer import returnValue
+from txtorcon.circuit import _get_circuit_attacher
 
 from twisted.python import log
+from collections import OrderedDict, deque
+from storage import open_storage
+
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        from time import time as monotonic
 
 import sys
+import os
 import random
 import txtorcon
 import click
 import time
 
+# file the requests through a circuit download, overridden with --uri
+TARGET_URI = '' #BLINDED FOR SUBMISSION
+
+BUILD_ATTEMPTS = REGISTRY.counter('scanner_circuit_build_attempts_total', 'Circuits launched by the scanner', ('strategy',))
+BUILD_FAILURES = REGISTRY.counter('scanner_circuit_build_failures_total', 'Circuits that failed to build', ('strategy',))
+BUILD_SECONDS = REGISTRY.histogram('scanner_circuit_build_seconds', 'Build time of circuits from launch to built', ('strategy',))
+REQUESTS = REGISTRY.counter('scanner_requests_total', 'Requests sent through circuits', ('result',))
+REQUESTS_IN_FLIGHT = REGISTRY.gauge('scanner_requests_in_flight', 'Requests sent through circuits and not completely read yet')
+REQUEST_SECONDS = REGISTRY.histogram('scanner_request_seconds', 'Time to first byte of requests through circuits')
+
 class SuccessStatistics():
     """
     Track the success of building circuits. We use this to increment the
@@ -36,241 +62,923 @@ class CircuitLogger(txtorcon.StreamListenerMixin,
     """
     Listen to events and measure timing. We use this to count the number of
     fails and successful circuit builds.
+
+    Times are taken from a monotonic clock and kept per circuit id. The launch
+    time of every circuit is recorded (the LAUNCHED event can arrive before
+    build_circuit returns the id), but a build time is only kept for the
+    circuits we announced with expect(), so tor's own background circuits
+    never end up in our measurements. Entries are removed when a circuit
+    closes or fails, both maps are bounded to max_circuits entries so
+    circuits that never report back are evicted, oldest first.
+
+    Arguments:
+        max_circuits: upper bound of circuits tracked at the same time
     """
-    def __init__(self):
-        self.circuit_new_time = 0
-        self.circuit_built_diff = 0
+    def __init__(self, max_circuits=4096):
+        self.max_circuits = max_circuits
+        self.launch_times = OrderedDict()
+        self.built_diffs = OrderedDict()
+        self.attach_times = OrderedDict()
+        self.expected = set()
+
+    def _bounded_put(self, entries, circuit_id, value):
+        entries[circuit_id] = value
+        while len(entries) > self.max_circuits:
+            evicted, ign = entries.popitem(last=False)
+            self.expected.discard(evicted)
+
+    def _forget(self, circuit_id):
+        self.launch_times.pop(circuit_id, None)
+        self.built_diffs.pop(circuit_id, None)
+        self.attach_times.pop(circuit_id, None)
+        self.expected.discard(circuit_id)
+
+    def expect(self, circuit_id):
+        self.expected.add(circuit_id)
 
     def circuit_new(self, circuit):
-        new_time = int(round(time.time() * 1000))
+        if circuit.id not in self.launch_times:
+            self._bounded_put(self.launch_times, circuit.id, monotonic())
 
-        self.circuit_new_time = new_time
+    def circuit_launched(self, circuit):
+        self.circuit_new(circuit)
 
     def circuit_built(self, circuit):
-        built_time = int(round(time.time() * 1000))
-        built_diff = built_time - self.circuit_new_time
+        built_time = monotonic()
+        launch_time = self.launch_times.pop(circuit.id, None)
+
+        if launch_time is not None and circuit.id in self.expected:
+            self._bounded_put(self.built_diffs, circuit.id, (built_time - launch_time) * 1000)
 
-        self.circuit_built_diff = built_diff
+    def circuit_closed(self, circuit, **kw):
+        self._forget(circuit.id)
+
+    def circuit_failed(self, circuit, **kw):
+        self._forget(circuit.id)
+
+    def stream_attach(self, stream, circuit):
+        if circuit is not None and circuit.id in self.expected:
+            self._bounded_put(self.attach_times, circuit.id, monotonic())
+
+    def attach_time(self, circuit_id):
+        """
+        Monotonic time a stream was last attached to one of our circuits,
+        taken out of the logger. None if no stream was attached since.
+        """
+        return self.attach_times.pop(circuit_id, None)
+
+    def built_diff(self, circuit_id):
+        """
+        Build time in ms of one of our circuits, taken out of the logger.
+        Returns None if the circuit was not seen launching and building.
+        """
+        return self.built_diffs.pop(circuit_id, None)
 
 @defer.inlineCallbacks
-def write_results(dbpool, db_name, strategy, geo_code, period, repetitions, request_timing, circuit_build_timing, circuit_fail_cnt, circuit_success_cnt):
+def write_results(writer, measurement, repetitions):
+    """
+    Queue the failure rate of a finished measurement. The circuit and request
+    timing was already streamed to the ResultWriter during the run.
+
+    Arguments:
+        writer: ResultWriter of the run
+        measurement: Measurement of one strategy and geo code
+        repetitions: number of repetitions of the measurement
+    """
+    yield writer.add('circuit_failures', (measurement.strategy, measurement.geo_code, measurement.period,
+        measurement.circuit_fail_cnt, repetitions))
+
+    print('Results for {gc}: {c_time} circ timing, {r_time} req timing, {cf} circ failures, {cs} circ successes.'.format(
+        gc = measurement.geo_code,
+        c_time = measurement.builds,
+        r_time = measurement.requests,
+        cf = measurement.circuit_fail_cnt,
+        cs = measurement.statistics.circuit_success_cnt))
+
+class CircuitPool():
+    """
+    Circuits of one strategy and geo code, loaded once from the circuits table
+    (found through its covering index, the relay fids are resolved to
+    fingerprints by primary key) and handed out without replacement. Every get() swaps a random remaining
+    circuit to the front of the unused part of the list (a lazy Fisher-Yates
+    shuffle), so drawing a circuit is O(1) and no circuit repeats before all
+    were used once.
+
+    The pool reloads itself when it runs out of circuits or when the circuits
+    table was replaced by get_circuits.py. The latter is checked at most every
+    refresh_interval seconds through the creation time of the table, which
+    changes with every rebuild because the new table is renamed into place.
+
+    Circuits with a relay that the RelayHealth considers unreliable are
+    skipped.
+
+    Arguments:
+        dbpool: connection to database
+        db_name: database name
+        strategy: strategy of the circuits
+        geo_code: geo code of the circuits
+        refresh_interval: seconds between checks for a rebuilt circuits table
+        health: RelayHealth of the run, may be None
+    """
+    def __init__(self, dbpool, db_name, strategy, geo_code, refresh_interval=60, health=None):
+        self.dbpool = dbpool
+        self.db_name = db_name
+        self.strategy = strategy
+        self.geo_code = geo_code
+        self.refresh_interval = refresh_interval
+        self.health = health
+        self.skipped = 0
+
+        self.circuits = []
+        self.position = 0
+        self.version = None
+        self.checked = None
+
+    def table_version(self):
+        return self.dbpool.table_version('circuits')
+
+    @defer.inlineCallbacks
+    def load(self):
+        self.version = yield self.table_version()
+
+        rows = yield self.dbpool.runQuery(
+            'SELECT e.fp, m.fp, x.fp, c.geo_code FROM {0}.circuits c '
+            'JOIN {0}.fingerprints e ON e.fid = c.entry_relay '
+            'JOIN {0}.fingerprints m ON m.fid = c.middle_relay '
+            'JOIN {0}.fingerprints x ON x.fid = c.exit_relay '
+            'WHERE c.strategy = %s AND c.geo_code = %s;'.format(self.db_name),
+            (self.strategy, self.geo_code))
+
+        self.circuits = list(rows)
+        self.position = 0
+        print('Loaded {} circuits for {} {}'.format(len(self.circuits), self.strategy, self.geo_code))
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        now = time.time()
+        exhausted = self.position >= len(self.circuits)
+
+        if self.checked is None or exhausted or now - self.checked >= self.refresh_interval:
+            self.checked = now
+            version = yield self.table_version()
+            if version != self.version or exhausted:
+                yield self.load()
+
+    @defer.inlineCallbacks
+    def get(self):
+        """
+        Next unused circuit as [entry, middle, exit, geo_code], an empty list
+        if there are no circuits for this strategy and geo code.
+        """
+        try:
+            yield self.refresh()
+        except Exception as err:
+            print('Error retrieving circuits: ', err)
+
+        circuits = self.circuits
+        with PROFILER.phase('circuit_pool'):
+            while self.position < len(circuits):
+                index = random.randrange(self.position, len(circuits))
+                circuits[self.position], circuits[index] = circuits[index], circuits[self.position]
+
+                circuit = circuits[self.position]
+                self.position += 1
+
+                if self.health is None or not any(self.health.unreliable(fp) for fp in circuit[:3]):
+                    returnValue(list(circuit))
+                self.skipped += 1
+
+        returnValue([])
+
+class CircuitBuildError(Exception):
+    pass
 
-    db_cols_circ = '(build_offset, strategy, geo_code, period)'
-    db_cols_req = '(request_offset, strategy, geo_code, period)'
-    db_cols_err = '(strategy, geo_code, period, rate, repetitions)'
+class RetryBudget():
+    """
+    Number of circuits a repetition may try before it is given up, and the
+    backoff between the attempts: no wait before the second attempt, then
+    backoff seconds, doubling up to max_backoff.
+    """
+    def __init__(self, attempts=10, backoff=0.25, max_backoff=30):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
 
-    quote ='"'
-    period_string = '{}{}{}'.format(quote,period,quote)
-    print period_string
+    def delay(self, attempt):
+        if attempt < 2 or self.backoff <= 0:
+            return 0
+        return min(self.backoff * 2 ** (attempt - 2), self.max_backoff)
 
-    for time in circuit_build_timing:
-        time_string = '{}{}{}'.format(quote, time, quote)
+def failed_relay(circ, relays):
+    """
+    Fingerprint of the relay a circuit failed at: the hop after the last one
+    it was extended to. None if the circuit was never launched.
+    """
+    if circ is None or not relays:
+        return None
+    return relays[min(len(circ.path), len(relays) - 1)]
 
+@defer.inlineCallbacks
+def build_circuit(reactor, state, listener, statistics, strategy, circuit_pool, retry=None):
+    """
+    Build a circuit for one repetition, a failed build is retried with
+    another circuit until one is successful or the retry budget is used up.
+    Returns the circuit and its build time in ms, raises CircuitBuildError
+    if no circuit could be built.
+
+    The relay a circuit failed at and the relays of a built circuit are
+    reported to the RelayHealth of the circuit pool.
+
+    Arguments:
+        reactor: reactor object for the backoff between attempts
+        state: TorState of the control connection
+        listener: CircuitLogger registered with the state
+        statistics: SuccessStatistics of this run
+        strategy: current strategy, 'weighted' leaves path selection to tor
+        circuit_pool: CircuitPool of the strategy and geo code
+        retry: RetryBudget of the repetition
+    """
+    retry = retry or RetryBudget()
+    health = circuit_pool.health
+
+    for attempt in xrange(retry.attempts):
+        delay = retry.delay(attempt)
+        if delay > 0:
+            yield task.deferLater(reactor, delay, lambda: None)
+
+        circ = None
+        relays = []
+        if strategy != 'weighted':
+            circuit_data = yield circuit_pool.get()
+            if not circuit_data:
+                # an empty path would let tor pick all relays itself
+                raise CircuitBuildError('No circuits for {} {}'.format(circuit_pool.strategy, circuit_pool.geo_code))
+            relays = circuit_data[:3]
+
+        BUILD_ATTEMPTS.inc(strategy=strategy)
         try:
-            yield dbpool.runQuery('INSERT INTO {}.circuit_statistics {} VALUES ({},{},{},{});'.format(
-                db_name,
-                db_cols_circ,
-                time_string,strategy,geo_code,period_string))
+            if strategy == 'weighted':
+                circ = yield state.build_circuit()
+            else:
+                circ = yield state.build_circuit(relays,using_guards=False)
+            listener.expect(circ.id)
+            yield circ.when_built()
+
+            statistics.circuit_succeeded()
         except Exception as err:
-            print('Unable to write circ timing to db: ', err)
-            pass
+            statistics.circuit_failed()
+            BUILD_FAILURES.inc(strategy=strategy)
+
+            fp = failed_relay(circ, relays)
+            if health is not None and fp is not None:
+                health.failed(fp)
+            continue
+
+        if health is not None:
+            health.succeeded(relays)
+        build_time = listener.built_diff(circ.id)
+        if build_time is not None:
+            BUILD_SECONDS.observe(build_time / 1000.0, strategy=strategy)
+        returnValue((circ, build_time))
 
-    for time in request_timing:
-        time_string = '{}{}{}'.format(quote, time, quote)
+    raise CircuitBuildError('No circuit built after {} attempts'.format(retry.attempts))
 
+@defer.inlineCallbacks
+def measure_circuit(reactor, circ, socks_port, listener, persistent=False, num_repetitions=50, sampling=None, uri=TARGET_URI):
+    """
+    Send num_repetitions requests through the circuit and close it. Returns
+    the average request time in ms (until the response headers arrived), None
+    if a request failed, and the phases of every request.
+
+    With an adaptive Sampling the requests stop early once the average of
+    the circuit is known to the sampling precision, but not before
+    min_requests were sent.
+
+    The phases are (attach, ttfb, body) in ms after the request started,
+    measured with the monotonic clock: attach is when tor attached the stream
+    to the circuit (0 if an open connection was reused), ttfb when the
+    response headers arrived, and body when the body was read completely.
+
+    With persistent all requests go through one agent with a persistent
+    connection pool, so after the first request no new stream and HTTP
+    connection have to be set up and the requests measure the circuit round
+    trip only.
+
+    For the requests you'll need a web server. Example: run apache and provide
+    a random binary file for download.
+    We used a 500 Bytes bin file. uri is the url of the file.
+    """
+    avg_request_time = 0
+    phases = []
+    stats = RunningStats()
+
+    pool = None
+    agent = None
+    if persistent:
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = 1
+        agent = circ.web_agent(reactor, socks_port, pool=pool)
+
+    print('Repeat {} Requests now'.format(num_repetitions))
+    for i in xrange(0,num_repetitions):
         try:
-            print('INSERT INTO {}.request_statistics {} VALUES ({},{},{},{});'.format(
-                db_name,
-                db_cols_req,
-                time_string,strategy,geo_code,period_string))
-            yield dbpool.runQuery('INSERT INTO {}.request_statistics {} VALUES ({},{},{},{});'.format(
-                db_name,
-                db_cols_req,
-                time_string,strategy,geo_code,period_string))
+            if not persistent:
+                agent = circ.web_agent(reactor, socks_port)
+
+            listener.attach_time(circ.id)
+            request_start_time = monotonic()
+            REQUESTS_IN_FLIGHT.inc()
+            try:
+                resp = yield agent.request(b'GET', uri)
+                headers_time = monotonic()
+                yield readBody(resp)
+                body_time = monotonic()
+            finally:
+                REQUESTS_IN_FLIGHT.dec()
+
+            attach_time = listener.attach_time(circ.id)
+            attach_delta = 0.0
+            if attach_time is not None:
+                attach_delta = (attach_time - request_start_time) * 1000
+
+            request_delta = (headers_time - request_start_time) * 1000
+            phases.append((attach_delta, request_delta, (body_time - request_start_time) * 1000))
+
+            REQUESTS.inc(result='ok')
+            REQUEST_SECONDS.observe(request_delta / 1000.0)
+
+            avg_request_time = avg_request_time + request_delta
+            stats.add(request_delta)
+            if sampling is not None and sampling.requests_converged(stats):
+                break
         except Exception as err:
-            print('Unable to write req timing to db: ', err)
-            pass
+            print('Error in request: ', err)
+            REQUESTS.inc(result='error')
 
-    rate = '"{}"'.format(circuit_fail_cnt)
-    rep_string = '"{}"'.format(repetitions)
-    try:
-        yield dbpool.runQuery('INSERT INTO {}.circuit_failures {} VALUES ({},{},{},{},{});'.format(
-            db_name,
-            db_cols_err,
-            strategy,geo_code, period_string, rate, rep_string))
-    except Exception as err:
-        print('Unable to write errors to db: ', err)
-        pass
+            if pool is not None:
+                yield pool.closeCachedConnections()
+            yield circ.close()
+            returnValue((None, phases))
 
-    print('Results for {gc}: {c_time} circ timing, {r_time} req timing, {cf} circ failures, {cs} circ successes.'.format(
-        gc = geo_code,
-        c_time = len(circuit_build_timing),
-        r_time = len(request_timing),
-        cf = circuit_fail_cnt,
-        cs = circuit_success_cnt))
-
-    circuit_fail_cnt = 0
-    circuit_success_cnt = 0
-
-@inlineCallbacks
-def get_circuit(strategy, geo_code, dbpool, db_name, state):
-    relays = []
-    try:
-        circuits_tuple = yield dbpool.runQuery('SELECT * FROM {}.circuits WHERE strategy = {} AND geo_code = {};'.format(
-            db_name, strategy, geo_code))
-    except Exception as err:
-        print('Error retrieving circuits: ', err)
+    if pool is not None:
+        yield pool.closeCachedConnections()
+    yield circ.close()
+    returnValue((float(avg_request_time) / float(stats.count), phases))
 
-    try:
-        circuits = list(circuits_tuple)
-        random.shuffle(circuits)
+class TorInstance():
+    """
+    One tor daemon driven by the scanner: its control and socks port, the
+    TorState and CircuitLogger of the control connection, and its health. An
+    instance that failed max_failures repetitions in a row is considered
+    unhealthy and stops taking work, the remaining work goes to the other
+    instances.
 
-        relays = [circuits[0][1], circuits[0][2], circuits[0][3], circuits[0][5]]
-    except Exception as err:
-        pass
+    Arguments:
+        reactor: reactor object from import in main
+        control_port: tor control port
+        socks_port: tor socks port
+        tor: txtorcon Tor object if the instance was launched by us, the
+            daemon is stopped through it even after the control connection
+            was replaced by a reconnect
+        max_failures: consecutive failures until the instance is given up
+    """
+    def __init__(self, reactor, control_port, socks_port, tor=None, max_failures=5):
+        self.reactor = reactor
+        self.control_port = int(control_port)
+        self.socks_port = int(socks_port)
+        self.socks_endpoint = TCP4ClientEndpoint(reactor, 'localhost', self.socks_port)
+        self.tor = tor
+        self.process = tor
+        self.max_failures = max_failures
+
+        self.state = None
+        self.listener = None
+        self.failures = 0
+        self.successes = 0
+
+    def __str__(self):
+        return 'tor {}/{}'.format(self.control_port, self.socks_port)
+
+    @property
+    def healthy(self):
+        return self.state is not None and self.failures < self.max_failures
+
+    def succeeded(self):
+        self.failures = 0
+        self.successes += 1
+
+    def failed(self):
+        self.failures += 1
+        if self.failures == self.max_failures:
+            print('Giving up on {} after {} failures in a row'.format(self, self.failures))
+
+    @defer.inlineCallbacks
+    def connect(self, attempt_limit=5):
+        cnt = 0
+        while cnt < attempt_limit:
+            try:
+                if self.tor is None:
+                    control_endpoint = TCP4ClientEndpoint(self.reactor, 'localhost', self.control_port)
+                    self.tor = yield txtorcon.connect(self.reactor, control_endpoint)
+                self.state = yield self.tor.create_state()
+
+                # txtorcon has one circuit attacher per process and registers
+                # it only with the first state, streams of every other instance
+                # would never be attached
+                attacher = yield _get_circuit_attacher(self.reactor, self.state)
+                yield self.state.set_attacher(attacher, self.reactor)
+
+                self.listener = CircuitLogger()
+                self.state.add_circuit_listener(self.listener)
+                self.state.add_stream_listener(self.listener)
+            except Exception as err:
+                print('Could not connect to {}: '.format(self), err)
+                self.tor = None
+                cnt += 1
+                continue
+            break
+
+        returnValue(self.state is not None)
+
+    @defer.inlineCallbacks
+    def quit(self):
+        """
+        Stop the tor daemon if it was launched by us, instances we only
+        connected to keep running.
+        """
+        if self.process is None:
+            return
+        try:
+            yield self.process.quit()
+        except Exception as err:
+            print('Could not stop {}: '.format(self), err)
 
-    returnValue(relays)
+class Measurement():
+    """
+    Results of one strategy and geo code. Repetitions of the same measurement
+    may run on different tor instances, they all stream their timing through
+    the shared ResultWriter and record it in the LatencySummaries. The add
+    methods return the Deferred of the writer, it waits while the write
+    buffer is full.
+
+    Build times and the average request time of every circuit are also kept
+    as running statistics, they tell the adaptive mode how precise the
+    estimates of the measurement are.
+
+    Measurements of the same strategy and geo code in different periods can
+    share one circuit_pool, otherwise the measurement loads its own.
+    """
+    def __init__(self, dbpool, db_name, strategy, geo_code, period, writer, summaries, persistent=False, sampling=None,
+            health=None, retry=None, uri=TARGET_URI, circuit_pool=None):
+        self.strategy = strategy
+        # the result tables have no NULL geo code, strategies without one use ''
+        self.geo_code = geo_code or ''
+        self.period = period
+        self.writer = writer
+        self.summaries = summaries
+        self.persistent = persistent
+        self.uri = uri
+        self.sampling = sampling or Sampling()
+        self.retry = retry or RetryBudget()
+        self.build_stats = RunningStats()
+        self.request_stats = RunningStats()
+        self.circuit_pool = circuit_pool or CircuitPool(dbpool, db_name, strategy, self.geo_code, health=health)
+        self.statistics = SuccessStatistics()
+
+        self.builds = 0
+        self.requests = 0
+        self.circuit_fail_cnt = 0
+        self.circuits = 0
+        self.completed = 0
+
+    def next_circuit(self):
+        self.circuits += 1
+        return self.circuits
+
+    def add_build_time(self, build_time):
+        self.builds += 1
+        self.build_stats.add(build_time)
+        self.summaries.record(self.strategy, self.geo_code, self.period, 'build', build_time)
+        return self.writer.add('circuit_statistics', (build_time, self.strategy, self.geo_code, self.period))
+
+    def add_requests(self, avg_request_time, phases):
+        circuit_index = self.next_circuit()
+        writes = []
+        with PROFILER.phase('results'):
+            for request, phase in enumerate(phases):
+                self.summaries.record(self.strategy, self.geo_code, self.period, 'request', phase[1])
+                self.summaries.record(self.strategy, self.geo_code, self.period, 'body', phase[2])
+                writes.append(self.writer.add('request_phases',
+                    (circuit_index, request) + phase + (self.strategy, self.geo_code, self.period)))
+
+            if avg_request_time is not None:
+                self.requests += 1
+                self.request_stats.add(avg_request_time)
+                writes.append(self.writer.add('request_statistics', (avg_request_time, self.strategy, self.geo_code, self.period)))
+
+        return defer.gatherResults(writes)
+
+    def relative_error(self):
+        """
+        Larger relative confidence interval of the build and request time,
+        infinite while one of them is unknown.
+        """
+        errors = [self.build_stats.relative_error(), self.request_stats.relative_error()]
+        if None in errors:
+            return float('inf')
+        return max(errors)
+
+    def converged(self):
+        return self.sampling.converged(self)
+
+class Sampling():
+    """
+    Stop rules of the adaptive mode. With precision 0 every measurement gets
+    all its repetitions and every circuit all its requests, as before.
+    Otherwise a measurement is done when the 95% confidence intervals of its
+    mean build time and mean request time are within precision of the means
+    (0.05 = +-5%), after at least min_repetitions repetitions, and the
+    requests through a circuit stop in the same way after min_requests.
+
+    Arguments:
+        precision: target relative half width of the confidence intervals
+        min_repetitions: repetitions of a measurement before it may stop
+        min_requests: requests through a circuit before they may stop
+    """
+    def __init__(self, precision=0, min_repetitions=5, min_requests=10):
+        self.precision = precision
+        self.min_repetitions = min_repetitions
+        self.min_requests = min_requests
+
+    def converged(self, measurement):
+        if self.precision <= 0:
+            return False
+        return (measurement.build_stats.converged(self.precision, self.min_repetitions) and
+            measurement.request_stats.converged(self.precision, self.min_repetitions))
+
+    def requests_converged(self, stats):
+        return self.precision > 0 and stats.converged(self.precision, self.min_requests)
+
+def sample_work(measurements, repetitions, issued=None):
+    """
+    Iterator over the repetitions of the measurements, one Measurement per
+    repetition, until every measurement was issued repetitions times or
+    converged. Measurements below their min_repetitions go first, in turns,
+    after that the measurement with the widest confidence interval is next,
+    so noisy geo codes get more samples than stable ones. Without adaptive
+    sampling this is the same round-robin order as before.
+
+    Arguments:
+        measurements: list of Measurement
+        repetitions: upper bound of repetitions per measurement
+        issued: repetitions already done per Measurement, e.g. when resuming
+    """
+    issued = issued if issued is not None else dict((measurement, 0) for measurement in measurements)
+
+    def priority(measurement):
+        if measurement.sampling.precision <= 0:
+            return (0, 0.0, -issued[measurement])
+        if issued[measurement] < measurement.sampling.min_repetitions:
+            return (1, 0.0, -issued[measurement])
+        return (0, measurement.relative_error(), -issued[measurement])
+
+    while True:
+        cells = [m for m in measurements if issued[m] < repetitions and not m.converged()]
+        if not cells:
+            return
+
+        measurement = max(cells, key=priority)
+        issued[measurement] += 1
+        yield measurement
+
+def start_build(instance, measurement):
+    return build_circuit(instance.reactor, instance.state, instance.listener, measurement.statistics,
+        measurement.strategy, measurement.circuit_pool, measurement.retry)
+
+class CircuitPrefetcher():
+    """
+    Keep up to depth circuits of one tor instance building ahead of the
+    measurements. Every take() hands out the oldest pending build together
+    with its repetition and immediately starts the build for the next
+    repetition, so while one circuit is measuring its requests the next ones
+    are already being built and a new measurement usually starts with a warm
+    circuit.
+
+    Arguments:
+        instance: TorInstance the circuits are built on
+        work: shared iterator of Measurement, one item per repetition
+        depth: number of circuits built ahead
+    """
+    def __init__(self, instance, work, depth):
+        self.instance = instance
+        self.work = work
+        self.depth = depth
+        self.pending = deque()
+
+    def fill(self):
+        while len(self.pending) < self.depth and self.instance.healthy:
+            try:
+                measurement = next(self.work)
+            except StopIteration:
+                break
+            self.pending.append((measurement, start_build(self.instance, measurement)))
+
+    def take(self):
+        """
+        Next (measurement, build deferred), None if there is no more work.
+        """
+        self.fill()
+        if not self.pending:
+            return None
+
+        item = self.pending.popleft()
+        self.fill()
+        return item
+
+    def close(self):
+        """
+        Drop the circuits that were built ahead but will not be measured. They
+        are not failures of the measurement, only a build that failed counts.
+        """
+        def failed(failure, measurement):
+            measurement.circuit_fail_cnt += 1
+
+        while self.pending:
+            measurement, build = self.pending.popleft()
+            build.addCallbacks(lambda result: result[0].close(), failed, errbackArgs=(measurement,))
+            build.addErrback(lambda failure: None)
 
 @defer.inlineCallbacks
-def connect_tor(reactor, tor_control, socks, dbpool, db_name, strategy, geo_code, repetitions, period):
+def measure_repetition(reactor, instance, measurement, build=None):
+    """
+    One repetition: build a circuit on the tor instance and time the requests
+    through it. Every repetition keeps its circuit and timing to itself until
+    it hands the results to the writer, so concurrent repetitions do not mix
+    up their measurements.
+
+    Arguments:
+        build: deferred of a circuit built ahead by the CircuitPrefetcher,
+            a new circuit is built if it is None
+    """
+    if build is None:
+        build = start_build(instance, measurement)
+
+    circ, build_time = yield build
+    if build_time is not None:
+        yield measurement.add_build_time(build_time)
+
+    avg_request_time, phases = yield measure_circuit(reactor, circ, instance.socks_endpoint, instance.listener,
+        measurement.persistent, sampling=measurement.sampling, uri=measurement.uri)
+    yield measurement.add_requests(avg_request_time, phases)
+
+@defer.inlineCallbacks
+def instance_worker(reactor, instance, work, prefetcher=None):
+    """
+    Take repetitions from the shared work iterator (or the prefetcher of the
+    instance) and measure them on one tor instance until the work is done or
+    the instance became unhealthy.
+    """
+    while instance.healthy:
+        build = None
+        if prefetcher is not None:
+            item = prefetcher.take()
+            if item is None:
+                break
+            measurement, build = item
+        else:
+            try:
+                measurement = next(work)
+            except StopIteration:
+                break
+
+        try:
+            yield measure_repetition(reactor, instance, measurement, build)
+            instance.succeeded()
+        except Exception as err:
+            print('Repetition failed on {}: '.format(instance), err)
+            measurement.circuit_fail_cnt += 1
+            instance.failed()
+        measurement.completed += 1
+
+@defer.inlineCallbacks
+def launch_instances(reactor, count, base_port, data_dir=None):
+    """
+    Launch count local tor daemons, instance i uses the control port
+    base_port + 2i and the socks port base_port + 2i + 1.
+    """
+    launches = []
+    for index in xrange(count):
+        control_port = base_port + 2 * index
+        socks_port = control_port + 1
+        data_directory = None
+        if data_dir is not None:
+            data_directory = os.path.join(data_dir, 'tor{}'.format(index))
+
+        d = txtorcon.launch(reactor, control_port=control_port, socks_port=socks_port, data_directory=data_directory)
+        d.addCallback(lambda tor, c=control_port, s=socks_port: TorInstance(reactor, c, s, tor))
+        launches.append(d)
+
+    results = yield defer.DeferredList(launches, consumeErrors=True)
+
+    instances = []
+    for success, result in results:
+        if success:
+            instances.append(result)
+        else:
+            print('Could not launch tor: ', result.getErrorMessage())
+
+    returnValue(instances)
+
+@defer.inlineCallbacks
+def connect_tor(reactor, instances, dbpool, db_name, writer, summaries, strategy, geo_codes, repetitions, period, concurrency=1, prefetch=0,
+        persistent=False, sampling=None, health=None, retry=None, uri=TARGET_URI):
     """
     Manages the building of circuits and sends n Bytes requests to our local
     server.
 
+    The repetitions of all geo codes are spread over the tor instances: every
+    instance runs concurrency workers that take the next repetition from a
+    shared queue, so faster instances do more work and an instance that fails
+    repeatedly drops out. Results of all instances are merged per geo code.
+
     Arguments:
         reactor: inline callback reactor object from import in main
-        tor_control: control port, read in options
-        socks: socks port, read in options
+        instances: list of TorInstance to measure with
         dbpool: connection to database
         db_name: whatever name you have your database
+        writer: ResultWriter the results are streamed to
+        summaries: LatencySummaries the latencies are aggregated in
         strategy: current strategy for the selection of circuits
-        geo_code: specification of where the circuit will be built, follows the
-            strategy
+        geo_codes: specifications of where the circuits will be built, follow
+            the strategy, '' for the strategies without a geo code
         repetitions: this many random repetitions are made for one set of
-            strategy and geo_code
+            strategy and geo_code, at most if sampling is adaptive
         period: time of the day according to your local time zone, can be 'da'
             for daytime (6am - 6pm) or 'ni' for nighttime (6pm - 6am)
+        concurrency: number of circuits that are built and measured at the
+            same time on each tor instance
+        prefetch: number of circuits each tor instance builds ahead while
+            the current ones are measured
+        persistent: send the requests of a circuit over one persistent
+            connection instead of a new stream per request
+        sampling: Sampling with the stop rules of the adaptive mode
+        health: RelayHealth that tracks the failures of relays
+        retry: RetryBudget of every repetition
+        uri: url of the file the requests download
+
+    Returns the Measurement of every geo code.
     """
-    strategy_string = '"{}"'.format(strategy)
-    geo_string = '"{}"'.format(geo_code)
+    measurements = [Measurement(dbpool, db_name, strategy, geo_code, period, writer, summaries, persistent, sampling, health, retry, uri)
+        for geo_code in geo_codes]
+    work = sample_work(measurements, repetitions)
 
-    control_port = TCP4ClientEndpoint(reactor, 'localhost', int(tor_control))
-    socks_port = TCP4ClientEndpoint(reactor, 'localhost', int(socks))
+    yield connect_instances(instances)
+    yield run_workers(reactor, instances, work, concurrency, prefetch)
 
-    cnt = 0
-    attempt_limit = 5
-    while cnt < attempt_limit:
-        try:
-            tor = yield txtorcon.connect(reactor,control_port)
-            state = yield tor.create_state()
-
-            statistics = SuccessStatistics()
-            listener = CircuitLogger()
-            state.add_circuit_listener(listener)
-
-            circuit_build_timing = []
-            request_timing = []
-
-            circuit_fail_cnt = 0
-            circuit_success_cnt = 0
-
-            for repetition in xrange(1,repetitions+1):
-                if strategy == 'weighted':
-                    while True:
-                        try:
-                            circ = yield state.build_circuit()
-                            yield circ.when_built()
-
-                            circuit_build_timing.append(listener.circuit_built_diff)
-                            statistics.circuit_succeeded()
-                        except Exception as err:
-                            statistics.circuit_failed()
-                            continue
-
-                        break
-                else:
-                    while True:
-                        circuit_data = yield get_circuit(strategy_string, geo_string, dbpool, db_name, state)
-                        relays = [circuit_data[0],circuit_data[1],circuit_data[2]]
-
-                        try:
-                            circ = yield state.build_circuit(relays,using_guards=False)
-                            yield circ.when_built()
-
-                            circuit_build_timing.append(listener.circuit_built_diff)
-                            statistics.circuit_succeeded()
-
-                        except Exception as err:
-                            statistics.circuit_failed()
-                            continue
-
-                        break
-
-                if True:
-                    successful = 1
-                    avg_request_time = 0
-                    num_repetitions = 50
-
-                    """
-                    For the requests you'll need a web server. Example: run apache and provide
-                    a random binary file for download.
-                    We used a 500 Bytes bin file.
-                    """
-
-                    print('Repeat 50 Requests now')
-                    for i in xrange(0,num_repetitions):
-                        try:
-                            uri = '' #BLINDED FOR SUBMISSION
-                            agent = circ.web_agent(reactor, socks_port)
-
-                            request_start_time = int(round(time.time() * 1000))
-                            resp = yield agent.request(b'GET', uri)
-
-                            request_end_time = int(round(time.time() * 1000))
-                            request_delta = request_end_time - request_start_time
-
-                            avg_request_time = avg_request_time + request_delta
-                        except Exceptions as err:
-                            print('Error in request: ', err)
-
-                            yield circ.close()
-                            successful = 0
-                            break
-
-                    if successful == 1:
-                        avg_request_time = float(avg_request_time) / float(num_repetitions)
-                        request_timing.append(avg_request_time)
-                        yield circ.close()
+    for measurement in measurements:
+        yield write_results(writer, measurement, measurement.completed)
 
-        except Exception as err:
-            circuit_fail_cnt += 1
-            cnt += 1
-            continue
-        break
+    returnValue(measurements)
+
+@defer.inlineCallbacks
+def connect_instances(instances):
+    connected = yield defer.DeferredList([instance.connect() for instance in instances])
+    if not any(result for success, result in connected if success):
+        print('Could not connect to any tor instance')
+
+@defer.inlineCallbacks
+def run_workers(reactor, instances, work, concurrency=1, prefetch=0):
+    """
+    Measure the repetitions of the work iterator on all healthy tor
+    instances, with concurrency workers and a CircuitPrefetcher of depth
+    prefetch per instance. Fires when the work is done or no instance is
+    healthy anymore.
+    """
+    workers = []
+    prefetchers = []
+    for instance in instances:
+        if instance.healthy:
+            prefetcher = None
+            if prefetch > 0:
+                prefetcher = CircuitPrefetcher(instance, work, prefetch)
+                prefetchers.append(prefetcher)
+            workers.extend(instance_worker(reactor, instance, work, prefetcher) for worker in xrange(concurrency))
+    yield defer.DeferredList(workers)
+
+    for prefetcher in prefetchers:
+        prefetcher.close()
+
+    for instance in instances:
+        print('{}: {} successful repetitions'.format(instance, instance.successes))
 
+@defer.inlineCallbacks
+def collect_instances(reactor, tor_control, socks, tor_instances, launch_tor, launch_base_port, tor_data_dir):
+    """
+    TorInstances of the options: the single --tor-control and --socks pair,
+    every --tor-instance, and --launch-tor local daemons. Returns all
+    instances and the launched ones, which have to be stopped at the end.
+    """
+    instances = []
+    if tor_control is not None and socks is not None:
+        instances.append(TorInstance(reactor, tor_control, socks))
+    for ports in tor_instances:
+        control_port, socks_port = ports.split(':')
+        instances.append(TorInstance(reactor, control_port, socks_port))
+
+    launched = []
+    if launch_tor > 0:
+        launched = yield launch_instances(reactor, launch_tor, launch_base_port, tor_data_dir)
+        instances.extend(launched)
+
+    returnValue((instances, launched))
+
+@defer.inlineCallbacks
+def load_health(health):
     try:
-        yield write_results(dbpool, db_name, strategy_string, geo_string, period, repetitions, request_timing, circuit_build_timing, circuit_fail_cnt, circuit_success_cnt)
+        yield health.load()
     except Exception as err:
-        print('Failure writing results:', err)
+        print('Could not load relay health, starting without: ', err)
+
+@defer.inlineCallbacks
+def run_scanner(reactor, tor_control, socks, tor_instances, launch_tor, launch_base_port, tor_data_dir,
+        dbpool, db_name, writer, summaries, health, strategy, geo_codes, repetitions, period, concurrency, prefetch, persistent, sampling, retry,
+        uri=TARGET_URI):
+    """
+    Collect the tor instances of the options and run the measurements with
+    all of them. Launched daemons are stopped at the end.
+
+    Results that were spilled by an earlier run are replayed and the relay
+    health is loaded before, the writer is drained and the latency summaries
+    and relay health are merged into the database after the measurements.
+    """
+    yield writer.replay()
+    yield load_health(health)
+    writer.start(reactor)
+    summaries.start(reactor)
+    health.start(reactor)
+
+    instances, launched = yield collect_instances(reactor, tor_control, socks, tor_instances, launch_tor, launch_base_port, tor_data_dir)
+
+    try:
+        yield connect_tor(reactor, instances, dbpool, db_name, writer, summaries, strategy, list(geo_codes) or [''], repetitions, period, concurrency, prefetch,
+            persistent, sampling, health, retry, uri)
+    finally:
+        yield health.stop()
+        yield summaries.stop()
+        yield writer.stop()
+        print('Wrote {} result rows, spilled {} to {}'.format(writer.written, writer.spilled, writer.spill_path))
+
+        for instance in launched:
+            yield instance.quit()
 
 @click.command()
 @click.option('--tor-control', default=None, type=int, help='tor control port from torrc config')
 @click.option('--socks', default=None, type=int, help='socks procy from torrc config')
+@click.option('--tor-instance', default=None, type=str, multiple=True, help='CONTROL:SOCKS port pair of another tor instance, can be repeated')
+@click.option('--launch-tor', default=0, type=int, help='number of local tor instances to launch')
+@click.option('--launch-base-port', default=9250, type=int, help='first control port of launched tor instances')
+@click.option('--tor-data-dir', default=None, type=str, help='parent directory for data directories of launched tor instances')
 @click.option('--db-name', default=None, type=str, help='Name of DB')
 @click.option('--db-user', default=None, type=str, help='Username DB')
 @click.option('--db-passwd', default=None, type=str, help='Password DB')
 @click.option('--db-port', default=None, type=int, help='DB connection port')
 @click.option('--db-host', default=None, type=str, help='DB connection host')
-@click.option('--strategy', default=None, type=str, help='choose continent_code or country_code')
-@click.option('--geo-code', default=None, type=str, help='choose continent or country according to srategy')
+@click.option('--db-file', default=None, type=str, help='SQLite database file, used instead of the MySQL server')
+@click.option('--strategy', default=None, type=str, help='choose continent_code, country_code, weighted or one of the weighted_ strategies of get_circuits.py')
+@click.option('--geo-code', default=None, type=str, multiple=True, help='choose continent or country according to srategy, can be repeated')
 @click.option('--repetitions', default=10, type=int, help='Number of repetitions per parameter combination')
 @click.option('--period', default=None, type=str, help='enter [da] (6am - 6pm) or [ni] (6pm - 6am)')
-def main(tor_control, socks, db_name, db_user, db_passwd, db_port, db_host, strategy, geo_code, repetitions, period):
+@click.option('--concurrency', default=1, type=int, help='number of circuits built and measured at the same time per tor instance')
+@click.option('--prefetch', default=0, type=int, help='number of circuits built ahead per tor instance')
+@click.option('--persistent', is_flag=True, help='reuse one connection for all requests of a circuit')
+@click.option('--flush-rows', default=500, type=int, help='number of buffered result rows that starts a db write')
+@click.option('--flush-interval', default=5, type=int, help='seconds between db writes of buffered results')
+@click.option('--spill-path', default='results.spill', type=str, help='file for results that could not be written to the db')
+@click.option('--summary-interval', default=60, type=int, help='seconds between merges of the latency summaries into the db')
+@click.option('--precision', default=0.0, type=float, help='stop a geo code once its mean latencies are known to +-precision (e.g. 0.05), 0 to disable')
+@click.option('--min-repetitions', default=5, type=int, help='repetitions per geo code before --precision may stop it')
+@click.option('--min-requests', default=10, type=int, help='requests per circuit before --precision may stop them')
+@click.option('--build-attempts', default=10, type=int, help='circuits a repetition tries before it is counted as failed')
+@click.option('--build-backoff', default=0.25, type=float, help='seconds to wait after the second failed build, doubles with every further failure')
+@click.option('--health-half-life', default=6, type=float, help='hours after which relay failures count half')
+@click.option('--uri', default=TARGET_URI, type=str, help='url of the file the requests download')
+@click.option('--metrics-port', default=None, type=int, help='local port of the metrics endpoint, off by default')
+def main(tor_control, socks, tor_instance, launch_tor, launch_base_port, tor_data_dir, db_name, db_user, db_passwd, db_port, db_host, db_file, strategy, geo_code, repetitions, period, concurrency, prefetch, persistent, flush_rows, flush_interval, spill_path, summary_interval,
+        precision, min_repetitions, min_requests, build_attempts, build_backoff, health_half_life, uri, metrics_port):
     from twisted.internet import reactor
 
-    dbpool = adbapi.ConnectionPool('MySQLdb', host=db_host, db=db_name, user=db_user, passwd=db_passwd, port=db_port)
-
-    d = connect_tor(reactor, tor_control, socks, dbpool, db_name, strategy, geo_code, repetitions, period)
+    dbpool = InstrumentedPool(open_storage(db_name, db_user, db_passwd, db_port, db_host, db_file))
+    db_name = dbpool.db_name
+    if metrics_port is not None:
+        serve_metrics(reactor, metrics_port)
+    writer = ResultWriter(dbpool, db_name, flush_rows, flush_interval, spill_path=spill_path)
+    summaries = LatencySummaries(dbpool, db_name, summary_interval)
+    sampling = Sampling(precision, min_repetitions, min_requests)
+    health = RelayHealth(dbpool, db_name, health_half_life * 3600)
+    retry = RetryBudget(build_attempts, build_backoff)
+
+    d = run_scanner(reactor, tor_control, socks, tor_instance, launch_tor, launch_base_port, tor_data_dir,
+        dbpool, db_name, writer, summaries, health, strategy, geo_code, repetitions, period, concurrency, prefetch, persistent, sampling, retry, uri)
     d.addCallback(lambda ign: reactor.stop())
 
     reactor.run()
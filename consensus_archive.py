@@ -0,0 +1,166 @@
+#!/usr/bin/env/python
+
+from stem.descriptor import parse_file
+
+import datetime
+import shutil
+import urllib
+import gzip
+import io
+import os
+
+CONSENSUS_TYPE = 'network-status-consensus-3 1.0'
+RECENT_URL = 'https://collector.torproject.org/recent/relay-descriptors/consensuses/'
+FILENAME_FORMAT = '%Y-%m-%d-%H-%M-%S-consensus'
+
+class ConsensusArchive():
+    """
+    Local archive of consensus files, keyed by their valid-after time. Files
+    are stored gzip compressed as <directory>/YYYY/MM/<collector filename>.gz.
+    A consensus never changes once it is published, so a file that is already
+    in the archive is never downloaded again.
+
+    Arguments:
+        directory: root directory of the archive, created if missing
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, valid_after):
+        return os.path.join(self.directory,
+            valid_after.strftime('%Y'),
+            valid_after.strftime('%m'),
+            valid_after.strftime(FILENAME_FORMAT) + '.gz')
+
+    def __contains__(self, valid_after):
+        return os.path.exists(self.path(valid_after))
+
+    def fetch(self, valid_after, base_url=RECENT_URL):
+        """
+        Return the archive path of the consensus valid after valid_after and
+        download it from collector only if it is not archived yet. Returns
+        None if the download failed.
+        """
+        path = self.path(valid_after)
+        if os.path.exists(path):
+            return path
+
+        consensus_url = '{}{}'.format(base_url, valid_after.strftime(FILENAME_FORMAT))
+        try:
+            response = urllib.urlopen(consensus_url)
+            if response.getcode() != 200:
+                print('Request failed: ', response.getcode(), ' URL was ', consensus_url)
+                return None
+            self._store(response, path)
+        except Exception as err:
+            print('Request failed: ', err, ' URL was ', consensus_url)
+            return None
+
+        return path
+
+    def add(self, consensus_path):
+        """
+        Copy an uncompressed consensus file into the archive. Returns the
+        archive path, existing entries are kept as they are.
+        """
+        with open(consensus_path, 'rb') as consensus_file:
+            valid_after = read_valid_after(consensus_file)
+            path = self.path(valid_after)
+            if not os.path.exists(path):
+                consensus_file.seek(0)
+                self._store(consensus_file, path)
+
+        return path
+
+    def entries(self, start=None, end=None):
+        """
+        Archive paths of all consensuses, optionally limited to valid-after
+        times in [start, end], in chronological order.
+        """
+        paths = []
+        for root, dirs, files in os.walk(self.directory):
+            for filename in files:
+                if not filename.endswith('-consensus.gz'):
+                    continue
+                valid_after = datetime.datetime.strptime(filename[:-3], FILENAME_FORMAT)
+                if (start is None or valid_after >= start) and (end is None or valid_after <= end):
+                    paths.append((valid_after, os.path.join(root, filename)))
+
+        return [path for valid_after, path in sorted(paths)]
+
+    def _store(self, source, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        partial_path = path + '.part'
+        with gzip.open(partial_path, 'wb') as archive_file:
+            shutil.copyfileobj(source, archive_file)
+        os.rename(partial_path, path)
+
+def load_consensus(consensus_path):
+    """
+    Read a (possibly gzip compressed) consensus file once into memory. The
+    stem parser seeks back one line for every router entry, which is cheap on
+    an in-memory stream but would restart decompression on a gzip file.
+    """
+    opener = gzip.open if consensus_path.endswith('.gz') else open
+    with opener(consensus_path, 'rb') as consensus_file:
+        return io.BytesIO(consensus_file.read())
+
+def read_valid_after(consensus_file):
+    """
+    Read the valid-after time from the header of an open consensus file and
+    rewind it. Falls back to the current time if the header does not contain
+    it.
+    """
+    valid_after = None
+    for line in iter(consensus_file.readline, b''):
+        if line.startswith(b'valid-after '):
+            valid_after = datetime.datetime.strptime(line.split(b' ', 1)[1].strip(), '%Y-%m-%d %H:%M:%S')
+            break
+        if line.startswith(b'r '):
+            break
+    consensus_file.seek(0)
+
+    if valid_after is None:
+        valid_after = datetime.datetime.utcnow().replace(microsecond=0)
+    return valid_after
+
+class ProgressStream():
+    """
+    Wrap a consensus stream and report the bytes consumed by the parser to a
+    click progressbar. Positions the parser seeks back to are only counted
+    once.
+    """
+    def __init__(self, stream, bar):
+        self.stream = stream
+        self.bar = bar
+        self.reported = stream.tell()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def _report(self):
+        position = self.stream.tell()
+        if position > self.reported:
+            self.bar.update(position - self.reported)
+            self.reported = position
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self._report()
+        return data
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self._report()
+        return line
+
+def read_relays(consensus_file):
+    """
+    Yield the running relays of a consensus stream, parsed in a single pass.
+    """
+    for relay in parse_file(consensus_file, CONSENSUS_TYPE):
+        if relay is not None and relay.address is not None and 'Running' in relay.flags:
+            yield relay
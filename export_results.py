@@ -0,0 +1,391 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer
+from twisted.internet.defer import returnValue
+from latency_summary import LatencyHistogram
+from metrics import InstrumentedPool
+from storage import open_storage
+
+import numpy as np
+import shutil
+import click
+import json
+import math
+import time
+import csv
+import os
+
+# key column and exported value columns with their types of every result table
+EXPORT_TABLES = {
+    'circuit_statistics': ('cid', [('build_offset', 'float64')]),
+    'request_statistics': ('cid', [('request_offset', 'float64')]),
+    'request_phases': ('rid', [('circuit', 'int64'), ('request', 'int64'), ('attach_offset', 'float64'),
+        ('ttfb_offset', 'float64'), ('body_offset', 'float64')]),
+    'circuit_failures': ('cid', [('rate', 'float64'), ('repetitions', 'float64')]),
+}
+
+PARTITION_COLUMNS = ('strategy', 'geo_code', 'period')
+
+# latency metrics of the report: (metric, table, column)
+LATENCY_METRICS = [
+    ('build', 'circuit_statistics', 'build_offset'),
+    ('request', 'request_statistics', 'request_offset'),
+    ('attach', 'request_phases', 'attach_offset'),
+    ('ttfb', 'request_phases', 'ttfb_offset'),
+    ('body', 'request_phases', 'body_offset'),
+]
+
+def partition_path(directory, partition):
+    """
+    Directory of one (strategy, geo_code, period) partition, named like hive
+    partitions: strategy=country_code/geo_code=DE/period=da.
+    """
+    return os.path.join(directory, *['{}={}'.format(name, value) for name, value in zip(PARTITION_COLUMNS, partition)])
+
+def typed_column(values, dtype):
+    """
+    Column of a chunk as a typed array. The offsets of circuit_statistics
+    and request_statistics are VARCHAR, they are cast in one vectorized
+    step, values that are not numbers become nan.
+    """
+    try:
+        return np.asarray(values).astype(dtype)
+    except (ValueError, TypeError):
+        column = np.empty(len(values), dtype=dtype)
+        for index, value in enumerate(values):
+            try:
+                column[index] = value
+            except (ValueError, TypeError):
+                column[index] = np.nan
+        return column
+
+def split_partitions(rows, value_columns):
+    """
+    Split a chunk of (key, values..., strategy, geo_code, period) rows by
+    partition. The partition of every row is found with np.unique on the
+    three partition columns, the rows of a partition are taken out with one
+    stable argsort. Yields (partition, [typed value arrays]).
+    """
+    columns = list(zip(*rows))
+    codes = np.zeros(len(rows), dtype=np.int64)
+    labels = []
+    for column in columns[-3:]:
+        values, inverse = np.unique(np.asarray(column, dtype=object).astype(str), return_inverse=True)
+        codes = codes * len(values) + inverse
+        labels.append(values)
+
+    values = [typed_column(columns[index + 1], dtype) for index, (name, dtype) in enumerate(value_columns)]
+
+    order = np.argsort(codes, kind='mergesort')
+    partitions, starts = np.unique(codes[order], return_index=True)
+    ends = list(starts[1:]) + [len(order)]
+    for code, start, end in zip(partitions, starts, ends):
+        partition = []
+        for column_labels in reversed(labels):
+            partition.append(str(column_labels[code % len(column_labels)]))
+            code //= len(column_labels)
+        index = order[start:end]
+        yield tuple(reversed(partition)), [column[index] for column in values]
+
+class NpyPartitionWriter():
+    """
+    Write the exported columns of every partition to .npy files that can be
+    memory-mapped with np.load(path, mmap_mode='r'). The number of rows of
+    every partition is counted before the export, so every file is created
+    in its final size and the chunks are copied into it in place.
+
+    Arguments:
+        directory: output directory of the table
+        value_columns: (name, dtype) of the exported columns
+        counts: dict of partition -> number of rows
+    """
+    def __init__(self, directory, value_columns, counts):
+        self.directory = directory
+        self.value_columns = value_columns
+        self.arrays = {}
+        self.filled = {}
+
+        for partition, count in counts.items():
+            path = partition_path(directory, partition)
+            os.makedirs(path)
+            self.arrays[partition] = [np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=(count,))
+                for name, dtype in value_columns]
+            self.filled[partition] = 0
+
+    def write(self, partition, columns):
+        start = self.filled[partition]
+        end = start + len(columns[0])
+        for array, column in zip(self.arrays[partition], columns):
+            array[start:end] = column
+        self.filled[partition] = end
+
+    def close(self):
+        for partition, arrays in self.arrays.items():
+            filled = self.filled[partition]
+            for (name, dtype), array in zip(self.value_columns, arrays):
+                array.flush()
+                if filled < len(array):
+                    # rows were deleted since they were counted
+                    np.save(os.path.join(partition_path(self.directory, partition), name + '.npy'), np.array(array[:filled]))
+        self.arrays = {}
+
+class ParquetPartitionWriter():
+    """
+    Write the exported columns of every partition to one parquet file per
+    partition, one row group per chunk. Needs pyarrow, it is only imported
+    when parquet is requested.
+    """
+    def __init__(self, directory, value_columns, counts):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.directory = directory
+        self.value_columns = value_columns
+        self.schema = pyarrow.schema([(name, pyarrow.from_numpy_dtype(np.dtype(dtype))) for name, dtype in value_columns])
+        self.writers = {}
+
+        for partition in counts:
+            os.makedirs(partition_path(directory, partition))
+
+    def write(self, partition, columns):
+        if partition not in self.writers:
+            path = os.path.join(partition_path(self.directory, partition), 'part-0.parquet')
+            self.writers[partition] = self.parquet.ParquetWriter(path, self.schema)
+        arrays = [self.pyarrow.array(column) for column in columns]
+        self.writers[partition].write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+WRITERS = {'npy': NpyPartitionWriter, 'parquet': ParquetPartitionWriter}
+
+@defer.inlineCallbacks
+def export_table(dbpool, db_name, table, output_dir, file_format='npy', chunk_size=100000):
+    """
+    Stream one result table into partitioned columnar files. The table is
+    read in chunks of chunk_size rows in key order (keyset pagination on the
+    primary key), only one chunk is in memory at a time. Rows inserted while
+    the export runs are left for the next export. The files are written to
+    <table>.part and renamed into place when the table is complete.
+
+    Returns the number of exported rows.
+    """
+    key, value_columns = EXPORT_TABLES[table]
+    rows = yield dbpool.runQuery('SELECT MAX({}) FROM {}.{};'.format(key, db_name, table))
+    max_key = rows[0][0] if rows else None
+    if max_key is None:
+        print('{} is empty'.format(table))
+        returnValue(0)
+
+    counts = yield dbpool.runQuery('SELECT strategy, geo_code, period, COUNT(*) FROM {}.{} WHERE {} <= %s GROUP BY strategy, geo_code, period;'.format(
+        db_name, table, key), (max_key,))
+    counts = dict(((str(strategy), str(geo_code), str(period)), int(count)) for strategy, geo_code, period, count in counts)
+
+    table_dir = os.path.join(output_dir, table)
+    part_dir = table_dir + '.part'
+    if os.path.exists(part_dir):
+        shutil.rmtree(part_dir)
+    writer = WRITERS[file_format](part_dir, value_columns, counts)
+
+    query = 'SELECT {}, {}, strategy, geo_code, period FROM {}.{} WHERE {} > %s AND {} <= %s ORDER BY {} LIMIT %s;'.format(
+        key, ', '.join(name for name, dtype in value_columns), db_name, table, key, key, key)
+
+    exported = 0
+    last_key = 0
+    start = time.time()
+    with click.progressbar(length=sum(counts.values()), label='Exporting {}'.format(table)) as bar:
+        while True:
+            chunk = yield dbpool.runQuery(query, (last_key, max_key, chunk_size))
+            if not chunk:
+                break
+            last_key = chunk[-1][0]
+
+            for partition, columns in split_partitions(chunk, value_columns):
+                writer.write(partition, columns)
+            exported += len(chunk)
+            bar.update(len(chunk))
+    writer.close()
+
+    with open(os.path.join(part_dir, '_export.json'), 'w') as meta_file:
+        json.dump({'table': table, 'format': file_format, 'rows': exported, 'max_key': max_key,
+            'columns': value_columns, 'partitions': len(counts)}, meta_file)
+
+    if os.path.exists(table_dir):
+        shutil.rmtree(table_dir)
+    os.rename(part_dir, table_dir)
+
+    print('Exported {} rows of {} in {} partitions ({:.0f} rows/s)'.format(exported, table, len(counts), exported / max(time.time() - start, 1e-6)))
+    returnValue(exported)
+
+@defer.inlineCallbacks
+def export_results(dbpool, db_name, tables, output_dir, file_format='npy', chunk_size=100000):
+    for table in tables:
+        try:
+            yield export_table(dbpool, db_name, table, output_dir, file_format, chunk_size)
+        except Exception as err:
+            print('Could not export {}: '.format(table), err)
+
+def read_partitions(output_dir, table):
+    """
+    Partitions of an exported table as a dict of partition -> directory.
+    """
+    table_dir = os.path.join(output_dir, table)
+    partitions = {}
+    for root, dirs, files in os.walk(table_dir):
+        relative = os.path.relpath(root, table_dir).split(os.sep)
+        if len(relative) == len(PARTITION_COLUMNS) and all(part.startswith(name + '=') for name, part in zip(PARTITION_COLUMNS, relative)):
+            partitions[tuple(part.split('=', 1)[1] for part in relative)] = root
+    return partitions
+
+def column_chunks(directory, column, chunk_size=1000000):
+    """
+    Yield one column of a partition in chunks of chunk_size values, from the
+    memory-mapped .npy file or the row groups of the parquet file.
+    """
+    path = os.path.join(directory, column + '.npy')
+    if os.path.exists(path):
+        values = np.load(path, mmap_mode='r')
+        for start in xrange(0, len(values), chunk_size):
+            yield np.asarray(values[start:start + chunk_size])
+        return
+
+    import pyarrow.parquet
+    parquet_file = pyarrow.parquet.ParquetFile(os.path.join(directory, 'part-0.parquet'))
+    for index in xrange(parquet_file.num_row_groups):
+        yield np.asarray(parquet_file.read_row_group(index, columns=[column]).column(0))
+
+def column_summary(chunks, precision=0.01):
+    """
+    Count, mean, standard deviation and percentiles of a column, computed
+    chunk by chunk with constant memory: the values of every chunk are
+    counted in the logarithmic buckets of a LatencyHistogram with one
+    vectorized np.unique, so percentiles are exact up to precision.
+    """
+    histogram = LatencyHistogram(precision)
+    squares = 0.0
+    for values in chunks:
+        values = values[~np.isnan(values)]
+        if not len(values):
+            continue
+
+        positive = values[values > 0]
+        buckets, counts = np.unique(np.floor(np.log(positive) / histogram.log_base).astype(np.int64), return_counts=True)
+        for bucket, count in zip(buckets.tolist(), counts.tolist()):
+            histogram.buckets[bucket] = histogram.buckets.get(bucket, 0) + count
+
+        histogram.zeros += len(values) - len(positive)
+        histogram.count += len(values)
+        histogram.total += float(values.sum())
+        squares += float(np.square(values).sum())
+        for value in (float(values.min()), float(values.max())):
+            histogram.min = value if histogram.min is None else min(histogram.min, value)
+            histogram.max = value if histogram.max is None else max(histogram.max, value)
+
+    if histogram.count == 0:
+        return None
+
+    mean = histogram.mean()
+    return {
+        'count': histogram.count,
+        'mean': mean,
+        'std': math.sqrt(max(squares / histogram.count - mean * mean, 0.0)),
+        'min': histogram.min,
+        'p50': histogram.percentile(50),
+        'p95': histogram.percentile(95),
+        'p99': histogram.percentile(99),
+        'max': histogram.max,
+    }
+
+def failure_rates(output_dir):
+    """
+    Failure rate of every partition from circuit_failures: the rate column
+    holds the failed repetitions of one measurement, so the rate of a
+    partition is the sum of its failures over the sum of its repetitions.
+    """
+    rates = {}
+    for partition, directory in read_partitions(output_dir, 'circuit_failures').items():
+        failures = sum(float(chunk.sum()) for chunk in column_chunks(directory, 'rate'))
+        repetitions = sum(float(chunk.sum()) for chunk in column_chunks(directory, 'repetitions'))
+        rates[partition] = (failures / repetitions if repetitions else None, repetitions)
+    return rates
+
+def report(output_dir, precision=0.01):
+    """
+    Statistics of every latency metric per strategy, geo code and period from
+    the exported files, together with the failure rate of the partition.
+    Returns a list of dicts sorted by partition and metric.
+    """
+    rates = failure_rates(output_dir)
+
+    rows = []
+    for metric, table, column in LATENCY_METRICS:
+        for partition, directory in sorted(read_partitions(output_dir, table).items()):
+            summary = column_summary(column_chunks(directory, column), precision)
+            if summary is None:
+                continue
+
+            row = dict(zip(PARTITION_COLUMNS, partition))
+            row['metric'] = metric
+            row.update(summary)
+            row['failure_rate'], row['repetitions'] = rates.get(partition, (None, None))
+            rows.append(row)
+
+    rows.sort(key=lambda row: (row['strategy'], row['geo_code'], row['period'], row['metric']))
+    return rows
+
+REPORT_COLUMNS = ['strategy', 'geo_code', 'period', 'metric', 'count', 'mean', 'std', 'min', 'p50', 'p95', 'p99', 'max', 'failure_rate', 'repetitions']
+
+def print_report(rows):
+    def cell(value):
+        if isinstance(value, float):
+            return '{:.2f}'.format(value)
+        return '' if value is None else str(value)
+
+    lines = [REPORT_COLUMNS] + [[cell(row[column]) for column in REPORT_COLUMNS] for row in rows]
+    widths = [max(len(line[index]) for line in lines) for index in xrange(len(REPORT_COLUMNS))]
+    for line in lines:
+        print('  '.join(value.rjust(width) for value, width in zip(line, widths)))
+
+def write_report(rows, path):
+    with open(path, 'wb') as report_file:
+        report_csv = csv.DictWriter(report_file, REPORT_COLUMNS)
+        report_csv.writeheader()
+        report_csv.writerows(rows)
+
+@click.command()
+@click.option('--db-name', default=None, type=str, help='Name of DB')
+@click.option('--db-user', default=None, type=str, help='Username DB')
+@click.option('--db-passwd', default=None, type=str, help='Password DB')
+@click.option('--db-port', default=None, type=int, help='DB connection port')
+@click.option('--db-host', default=None, type=str, help='DB connection host')
+@click.option('--db-file', default=None, type=str, help='SQLite database file, used instead of the MySQL server')
+@click.option('--output-dir', default='results', type=str, help='directory of the exported files')
+@click.option('--table', default=None, type=click.Choice(sorted(EXPORT_TABLES)), multiple=True, help='tables to export, all by default')
+@click.option('--format', 'file_format', default='npy', type=click.Choice(sorted(WRITERS)), help='npy files or parquet (needs pyarrow)')
+@click.option('--chunk-size', default=100000, type=int, help='rows read from the db per query')
+@click.option('--export/--no-export', default=True, help='export the tables, --no-export only reports on an earlier export')
+@click.option('--report-path', default=None, type=str, help='csv file for the report')
+@click.option('--precision', default=0.01, type=float, help='relative precision of the percentiles')
+def main(db_name, db_user, db_passwd, db_port, db_host, db_file, output_dir, table, file_format, chunk_size, export, report_path, precision):
+    if export:
+        from twisted.internet import reactor
+
+        dbpool = InstrumentedPool(open_storage(db_name, db_user, db_passwd, db_port, db_host, db_file))
+        db_name = dbpool.db_name
+
+        d = export_results(dbpool, db_name, list(table) or sorted(EXPORT_TABLES), output_dir, file_format, chunk_size)
+        d.addCallback(lambda ign: reactor.stop())
+
+        reactor.run()
+
+    rows = report(output_dir, precision)
+    print_report(rows)
+    if report_path is not None:
+        write_report(rows, report_path)
+
+if __name__ == '__main__':
+    main()
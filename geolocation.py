@@ -0,0 +1,246 @@
+#!/usr/bin/env/python
+
+from collections import OrderedDict
+from array import array
+
+import bisect
+import socket
+import struct
+import urllib
+import json
+import csv
+import os
+
+def ip_to_int(address):
+    """
+    Convert a dotted IPv4 address (or an already numeric string) to an
+    unsigned integer that can be compared against the range boundaries.
+    """
+    if address.isdigit():
+        return int(address)
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+def network_to_range(network):
+    """
+    Convert a CIDR network like 1.2.3.0/24 to its first and last address as
+    integers.
+    """
+    address, prefix = network.split('/')
+    start = ip_to_int(address)
+    size = 1 << (32 - int(prefix))
+    return start, start + size - 1
+
+class LRUCache():
+    """
+    Small least recently used cache keyed by IP address. Relays of one
+    consensus share a lot of addresses with the previous one and families
+    often sit in the same ranges, so repeated lookups are answered from here.
+    """
+    def __init__(self, size=8192):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.entries.pop(key)
+        elif len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+class RangeDatabase():
+    """
+    IP range database held in compact sorted arrays. The start and end of
+    every range are stored as unsigned ints, the location of a range is an
+    index into the list of distinct (continent_code, country_code) pairs. A
+    lookup is a single binary search over the range starts.
+
+    Supported input formats:
+        range: plain text file, one range per line:
+            <first ip> <last ip> <continent code> <country code>
+            fields may be separated by whitespace or commas, ips may be dotted
+            or integers, lines starting with # are ignored
+        maxmind-csv: GeoLite2/GeoIP2 country blocks file (GeoLite2-Country-
+            Blocks-IPv4.csv), the matching locations file (Locations-en) is
+            expected in the same directory
+    """
+    def __init__(self, ranges):
+        ranges = sorted(ranges)
+
+        self.starts = array('I')
+        self.ends = array('I')
+        self.codes = array('H')
+        self.locations = []
+
+        location_index = {}
+        for start, end, location in ranges:
+            if location not in location_index:
+                location_index[location] = len(self.locations)
+                self.locations.append(location)
+
+            self.starts.append(start)
+            self.ends.append(end)
+            self.codes.append(location_index[location])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, address):
+        try:
+            ip = ip_to_int(address)
+        except (socket.error, ValueError):
+            return None
+
+        index = bisect.bisect_right(self.starts, ip) - 1
+        if index >= 0 and ip <= self.ends[index]:
+            return self.locations[self.codes[index]]
+        return None
+
+    @classmethod
+    def from_range_file(cls, path):
+        ranges = []
+        with open(path, 'rb') as range_file:
+            for line in range_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                fields = line.replace(',', ' ').split()
+                try:
+                    start, end = ip_to_int(fields[0]), ip_to_int(fields[1])
+                    ranges.append((start, end, (fields[2].upper(), fields[3].upper())))
+                except (IndexError, socket.error, ValueError):
+                    print('Skipping malformed range: ', line)
+
+        return cls(ranges)
+
+    @classmethod
+    def from_maxmind_csv(cls, path):
+        directory, filename = os.path.split(path)
+        locations_path = os.path.join(directory, filename.replace('Blocks-IPv4', 'Locations-en'))
+
+        geonames = {}
+        with open(locations_path, 'rb') as locations_file:
+            for row in csv.DictReader(locations_file):
+                geonames[row['geoname_id']] = (row['continent_code'], row['country_iso_code'])
+
+        ranges = []
+        with open(path, 'rb') as blocks_file:
+            for row in csv.DictReader(blocks_file):
+                geoname_id = row['geoname_id'] or row['registered_country_geoname_id']
+                location = geonames.get(geoname_id)
+                if location is None or not location[1]:
+                    continue
+
+                start, end = network_to_range(row['network'])
+                ranges.append((start, end, location))
+
+        return cls(ranges)
+
+class MMDBDatabase():
+    """
+    Lookups in a MaxMind .mmdb file. The file format already is a search tree,
+    so we only wrap the reader of the maxminddb module (optional dependency).
+    """
+    def __init__(self, path):
+        import maxminddb
+        self.reader = maxminddb.open_database(path)
+
+    def lookup(self, address):
+        try:
+            record = self.reader.get(address)
+        except ValueError:
+            return None
+
+        try:
+            return (record['continent']['code'], record['country']['iso_code'])
+        except (KeyError, TypeError):
+            return None
+
+def load_database(path, db_format=None):
+    """
+    Load a local geolocation database. Without an explicit format we guess it
+    from the file: .mmdb files use the maxminddb reader, csv files with a
+    network column are read as MaxMind blocks and everything else is treated
+    as a plain range file.
+    """
+    if db_format is None:
+        if path.endswith('.mmdb'):
+            db_format = 'mmdb'
+        elif path.endswith('.csv'):
+            with open(path, 'rb') as db_file:
+                header = db_file.readline()
+            db_format = 'maxmind-csv' if header.startswith('network') else 'range'
+        else:
+            db_format = 'range'
+
+    if db_format == 'mmdb':
+        return MMDBDatabase(path)
+    elif db_format == 'maxmind-csv':
+        return RangeDatabase.from_maxmind_csv(path)
+    return RangeDatabase.from_range_file(path)
+
+class Geolocator():
+    """
+    Resolve relay addresses to (continent_code, country_code). Lookups go to
+    the cache first and to the local database second, both without any
+    network access. The location service is only a fallback for addresses
+    the database does not know and has to be called via fetch(), which blocks
+    and should therefore be deferred to a thread.
+
+    Arguments:
+        database: RangeDatabase or MMDBDatabase, may be None
+        service_url: location_service_url of a json service, the address is
+            appended to it; empty to disable the fallback
+        cache_size: number of addresses kept in the LRU cache
+    """
+    def __init__(self, database=None, service_url='', cache_size=8192):
+        self.database = database
+        self.service_url = service_url
+        self.cache = LRUCache(cache_size)
+
+    def lookup(self, address):
+        try:
+            return self.cache.get(address)
+        except KeyError:
+            pass
+
+        location = None
+        if self.database is not None:
+            location = self.database.lookup(address)
+
+        if location is not None or not self.service_url:
+            self.cache.put(address, location)
+        return location
+
+    def fetch(self, address):
+        location = None
+        try:
+            response = urllib.urlopen(self.service_url + address)
+            data = json.loads(response.read())
+            location = (data['continent_code'], data['country_code'])
+        except Exception as err:
+            print('Location service failed for ', address, err)
+
+        self.cache.put(address, location)
+        return location
@@ -1,12 +1,100 @@
 #!/usr/bin/env/python
 
-from twisted.enterprise import adbapi
 from twisted.internet import defer
+from relay_health import read_relay_weights, weighted_order
+from geolocation import ip_to_int
+from metrics import REGISTRY, PROFILER, InstrumentedPool, serve_metrics
+from array import array
+from storage import open_storage
 
 import click
-import random
 
-def form_circuits(guard_tuples, relay_tuples, exit_tuples):
+STRATEGIES = ['continent_code', 'country_code']
+
+SELECTIONS = {
+    'continent_code': ['EU', 'NA', 'OC', 'SA', 'AS'],
+    'country_code': ['DE', 'US', 'FR', 'NL', 'RU', 'GB', 'CA', 'CH', 'UA', 'SE'],
+}
+
+# bandwidth weighted circuits, of the whole network and per selection
+WEIGHTED_NETWORK = 'weighted_network'
+WEIGHTED_PREFIX = 'weighted_'
+
+CIRCUITS_FORMED = REGISTRY.counter('circuits_formed_total', 'Circuits formed for the circuits table', ('strategy',))
+
+class RelayTable():
+    """
+    All fingerprints of the table, loaded with a single query and held column
+    wise: the integer ids (fid) in an int array, fingerprints in a list, the
+    above average bandwidth flags in a byte array, bandwidths, Guard flags
+    and /16 networks for the weighted sampler in arrays as well. Relays are
+    partitioned by strategy, geo code and flag in one pass, every partition is
+    an array of row indexes. Selecting the guards, relays or exits of a continent or
+    country is a lookup instead of a query.
+
+    Arguments:
+        rows: (fid, fp, above_avg_bw, flag, continent_code, country_code,
+            bandwidth, address, guard) tuples
+    """
+    def __init__(self, rows):
+        self.fids = array('I')
+        self.fps = []
+        self.bandwidth_flags = array('B')
+        self.bandwidths = array('d')
+        self.prefixes = array('I')
+        self.guards = array('B')
+        self.flags = []
+        self.partitions = {}
+
+        for index, (fid, fp, above_avg_bw, flag, continent_code, country_code, bandwidth, address, guard) in enumerate(rows):
+            self.fids.append(fid)
+            self.fps.append(fp)
+            self.bandwidth_flags.append(int(above_avg_bw))
+            self.bandwidths.append(bandwidth)
+            self.prefixes.append(ip_to_int(address) >> 16)
+            self.guards.append(int(guard))
+            self.flags.append(flag)
+
+            for key in (('continent_code', continent_code, flag), ('country_code', country_code, flag)):
+                try:
+                    self.partitions[key].append(index)
+                except KeyError:
+                    self.partitions[key] = array('I', [index])
+
+    def __len__(self):
+        return len(self.fps)
+
+    def select(self, strategy, geo_code, flag):
+        """
+        (fid, above_avg_bw) tuples of one partition, the same rows the former
+        per selection queries returned, with the fid instead of the fp.
+        """
+        return [(self.fids[index], self.bandwidth_flags[index]) for index in self.partitions.get((strategy, geo_code, flag), ())]
+
+    def indexes(self, strategy, geo_code):
+        """
+        Row indexes of all guards, relays and exits of one geo code.
+        """
+        indexes = array('I')
+        for flag in ('guard', 'relay', 'exit'):
+            indexes.extend(self.partitions.get((strategy, geo_code, flag), ()))
+        return indexes
+
+    def fid_weights(self, weights):
+        """
+        Map relay weights keyed by fp to the fids of the relays.
+        """
+        return dict((fid, weights[fp]) for fid, fp in zip(self.fids, self.fps) if fp in weights)
+
+    def geo_codes(self, strategy):
+        return sorted(set(key[1] for key in self.partitions if key[0] == strategy))
+
+@defer.inlineCallbacks
+def read_relay_table(dbpool, db_name):
+    rows = yield dbpool.runQuery('SELECT fid, fp, above_avg_bw, flag, continent_code, country_code, bandwidth, address, guard FROM {}.fingerprints;'.format(db_name))
+    defer.returnValue(RelayTable(rows))
+
+def form_circuits(guard_tuples, relay_tuples, exit_tuples, weights=None):
     """
     Receive the lists of guards, middle relays, and exits from the fingerprints
     table and form random circuits from them. Full circuits are written to the
@@ -19,7 +107,8 @@ def form_circuits(guard_tuples, relay_tuples, exit_tuples):
 
     Building circuits works as follows:
         - create a randomly shuffeled list from the set of fingerprints to avoid
-        repetitions
+        repetitions, relays that failed in earlier scans are moved towards the
+        end of the list (by their weight) or left out if they are unreliable
         - we want to keep the exit node fixed as long as possible
         - we want variation in the middle relays and the entry guards
             - when using a new circuit for a measurement we want to make sure this
@@ -28,28 +117,20 @@ def form_circuits(guard_tuples, relay_tuples, exit_tuples):
             repetitions in one strategy and parameter set
 
     Arguments:
-        guard_tuples: set of guard fingerprints from the database
-        relay_tuples: set of middle relay fingerprints
-        exit_tuples: set of exit relay fingerprints
+        guard_tuples: set of (fid, above_avg_bw) guards from the relay table
+        relay_tuples: set of middle relays
+        exit_tuples: set of exit relays
+        weights: dict of fid -> weight from the relay_health table, relays
+            without a weight count as 1
     """
-    guards = []
-    relays = []
-    exits = []
+    guards = [elem[0] for elem in guard_tuples if elem[1] == 1]
+    relays = [elem[0] for elem in relay_tuples if elem[1] == 1]
+    exits = [elem[0] for elem in exit_tuples if elem[1] == 1]
 
-    for elem in guard_tuples:
-        guards.append([elem[0], elem[1]])
-    for elem in relay_tuples:
-        relays.append([elem[0], elem[1]])
-    for elem in exit_tuples:
-        exits.append([elem[0], elem[1]])
-
-    guards = filter(lambda x:x[1] == 1, guards)
-    relays = filter(lambda x:x[1] == 1, relays)
-    exits = filter(lambda x:x[1] == 1, exits)
-
-    random.shuffle(guards)
-    random.shuffle(relays)
-    random.shuffle(exits)
+    weights = weights or {}
+    guards = weighted_order(guards, weights)
+    relays = weighted_order(relays, weights)
+    exits = weighted_order(exits, weights)
 
     circuits = []
 
@@ -67,10 +148,10 @@ def form_circuits(guard_tuples, relay_tuples, exit_tuples):
         relay_index = 0
 
         while guard_index < var_limit:
-            guard_fp = guards[guard_index][0]
-            relay_fp = relays[relay_index][0]
+            guard_fid = guards[guard_index]
+            relay_fid = relays[relay_index]
 
-            circuit = [guard_fp, relay_fp, exit_node[0]]
+            circuit = [guard_fid, relay_fid, exit_node]
             circuits.append(circuit)
 
             guard_index = guard_index + 1
@@ -83,11 +164,61 @@ def form_circuits(guard_tuples, relay_tuples, exit_tuples):
 
     return circuits
 
+def generate_circuits(table, selections, weights=None):
+    """
+    Form the circuits of all strategies and geo codes from the in-memory relay
+    table. Yields (strategy, geo_code, circuits).
+
+    Arguments:
+        table: RelayTable of the current fingerprints
+        selections: dict of strategy -> list of geo codes
+        weights: relay weights for form_circuits
+    """
+    for strategy in STRATEGIES:
+        for selection in selections.get(strategy, []):
+            guards = table.select(strategy, selection, 'guard')
+            relays = table.select(strategy, selection, 'relay')
+            exits = table.select(strategy, selection, 'exit')
+
+            try:
+                circuits = form_circuits(guards, relays, exits, weights)
+            except Exception as err:
+                print('Could not retrieve circuits because ', err)
+                continue
+
+            yield strategy, selection, circuits
+
+def generate_weighted_circuits(table, selections, count, bandwidth_weights=None, seed=None):
+    """
+    Sample count bandwidth weighted circuits of the whole network (strategy
+    weighted_network, geo code '') and of every selection (strategy
+    weighted_<strategy>). Yields (strategy, geo_code, circuits) like
+    generate_circuits, circuits are arrays of fid triples. With a seed the
+    same fingerprints give the same circuits.
+
+    Needs numpy, it is only imported when weighted circuits are requested.
+    """
+    import numpy as np
+    from weighted_sampler import partition_samplers
+
+    rng = np.random.RandomState(seed)
+
+    samplers = partition_samplers(table, None, None, bandwidth_weights)
+    for geo_code, sampler in samplers.items():
+        yield WEIGHTED_NETWORK, geo_code, sampler.sample(count, rng)
+
+    for strategy in STRATEGIES:
+        samplers = partition_samplers(table, strategy, selections.get(strategy, []), bandwidth_weights)
+        for geo_code in selections.get(strategy, []):
+            if geo_code in samplers:
+                yield WEIGHTED_PREFIX + strategy, geo_code, samplers[geo_code].sample(count, rng)
+
 @defer.inlineCallbacks
-def write_circuits(dbpool, db_name):
+def write_circuits(dbpool, db_name, all_geo_codes=False, weighted=0, consensus_path=None, seed=None):
     """
     Use fingerprints from database and form circuits according to all strategies
-    that are documented here.
+    that are documented here. The fingerprints table is read once, all
+    selections are formed from the in-memory RelayTable.
 
     Strategies:
         continent_code:
@@ -98,67 +229,83 @@ def write_circuits(dbpool, db_name):
         Restrict the selection of relays to a specific country. We use the top
         ten countries that offer relay nodes in the Tor network (with respect to
         the total number of relays).
-    """
-    strategies = ['continent_code', 'country_code']
-
-    for strategy in strategies:
-        print('Processing Strategy', strategy)
-
-        random_flag = 0
-        if strategy == 'continent_code':
-            selections = ['"EU"', '"NA"', '"OC"', '"SA"', '"AS"']
-        elif strategy == 'country_code':
-            selections = ['"DE"', '"US"', '"FR"', '"NL"', '"RU"', '"GB"', '"CA"', '"CH"', '"UA"', '"SE"']
-        else:
-            selections = ['']
-            random_flag = 1
-
-        for selection in selections:
-            if random_flag == 1:
-                selection_query = 'WHERE'
-            else:
-                selection_query = 'WHERE {} = {} AND'.format(strategy, selection)
-
-            try:
-                guards = yield dbpool.runQuery('SELECT fp, above_avg_bw FROM {}.fingerprints {} flag = "guard";'.format(
-                    db_name, selection_query))
-            except Exception as err:
-                print('Problem retrieving guards')
-
-            try:
-                relays = yield dbpool.runQuery('SELECT fp, above_avg_bw FROM {}.fingerprints {} flag = "relay"'.format(
-                    db_name, selection_query))
-            except Exception as err:
-                print('Problem retrieving relays')
 
-            try:
-                exits = yield dbpool.runQuery('SELECT fp, above_avg_bw FROM {}.fingerprints {} flag = "exit"'.format(
-                    db_name, selection_query))
-            except Exception as err:
-                print('Problem retrieving exits')
+    With all_geo_codes every continent and country found in the fingerprints is
+    used instead of the fixed SELECTIONS. With weighted > 0 as many bandwidth
+    weighted circuits are added for the network and every selection, using the
+    bandwidth-weights of the consensus at consensus_path if given. Relays are weighted by their
+    failures in earlier scans (relay_health table), unreliable relays are not
+    used at all.
+    """
+    try:
+        table = yield read_relay_table(dbpool, db_name)
+    except Exception as err:
+        print('Problem retrieving fingerprints', err)
+        return
+
+    weights = yield read_relay_weights(dbpool, db_name, table.fps)
+    weights = table.fid_weights(weights)
+    skipped = sum(1 for weight in weights.values() if weight == 0)
+    if skipped:
+        print('Skipping {} unreliable relays'.format(skipped))
+
+    selections = SELECTIONS
+    if all_geo_codes:
+        selections = dict((strategy, table.geo_codes(strategy)) for strategy in STRATEGIES)
+
+    rows = []
+    for strategy, selection, circuits in PROFILER.iterate('form_circuits', generate_circuits(table, selections, weights)):
+        print('Processing', strategy, selection, len(circuits))
+        CIRCUITS_FORMED.inc(len(circuits), strategy=strategy)
+
+        for circuit in circuits:
+            rows.append((circuit[0], circuit[1], circuit[2], strategy, selection))
+
+    if weighted > 0:
+        bandwidth_weights = None
+        if consensus_path is not None:
+            from weighted_sampler import read_bandwidth_weights
+            bandwidth_weights = read_bandwidth_weights(consensus_path)
+
+        weighted_circuits = generate_weighted_circuits(table, selections, weighted, bandwidth_weights, seed)
+        for strategy, selection, circuits in PROFILER.iterate('weighted_circuits', weighted_circuits):
+            print('Processing', strategy, selection, len(circuits))
+            CIRCUITS_FORMED.inc(len(circuits), strategy=strategy)
+            rows.extend((int(guard), int(middle), int(exit_fid), strategy, selection) for guard, middle, exit_fid in circuits)
+
+    try:
+        yield dbpool.runInteraction(load_circuits, dbpool, rows)
+    except Exception as err:
+        print('Error in writing circuits ', err)
+
+def load_circuits(txn, storage, rows, batch_size=5000):
+    """
+    Replace the circuits table with a new set of circuits. The circuits are
+    written to circuits_staging with batched multi-row inserts, afterwards the
+    staging table replaces circuits in one atomic step (RENAME TABLE on
+    MySQL, a single write transaction on SQLite). Readers in connect_tor.py
+    see either the old or the new complete set of circuits but never a half
+    written table.
 
-            try:
-                circuits = form_circuits(guards, relays, exits)
-            except Exception as err:
-                print('Could not retrieve circuits because ', err)
+    Relays are stored as the fid of their fingerprints row. circuits has a
+    covering index on (strategy, geo_code) of the relays, the lookups of
+    connect_tor.py are index-only.
 
-            columns = 'entry_relay, middle_relay, exit_relay, strategy, geo_code'
-            quote = '"'
-            strategy_format = '{}{}{}'.format(quote, strategy, quote)
+    Arguments:
+        txn: cursor of the runInteraction
+        storage: Storage of the database
+        rows: (entry_fid, middle_fid, exit_fid, strategy, geo_code) tuples
+        batch_size: number of rows per insert statement
+    """
+    storage.copy_table(txn, 'circuits', 'circuits_staging')
 
-            for circuit in circuits:
-                guard_fp = '"{}"'.format(circuit[0])
-                relay_fp = '"{}"'.format(circuit[1])
-                exit_fp = '"{}"'.format(circuit[2])
+    insert = 'INSERT INTO {}.circuits_staging (entry_relay, middle_relay, exit_relay, strategy, geo_code) VALUES (%s, %s, %s, %s, %s);'.format(storage.db_name)
+    for index in xrange(0, len(rows), batch_size):
+        txn.executemany(insert, rows[index:index + batch_size])
 
-                try:
-                    yield dbpool.runQuery('INSERT INTO {}.circuits ({}) VALUES ({},{},{},{},{});'.format(
-                        db_name,
-                        columns,
-                        guard_fp,relay_fp,exit_fp, strategy_format, selection))
+    storage.replace_table(txn, 'circuits', 'circuits_staging')
 
-                except Exception as err:
-                    print('Error in writing circuits ', err)
+    print('Wrote {} circuits'.format(len(rows)))
 
 @click.command()
 @click.option('--db-name', default=None, type=str, help='Name of DB')
@@ -166,12 +313,21 @@ def write_circuits(dbpool, db_name):
 @click.option('--db-passwd', default=None, type=str, help='Password DB')
 @click.option('--db-port', default=None, type=int, help='DB connection port')
 @click.option('--db-host', default=None, type=str, help='DB connection host')
-def main(db_name, db_user, db_passwd, db_port, db_host):
+@click.option('--db-file', default=None, type=str, help='SQLite database file, used instead of the MySQL server')
+@click.option('--all-geo-codes', is_flag=True, help='form circuits for every continent and country in the fingerprints')
+@click.option('--weighted', default=0, type=int, help='number of bandwidth weighted circuits per selection, needs numpy')
+@click.option('--consensus-path', default=None, type=str, help='consensus with the bandwidth-weights for --weighted')
+@click.option('--seed', default=None, type=int, help='random seed for reproducible --weighted circuits')
+@click.option('--metrics-port', default=None, type=int, help='local port of the metrics endpoint, off by default')
+def main(db_name, db_user, db_passwd, db_port, db_host, db_file, all_geo_codes, weighted, consensus_path, seed, metrics_port):
     from twisted.internet import reactor
 
-    dbpool = adbapi.ConnectionPool('MySQLdb', host=db_host, db=db_name, user=db_user, passwd=db_passwd, port=db_port)
+    dbpool = InstrumentedPool(open_storage(db_name, db_user, db_passwd, db_port, db_host, db_file))
+    db_name = dbpool.db_name
+    if metrics_port is not None:
+        serve_metrics(reactor, metrics_port)
 
-    d = write_circuits(dbpool, db_name)
+    d = write_circuits(dbpool, db_name, all_geo_codes, weighted, consensus_path, seed)
     d.addCallback(lambda ign: reactor.stop())
 
     reactor.run()
@@ -1,28 +1,45 @@
 #!/usr/bin/env/python
 
-from stem.descriptor import parse_file, DocumentHandler
+from stem.descriptor import DocumentHandler
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.enterprise import adbapi
-from twisted.internet import defer
+from twisted.internet import defer, task, threads
+from geolocation import Geolocator, load_database
+from metrics import REGISTRY, PROFILER, InstrumentedPool, serve_metrics
+from consensus_archive import (ConsensusArchive, ProgressStream, load_consensus,
+    read_relays, read_valid_after, RECENT_URL, FILENAME_FORMAT)
+from storage import open_storage
 
 import txtorcon
 import click
 import urllib
-import json
 import datetime
 import time
+import os
+
+# relays parsed between two turns of the reactor, so the metrics endpoint
+# keeps answering during a load
+YIELD_INTERVAL = 1000
+
+INGEST_RELAYS = REGISTRY.counter('ingest_relays_total', 'Relays of the consensus parsed and compared or located')
+INGEST_RATE = REGISTRY.gauge('ingest_relays_per_second', 'Relays parsed and compared or located per second in the current load')
+GEO_CACHE_HIT_RATIO = REGISTRY.gauge('geolocation_cache_hit_ratio', 'Share of address lookups answered by the geolocation cache')
 
 @defer.inlineCallbacks
-def write_fingerprints(reactor, dbpool, db_name, consensus_path):
+def write_fingerprints(reactor, dbpool, db_name, consensus_path, locator, incremental=False, archive=None):
     """
     Downloads the day's first relay-descriptor consensus file from collector and
     parses the contents to the fingerprints table of the database. We save
-    the fingerprint, guard/relay/exit flag, continent code, country code, and
-    reported bandwidth of each router in the consensus file.
+    the fingerprint, guard/relay/exit flag, Guard flag, continent code, country
+    code, and reported bandwidth of each router in the consensus file.
 
     You want to run get_consensus before building circuits to make sure an actual
     collection of rotersis available.
 
+    The consensus is read once and parsed as a stream, relays are passed on
+    through generators and progress is reported in bytes. Every
+    YIELD_INTERVAL relays the reactor gets a turn, so metrics can be scraped
+    during the load.
+
     Arguments:
         reactor: reactor object for @inlineCallbacks, import in main
         dbpool: object to perform database queries, created in main with
@@ -30,128 +47,311 @@ def write_fingerprints(reactor, dbpool, db_name, consensus_path):
         db_name: global name of the database, required to perform queries
         consensus_path: relative path to directory of conensus files, includes
                 the filename of the consensus created in get_consensus_file()
+        locator: Geolocator that resolves relay addresses to continent and
+                country, see geolocation.py
+        incremental: compare the consensus with the fingerprints already in
+                the table and only locate and write relays that were added,
+                removed or changed their address, flags or above average
+                bandwidth flag
+        archive: ConsensusArchive to take the consensus from, consensus_path
+                is not used if it is given
 
     Note:
-        The location_service_url delivers a json object of the location information
-        for an IP address. We blinded it for submission, this should be exchanged to
-        any comparable service. Please note that a change might require some changes
-        in the expected data structure
-    """
-    
-    location_service_url = '' #BLINDED FOR SUBMISSION
-    avg_bandwidths = yield truncate_table(dbpool, db_name)
-    get_consensus_file(consensus_path)
-
-    num_lines = sum(1 for line in open(consensus_path))
-    with open(consensus_path, 'rb') as consensus_file:
-        with click.progressbar(parse_file(consensus_file), length=num_lines) as bar:
-            for relay in bar:
-                if relay is not None and relay.address is not None and 'Running' in relay.flags:
-
-                    json_url = location_service_url + relay.address
-                    request_start_time = int(round(time.time() * 1000))
-                    response = urllib.urlopen(json_url)
-
-                    try:
-                        data = json.loads(response.read())
-                    except Exception as err:
-                        pass
-
-                    try:
-                        continent_code = '"{}"'.format(data['continent_code'])
-                        country_code = '"{}"'.format(data['country_code'])
-                        fingerprint = '"{}"'.format(relay.fingerprint)
-                        bandwidth = '"{}"'.format(relay.bandwidth)
-                    except Exception as err:
-                        print err
-
-                    columns = '(fp,continent_code,country_code,bandwidth,above_avg_bw,flag)'
-
-                    bw_flag = 0
-                    if 'Exit' in relay.flags:
-                        flag = '"exit"'
-                        if relay.bandwidth >= avg_bandwidths[2]:
-                            bw_flag = 1
-                    elif 'Guard' in relay.flags:
-                        flag = '"guard"'
-                        if relay.bandwidth >= avg_bandwidths[0]:
-                            bw_flag = 1
-                    else:
-                        flag='"relay"'
-                        if relay.bandwidth >= avg_bandwidths[1]:
-                            bw_flag = 1
-
-                    avg_bw_flag = '"{}"'.format(bw_flag)
-
-                    try:
-                        yield dbpool.runQuery('INSERT INTO {}.fingerprints {} VALUES ({},{},{},{},{},{});'.format(
-                            db_name,
-                            columns,
-                            fingerprint,continent_code,country_code, bandwidth, avg_bw_flag, flag))
-
-                    except Exception as err:
-                        print('Problem writing to db: ',err)
+        Relays are located with the local database of the locator. Only if an
+        address is missing there (or no database was given) we ask the
+        location_service_url, which delivers a json object of the location
+        information for an IP address. We blinded it for submission, this should
+        be exchanged to any comparable service. Please note that a change might
+        require some changes in the expected data structure
+    """
+
+    averages = yield average_bandwidths(dbpool, db_name)
+    avg_bandwidths = averages.thresholds()
+
+    consensus_path = get_consensus_file(consensus_path, archive)
+    if consensus_path is None:
+        return
+
+    previous = None
+    if incremental:
+        previous = yield read_fingerprints(dbpool, db_name)
+
+    consensus_file = load_consensus(consensus_path)
+    consensus_file.seek(0, 2)
+    consensus_size = consensus_file.tell()
+
+    # without stored totals the differences start from the summed up fingerprints
+    base = averages if incremental and averages.summed else None
+    loader = FingerprintLoader(dbpool, db_name, read_valid_after(consensus_file), incremental, base=base)
+    unchanged = 0
+
+    GEO_CACHE_HIT_RATIO.set_function(locator.cache.hit_ratio)
+    start = time.time()
+
+    with click.progressbar(length=consensus_size, label='Parsing consensus') as bar:
+        relays = PROFILER.iterate('parse', classify_relays(read_relays(ProgressStream(consensus_file, bar)), avg_bandwidths))
+        for count, (relay, flag, bw_flag) in enumerate(relays, 1):
+            guard = guard_flag(relay)
+            INGEST_RELAYS.inc()
+            if count % YIELD_INTERVAL == 0:
+                INGEST_RATE.set(count / max(time.time() - start, 1e-6))
+                yield task.deferLater(reactor, 0, lambda: None)
+
+            known = None
+            if previous is not None:
+                known = previous.pop(relay.fingerprint, None)
+                if known is not None and (known[0], known[1], known[4], known[5]) == (relay.address, flag, guard, bw_flag):
+                    unchanged += 1
+                    continue
+
+            if known is not None and known[0] == relay.address:
+                location = known[3]
+            else:
+                with PROFILER.phase('geolocate'):
+                    location = locator.lookup(relay.address)
+                if location is None and locator.service_url:
+                    location = yield threads.deferToThread(locator.fetch, relay.address)
+
+            if location is None:
+                print('No location for ', relay.address)
+                if known is not None:
+                    loader.remove(relay.fingerprint, known)
+                continue
+
+            loader.add(relay.fingerprint, relay.address, location[0], location[1], relay.bandwidth, bw_flag, flag, guard, known)
+
+    INGEST_RATE.set(INGEST_RELAYS.value() / max(time.time() - start, 1e-6))
+
+    if previous is not None:
+        for fingerprint, known in previous.iteritems():
+            loader.remove(fingerprint, known)
+
+        print('Consensus diff: {} added or changed, {} removed, {} unchanged'.format(
+            len(loader.rows), len(loader.removed), unchanged))
+
+    try:
+        yield loader.commit()
+    except Exception as err:
+        print('Problem writing to db: ', err)
+
+class BandwidthAverages():
+    """
+    Running bandwidth totals and relay counts per flag. The averages are the
+    threshold for the "above average" flag, like before we use half of the
+    average bandwidth. Totals are kept in the bandwidth_totals table so they
+    can be updated with the differences of an incremental load instead of
+    being recomputed from all fingerprints.
+    """
+    flags = ('guard', 'relay', 'exit')
+
+    def __init__(self):
+        self.totals = dict((flag, [0.0, 0]) for flag in self.flags)
+        self.summed = False
+
+    def add(self, flag, bandwidth, relays=1):
+        self.totals[flag][0] += bandwidth
+        self.totals[flag][1] += relays
+
+    def remove(self, flag, bandwidth):
+        self.add(flag, -bandwidth, -1)
+
+    def threshold(self, flag):
+        total, relays = self.totals[flag]
+        if relays <= 0:
+            return 0
+        return total / relays / 2
+
+    def thresholds(self):
+        return [self.threshold(flag) for flag in self.flags]
+
+    def rows(self):
+        return [(flag, self.totals[flag][0], self.totals[flag][1]) for flag in self.flags]
+
+class FingerprintLoader():
+    """
+    Buffer the relays of one consensus and write them to the fingerprints table
+    in a single transaction. Rows are sent with multi-row executemany inserts
+    and updated in place if the fingerprint is already known. A full load
+    afterwards removes all relays that did not show up in this consensus, an
+    incremental load only deletes the relays passed to remove(). Readers of the
+    table keep seeing the previous consensus until the transaction commits, so
+    get_circuits.py and connect_tor.py never find it empty.
+
+    The bandwidth totals are written in the same transaction, replaced by the
+    new totals on a full load and adjusted by the differences on an
+    incremental one.
+
+    Arguments:
+        dbpool: connection to database
+        db_name: database name
+        valid_after: valid-after time of the consensus, marks the rows written
+            by this load
+        incremental: only apply the added, changed and removed relays
+        batch_size: number of rows per insert statement
+        base: BandwidthAverages the differences of an incremental load are
+            added to, for a bandwidth_totals table that is still empty
+    """
+    columns = ('fp', 'address', 'continent_code', 'country_code', 'bandwidth', 'above_avg_bw', 'flag', 'guard', 'valid_after')
+
+    def __init__(self, dbpool, db_name, valid_after, incremental=False, batch_size=1000, base=None):
+        self.dbpool = dbpool
+        self.db_name = db_name
+        self.valid_after = valid_after
+        self.incremental = incremental
+        self.batch_size = batch_size
+        self.rows = []
+        self.removed = []
+        self.totals = BandwidthAverages()
+        if base is not None:
+            for flag, total, relays in base.rows():
+                self.totals.add(flag, total, relays)
+
+    def add(self, fingerprint, address, continent_code, country_code, bandwidth, above_avg_bw, flag, guard, known=None):
+        """
+        Queue a relay for the upsert. known is the previous row of the relay
+        as returned by read_fingerprints(), its bandwidth is taken out of the
+        totals of an incremental load.
+        """
+        self.rows.append((fingerprint, address, continent_code, country_code, bandwidth, above_avg_bw, flag, guard, self.valid_after))
+        self.totals.add(flag, bandwidth)
+        if known is not None:
+            self.totals.remove(known[1], known[2])
+
+    def remove(self, fingerprint, known):
+        self.removed.append((fingerprint,))
+        self.totals.remove(known[1], known[2])
+
+    def commit(self):
+        return self.dbpool.runInteraction(self._load)
+
+    def _load(self, txn):
+        insert = self.dbpool.upsert('fingerprints', self.columns, ('fp',))
+        for index in xrange(0, len(self.rows), self.batch_size):
+            txn.executemany(insert, self.rows[index:index + self.batch_size])
+
+        if self.incremental:
+            if self.removed:
+                txn.executemany('DELETE FROM {}.fingerprints WHERE fp = %s;'.format(self.db_name), self.removed)
+            added = ('total', 'relays')
+        else:
+            txn.execute('DELETE FROM {}.fingerprints WHERE valid_after <> %s;'.format(self.db_name), (self.valid_after,))
+            added = ()
+
+        txn.executemany(self.dbpool.upsert('bandwidth_totals', ('flag', 'total', 'relays'), ('flag',), add=added), self.totals.rows())
+
+        print('Wrote {} relays to fingerprints, removed {}'.format(len(self.rows), len(self.removed)))
+
+@defer.inlineCallbacks
+def read_fingerprints(dbpool, db_name):
+    """
+    Load the relays of the previous consensus for an incremental update.
+    Returns a dict of fingerprint -> (address, flag, bandwidth,
+    (continent_code, country_code), guard, above_avg_bw).
+    """
+    rows = yield dbpool.runQuery('SELECT fp, address, flag, bandwidth, continent_code, country_code, guard, above_avg_bw '
+        'FROM {}.fingerprints;'.format(db_name))
+
+    returnValue(dict((row[0], (row[1], row[2], row[3], (row[4], row[5]), int(row[6]), int(row[7]))) for row in rows))
 
 @defer.inlineCallbacks
-def truncate_table(dbpool, db_name):
+def average_bandwidths(dbpool, db_name):
     """
-    Compute the average bandwidths of guards, relays, and exits in the prior set
-    of consensus fingerprints. We'll use this information later as a threshold
+    Get the bandwidth totals of guards, relays, and exits in the prior set
+    of consensus fingerprints. We'll use the averages later as a threshold
     to assign an "above average" flag for updated entries.
 
-    Because we only want the latest consensus data old entries are removed from
-    the table as soon as we got our average bandwidth values.
+    The totals are read from the bandwidth_totals table. If it is still empty
+    (first run after an upgrade) they are summed up from the fingerprints and
+    marked as summed, an incremental load then writes them with its
+    differences.
 
     Arguments:
         dbpool: connection to database
         db_name: database name
     """
-    bandwidths_guard = yield dbpool.runQuery('SELECT bandwidth FROM {}.fingerprints WHERE flag="guard";'.format(db_name))
-    bandwidths_relay = yield dbpool.runQuery('SELECT bandwidth FROM {}.fingerprints WHERE flag="relay";'.format(db_name))
-    bandwidths_exit = yield dbpool.runQuery('SELECT bandwidth FROM {}.fingerprints WHERE flag="exit";'.format(db_name))
+    averages = BandwidthAverages()
 
-    yield dbpool.runQuery('TRUNCATE TABLE {}.fingerprints;'.format(db_name))
-
-    try:
-        avg_guards = sum(x[0] for x in bandwidths_guard) / len(bandwidths_guard)
-        avg_guards = avg_guards / 2
-    except:
-        avg_guards = 0
-    try:
-        avg_relays = sum(x[0] for x in bandwidths_relay) / len(bandwidths_relay)
-        avg_relays = avg_relays / 2
-    except:
-        avg_relays = 0
     try:
-        avg_exits = sum(x[0] for x in bandwidths_exit) / len(bandwidths_exit)
-        avg_exits = avg_exits / 2
-    except:
-        avg_exits = 0
+        rows = yield dbpool.runQuery('SELECT flag, total, relays FROM {}.bandwidth_totals;'.format(db_name))
+        if not rows:
+            rows = yield dbpool.runQuery('SELECT flag, SUM(bandwidth), COUNT(*) FROM {}.fingerprints GROUP BY flag;'.format(db_name))
+            averages.summed = True
+
+        for flag, total, relays in rows:
+            if flag in averages.totals and total is not None:
+                averages.add(flag, float(total), int(relays))
+    except Exception as err:
+        print('Problem computing average bandwidths: ', err)
+
+    returnValue(averages)
 
-    returnValue([avg_guards,avg_relays,avg_exits])
+def relay_flag(relay):
+    """
+    Position of a relay in our circuits: exit, guard or (middle) relay.
+    """
+    if 'Exit' in relay.flags:
+        return 'exit'
+    elif 'Guard' in relay.flags:
+        return 'guard'
+    return 'relay'
 
-def get_consensus_file(consensus_path):
+def guard_flag(relay):
+    """
+    1 if the relay has the Guard flag of the consensus. relay_flag counts
+    exits with the Guard flag as exits, the bandwidth weighted circuits need
+    to tell them apart.
     """
-    Downloads the first consensus file of the current day and saves it in the
-    directory specified in the consensus_path. We use the relay descriptors
-    consensus data.
+    return 1 if 'Guard' in relay.flags else 0
 
-    To use more recent files instead of the day's first adjust the strftime
-    parsing in now = now.strftime("%Y-%m-%d-00-00-00"):
+def classify_relays(relays, avg_bandwidths):
+    """
+    Assign the guard/relay/exit flag and the "above average" bandwidth flag to
+    a stream of relays. Yields (relay, flag, bw_flag).
+
+    Arguments:
+        relays: iterable of router status entries
+        avg_bandwidths: thresholds for guards, relays, and exits
+    """
+    thresholds = dict(zip(BandwidthAverages.flags, avg_bandwidths))
+
+    for relay in relays:
+        flag = relay_flag(relay)
+        bw_flag = 1 if relay.bandwidth >= thresholds[flag] else 0
+
+        yield relay, flag, bw_flag
+
+def get_consensus_file(consensus_path, archive=None):
+    """
+    Get the first consensus file of the current day. We use the relay
+    descriptors consensus data. Returns the path of the file to parse, None if
+    it is not available.
+
+    With an archive the consensus is taken from (and if missing downloaded
+    into) the ConsensusArchive. Otherwise it is saved in the directory
+    specified in the consensus_path, a file that already holds the requested
+    consensus is not downloaded again.
+
+    To use more recent files instead of the day's first adjust the valid_after
+    time below:
         consensus is updated every hour
         minutes and seconds remain 00-00
 
     Arguments:
         consensus_path: relative path to consensus directory, includes the
             output filename for the downloaded consensus file
+        archive: ConsensusArchive or None
     """
+    valid_after = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
 
-    base_url = 'https://collector.torproject.org/recent/relay-descriptors/consensuses/'
+    if archive is not None:
+        return archive.fetch(valid_after)
 
-    now = datetime.datetime.now()
-    now = now.strftime("%Y-%m-%d-00-00-00")
+    if os.path.exists(consensus_path):
+        with open(consensus_path, 'rb') as consensus_file:
+            if read_valid_after(consensus_file) == valid_after:
+                return consensus_path
 
-    consensus_url = '{base_url}{now}-consensus'.format(base_url=base_url, now=now)
+    consensus_url = '{}{}'.format(RECENT_URL, valid_after.strftime(FILENAME_FORMAT))
 
     try:
         download = urllib.URLopener()
@@ -160,6 +360,8 @@ def get_consensus_file(consensus_path):
     except Exception as err:
         print 'Request failed: ', err, ' URL was ', consensus_url
 
+    return consensus_path
+
 @click.command()
 @click.option('--consensus-path', default=None, type=str, help='path to consensus file')
 @click.option('--db-name', default=None, type=str, help='Name of DB')
@@ -167,12 +369,32 @@ def get_consensus_file(consensus_path):
 @click.option('--db-passwd', default=None, type=str, help='Password DB')
 @click.option('--db-port', default=None, type=int, help='DB connection port')
 @click.option('--db-host', default=None, type=str, help='DB connection host')
-def main(consensus_path, db_name, db_user, db_passwd, db_port, db_host):
+@click.option('--db-file', default=None, type=str, help='SQLite database file, used instead of the MySQL server')
+@click.option('--geoip-db', default=None, type=str, help='local IP range database (range file, MaxMind csv or mmdb)')
+@click.option('--geoip-format', default=None, type=click.Choice(['range', 'maxmind-csv', 'mmdb']), help='format of --geoip-db, guessed if omitted')
+@click.option('--geoip-cache', default=8192, type=int, help='number of addresses kept in the lookup cache')
+@click.option('--location-service-url', default='', type=str, help='json location service used for addresses missing in --geoip-db')
+@click.option('--incremental', is_flag=True, help='only write relays that changed since the last consensus')
+@click.option('--archive-dir', default=None, type=str, help='consensus archive directory, replaces --consensus-path')
+@click.option('--metrics-port', default=None, type=int, help='local port of the metrics endpoint, off by default')
+def main(consensus_path, db_name, db_user, db_passwd, db_port, db_host, db_file, geoip_db, geoip_format, geoip_cache, location_service_url, incremental, archive_dir, metrics_port):
     from twisted.internet import reactor
 
-    dbpool = adbapi.ConnectionPool('MySQLdb', host=db_host, db=db_name, user=db_user, passwd=db_passwd, port=db_port)
+    dbpool = InstrumentedPool(open_storage(db_name, db_user, db_passwd, db_port, db_host, db_file))
+    db_name = dbpool.db_name
+    if metrics_port is not None:
+        serve_metrics(reactor, metrics_port)
+
+    database = None
+    if geoip_db is not None:
+        database = load_database(geoip_db, geoip_format)
+    locator = Geolocator(database, location_service_url, geoip_cache)
+
+    archive = None
+    if archive_dir is not None:
+        archive = ConsensusArchive(archive_dir)
 
-    d = write_fingerprints(reactor, dbpool, db_name, consensus_path)
+    d = write_fingerprints(reactor, dbpool, db_name, consensus_path, locator, incremental, archive)
     d.addCallback(lambda ign: reactor.stop())
 
     reactor.run()
@@ -0,0 +1,259 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer, task
+
+import json
+import math
+
+class LatencyHistogram():
+    """
+    Streaming latency summary in the style of an HDR histogram. Values are
+    counted in logarithmic buckets that are (1 + precision) wide, so every
+    percentile is exact up to precision (1% by default) relative error, no
+    matter how many samples were recorded. Buckets are kept sparse, a
+    histogram of latencies between 1ms and 10min has at most ~1300 of them.
+
+    Histograms with the same precision are merged by adding their bucket
+    counts, which makes them mergeable across runs and scanner hosts. A
+    histogram of another precision has to be rebucketed first.
+
+    Arguments:
+        precision: relative width of a bucket
+    """
+    def __init__(self, precision=0.01):
+        self.precision = precision
+        self.log_base = math.log(1 + precision)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def record(self, value):
+        value = float(value)
+        if value <= 0:
+            self.zeros += 1
+        else:
+            index = int(math.floor(math.log(value) / self.log_base))
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge histograms of different precision')
+
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def rebucket(self, precision):
+        """
+        Copy of the histogram with buckets of another precision. The samples
+        of every bucket are moved to the new bucket of its midpoint, so the
+        error of the copy is up to the sum of both precisions.
+        """
+        histogram = LatencyHistogram(precision)
+        for index, count in self.buckets.iteritems():
+            value = math.exp((index + 0.5) * self.log_base)
+            new_index = int(math.floor(math.log(value) / histogram.log_base))
+            histogram.buckets[new_index] = histogram.buckets.get(new_index, 0) + count
+        histogram.zeros = self.zeros
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.min = self.min
+        histogram.max = self.max
+        return histogram
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Value below which percent of the samples fall, None without samples.
+        """
+        if self.count == 0:
+            return None
+
+        rank = percent / 100.0 * self.count
+        seen = self.zeros
+        if seen >= rank and self.zeros > 0:
+            return 0.0
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                value = math.exp((index + 0.5) * self.log_base)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def to_json(self):
+        return json.dumps({
+            'precision': self.precision,
+            'buckets': self.buckets,
+            'zeros': self.zeros,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max})
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        histogram = cls(data['precision'])
+        histogram.buckets = dict((int(index), count) for index, count in data['buckets'].iteritems())
+        histogram.zeros = data['zeros']
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+class RunningStats():
+    """
+    Running mean and variance of a latency (Welford's algorithm), updated in
+    O(1) per sample without keeping the samples. Used by the adaptive mode of
+    the scanner to decide when an estimate is precise enough.
+    """
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    def relative_error(self, z=1.96):
+        """
+        Half width of the confidence interval of the mean (95% by default)
+        relative to the mean, None until there are two samples.
+        """
+        variance = self.variance()
+        if variance is None or self.mean <= 0:
+            return None
+        return z * math.sqrt(variance / self.count) / self.mean
+
+    def converged(self, precision, min_samples=2):
+        error = self.relative_error()
+        return self.count >= min_samples and error is not None and error <= precision
+
+    def to_tuple(self):
+        return (self.count, self.mean, self.m2)
+
+SUMMARY_COLUMNS = ('strategy', 'geo_code', 'period', 'metric', 'histogram', 'samples', 'mean', 'p50', 'p95', 'p99')
+
+class LatencySummaries():
+    """
+    Online aggregation of the measurements into one LatencyHistogram per
+    (strategy, geo_code, period, metric). Samples are recorded in memory as
+    they come in and merged into the latency_summaries table every
+    persist_interval seconds and at the end of the run. The merge reads the
+    stored histogram with a locking read (SQLite has a single writer anyway),
+    adds the new samples and writes it back in one transaction, so several
+    runs and hosts can update the same summary. A stored histogram of another
+    precision is rebucketed to the precision of the run before the merge, so
+    changing the precision never stops the summaries from being written.
+    Next to the histogram the table holds the sample count, mean, and
+    p50/p95/p99 for dashboards.
+
+    Arguments:
+        dbpool: connection to database
+        db_name: database name
+        persist_interval: seconds between merges into the table
+        precision: relative bucket width of the histograms
+    """
+    def __init__(self, dbpool, db_name, persist_interval=60, precision=0.01):
+        self.dbpool = dbpool
+        self.db_name = db_name
+        self.persist_interval = persist_interval
+        self.precision = precision
+        self.pending = {}
+        self.persisting = None
+        self.loop = None
+
+    def record(self, strategy, geo_code, period, metric, value):
+        key = (strategy, geo_code, period, metric)
+        try:
+            histogram = self.pending[key]
+        except KeyError:
+            histogram = self.pending[key] = LatencyHistogram(self.precision)
+        histogram.record(value)
+
+    def start(self, reactor):
+        self.loop = task.LoopingCall(self.persist)
+        self.loop.clock = reactor
+        self.loop.start(self.persist_interval, now=False)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        if self.persisting is not None:
+            yield self.persisting
+        yield self.persist()
+
+    def persist(self):
+        if self.persisting is not None or not self.pending:
+            return defer.succeed(None)
+
+        pending, self.pending = self.pending, {}
+
+        d = self.persisting = self.dbpool.runInteraction(self._merge, pending)
+        d.addErrback(self._restore, pending)
+        d.addBoth(self._persisted)
+        return d
+
+    def _merge(self, txn, pending):
+        select = 'SELECT histogram FROM {}.latency_summaries WHERE strategy = %s AND geo_code = %s AND period = %s AND metric = %s{};'.format(
+            self.db_name, self.dbpool.for_update)
+        insert = self.dbpool.upsert('latency_summaries', SUMMARY_COLUMNS, SUMMARY_COLUMNS[:4])
+
+        for key, histogram in pending.iteritems():
+            txn.execute(select, key)
+            row = txn.fetchone()
+
+            merged = LatencyHistogram(self.precision)
+            if row is not None:
+                merged = LatencyHistogram.from_json(row[0])
+                if merged.precision != self.precision:
+                    merged = merged.rebucket(self.precision)
+            merged.merge(histogram)
+
+            txn.execute(insert, key + (merged.to_json(), merged.count, merged.mean(),
+                    merged.percentile(50), merged.percentile(95), merged.percentile(99)))
+
+    def _restore(self, failure, pending):
+        print('Unable to write latency summaries to db: ', failure.getErrorMessage())
+
+        for key, histogram in pending.iteritems():
+            if key in self.pending:
+                histogram.merge(self.pending[key])
+            self.pending[key] = histogram
+
+    def _persisted(self, result):
+        self.persisting = None
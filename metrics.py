@@ -0,0 +1,399 @@
+#!/usr/bin/env/python
+
+from twisted.internet import task
+from twisted.web import resource, server
+from contextlib import contextmanager
+
+import cProfile
+import pstats
+import time
+import io
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric():
+    """
+    Base of all metrics: a name, a help text and the label names. Every
+    combination of label values has its own value, passed as keyword
+    arguments, e.g. attempts.inc(strategy='country_code').
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self):
+        """
+        (suffix, label string, value) of every value of the metric.
+        """
+        for key in sorted(self.values):
+            yield '', _labels(self.label_names, key), self.values[key]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, labels, _number(value)))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    """
+    Value that goes up and down. A gauge with a function reads its value
+    when the metrics are rendered, e.g. the hit rate of a cache.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=()):
+        Metric.__init__(self, name, help_text, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self.function = function
+
+    def value(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        return Metric.samples(self)
+
+class Histogram(Metric):
+    """
+    Distribution of durations in seconds with cumulative buckets, rendered
+    as <name>_bucket, <name>_sum and <name>_count like Prometheus expects.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help_text, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        try:
+            counts, total = self.values[key]
+        except KeyError:
+            counts, total = [0] * len(self.buckets), 0.0
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        for key in sorted(self.values):
+            counts, total = self.values[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', _labels(self.label_names, key, [('le', _number(bound))]), cumulative
+            yield '_sum', _labels(self.label_names, key), total
+            yield '_count', _labels(self.label_names, key), cumulative
+
+class Registry():
+    """
+    All metrics of a process. Asking for a metric that already exists
+    returns it, so modules can declare their metrics at import time and
+    share them.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def _metric(self, cls, name, help_text, labels, **kw):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, help_text, labels, **kw)
+        return self.metrics[name]
+
+    def counter(self, name, help_text, labels=()):
+        return self._metric(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._metric(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=BUCKETS):
+        return self._metric(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self):
+        """
+        All metrics in the Prometheus text format.
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def statement_name(sql):
+    """
+    Short name of a query for the statement label: the command and the
+    first table, e.g. 'SELECT fingerprints'.
+    """
+    words = sql.replace('(', ' ').split()
+    command = words[0].upper() if words else ''
+    for index, word in enumerate(words[:-1]):
+        if word.upper() in ('FROM', 'INTO', 'UPDATE', 'TABLE'):
+            return '{} {}'.format(command, words[index + 1].split('.')[-1].strip(';'))
+    return command
+
+class InstrumentedPool():
+    """
+    Wraps a ConnectionPool and records the duration of every runQuery,
+    runOperation and runInteraction in db_query_seconds, labeled with the
+    statement of a query or the name of the transaction function. Everything
+    else is passed on to the pool.
+
+    Arguments:
+        dbpool: ConnectionPool to wrap
+        registry: Registry of the histogram, the global one by default
+    """
+    def __init__(self, dbpool, registry=REGISTRY):
+        self.dbpool = dbpool
+        self.seconds = registry.histogram('db_query_seconds', 'Duration of database queries and transactions', ('statement',))
+        self.errors = registry.counter('db_query_errors_total', 'Failed database queries and transactions', ('statement',))
+
+    def __getattr__(self, name):
+        return getattr(self.dbpool, name)
+
+    def _timed(self, statement, d):
+        start = time.time()
+        def done(result):
+            self.seconds.observe(time.time() - start, statement=statement)
+            return result
+        def failed(failure):
+            self.errors.inc(statement=statement)
+            return failure
+        d.addErrback(failed)
+        d.addBoth(done)
+        return d
+
+    def runQuery(self, sql, *args, **kw):
+        return self._timed(statement_name(sql), self.dbpool.runQuery(sql, *args, **kw))
+
+    def runOperation(self, sql, *args, **kw):
+        return self._timed(statement_name(sql), self.dbpool.runOperation(sql, *args, **kw))
+
+    def runInteraction(self, interaction, *args, **kw):
+        return self._timed(interaction.__name__, self.dbpool.runInteraction(interaction, *args, **kw))
+
+class ReactorLagMonitor():
+    """
+    Timer that should fire every interval seconds. How much later it fires
+    goes into reactor_lag_seconds, a high lag means the reactor thread is
+    busy with something that blocks it.
+
+    Arguments:
+        reactor: reactor the timer runs on
+        interval: seconds between two ticks
+        registry: Registry of the histogram, the global one by default
+        lags: LatencyHistogram that also gets every lag in milliseconds, for
+            reports that need exact percentiles like the benchmarks
+    """
+    def __init__(self, reactor, interval=0.5, registry=REGISTRY, lags=None):
+        self.interval = interval
+        self.lag = registry.histogram('reactor_lag_seconds', 'Delay of a timer on the reactor, a busy reactor fires it late')
+        self.lags = lags
+        self.last = None
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.clock = reactor
+
+    def tick(self):
+        now = time.time()
+        if self.last is not None:
+            lag = max(now - self.last - self.interval, 0)
+            self.lag.observe(lag)
+            if self.lags is not None:
+                self.lags.record(lag * 1000)
+        self.last = now
+
+    def start(self):
+        self.loop.start(self.interval)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+class Profiler():
+    """
+    cProfile that can be switched on and off while a tool runs. While it is
+    on, code outside of a phase is profiled as 'main', code in a phase()
+    block has a profile of its own, so the report shows where every phase
+    spends its time. Only the reactor thread is profiled, database
+    transactions in the thread pool are not. Phases should only wrap code
+    that does not wait for a deferred, otherwise whatever the reactor does
+    in the meantime is counted for the phase.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.profiles = {}
+        self.stack = []
+
+    def _profile(self, phase):
+        if phase not in self.profiles:
+            self.profiles[phase] = cProfile.Profile()
+        return self.profiles[phase]
+
+    def _current(self):
+        return self.stack[-1] if self.stack else 'main'
+
+    def start(self):
+        if self.enabled:
+            return
+        self.profiles = {}
+        self.enabled = True
+        self._profile(self._current()).enable()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self._profile(self._current()).disable()
+        self.enabled = False
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            self.stack.append(name)
+            try:
+                yield
+            finally:
+                self.stack.pop()
+            return
+
+        outer = self._current()
+        self._profile(outer).disable()
+        self._profile(name).enable()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            self._profile(name).disable()
+            if self.enabled:
+                self._profile(outer).enable()
+
+    def iterate(self, name, iterable):
+        """
+        Iterate over iterable with every step in the phase name, for
+        generators that do the work of a phase lazily.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self, limit=25):
+        """
+        The limit functions with the highest cumulative time of every phase
+        as text.
+        """
+        output = io.BytesIO()
+        for phase in sorted(self.profiles):
+            output.write('=== {} ===\n'.format(phase))
+            try:
+                stats = pstats.Stats(self.profiles[phase], stream=output)
+            except TypeError:
+                output.write('no samples\n')
+                continue
+            stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+PROFILER = Profiler()
+
+class MetricsResource(resource.Resource):
+    """
+    The metrics endpoint:
+        GET /metrics          all metrics in the Prometheus text format
+        POST /profile/start   switch the profiler on
+        POST /profile/stop    switch the profiler off and return the report
+        GET /profile          report of the profiles so far
+    """
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY, profiler=PROFILER):
+        resource.Resource.__init__(self)
+        self.registry = registry
+        self.profiler = profiler
+
+    def render_GET(self, request):
+        if request.path == b'/metrics':
+            request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+            return self.registry.render()
+        if request.path == b'/profile':
+            request.setHeader(b'content-type', b'text/plain')
+            return self.profiler.report()
+        request.setResponseCode(404)
+        return b'not found\n'
+
+    def render_POST(self, request):
+        request.setHeader(b'content-type', b'text/plain')
+        if request.path == b'/profile/start':
+            self.profiler.start()
+            return b'profiling\n'
+        if request.path == b'/profile/stop':
+            self.profiler.stop()
+            return self.profiler.report()
+        request.setResponseCode(404)
+        return b'not found\n'
+
+def serve_metrics(reactor, port, interface='127.0.0.1', registry=REGISTRY, profiler=PROFILER):
+    """
+    Serve the metrics endpoint on a local port of the reactor and start
+    measuring the reactor lag. Returns the listening port.
+    """
+    ReactorLagMonitor(reactor, registry=registry).start()
+    listening = reactor.listenTCP(port, server.Site(MetricsResource(registry, profiler)), interface=interface)
+    print('Serving metrics on http://{}:{}/metrics'.format(interface, listening.getHost().port))
+    return listening
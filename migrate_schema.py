@@ -0,0 +1,115 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer
+from storage import open_storage
+
+import click
+
+def column_types(txn, db_name, table):
+    txn.execute('SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s;',
+        (db_name, table))
+    return dict((name, data_type.lower()) for name, data_type in txn.fetchall())
+
+def migrate_fingerprints(txn, storage):
+    """
+    Fingerprints are 40 hex characters, store them as CHAR(40) instead of
+    VARCHAR(255) so the unique index on fp stays small.
+    """
+    db_name = storage.db_name
+    txn.execute('SELECT CHARACTER_MAXIMUM_LENGTH, DATA_TYPE FROM information_schema.COLUMNS '
+        'WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s;', (db_name, 'fingerprints', 'fp'))
+    row = txn.fetchone()
+    if row is None or (row[0] == 40 and row[1].lower() == 'char'):
+        print('fingerprints.fp is up to date')
+        return
+
+    txn.execute('ALTER TABLE {}.fingerprints MODIFY fp CHAR(40) NOT NULL;'.format(db_name))
+    print('Changed fingerprints.fp to CHAR(40)')
+
+def migrate_guard_flag(txn, storage):
+    """
+    Add the Guard flag of the consensus to fingerprints. Existing rows start
+    without it, the next run of get_consensus.py writes the flag of every
+    relay (an incremental run rewrites the relays with the Guard flag).
+    """
+    db_name = storage.db_name
+    if 'guard' in column_types(txn, db_name, 'fingerprints'):
+        print('fingerprints.guard is up to date')
+        return
+
+    txn.execute('ALTER TABLE {}.fingerprints ADD COLUMN guard BOOLEAN NOT NULL DEFAULT 0 AFTER flag;'.format(db_name))
+    print('Added fingerprints.guard')
+
+def migrate_circuits(txn, storage):
+    """
+    Rewrite circuits with fingerprint strings in the relay columns to the fid
+    of the relays and add the covering index. The new table is filled from
+    the old one joined with fingerprints and renamed into place, circuits
+    with relays that are no longer in fingerprints are dropped.
+    """
+    db_name = storage.db_name
+    types = column_types(txn, db_name, 'circuits')
+    if types.get('entry_relay') == 'int':
+        txn.execute('SHOW INDEX FROM {}.circuits WHERE Key_name = %s;'.format(db_name), ('strategy_geo_code',))
+        if not txn.fetchall():
+            txn.execute('ALTER TABLE {}.circuits ADD KEY strategy_geo_code (strategy, geo_code, entry_relay, middle_relay, exit_relay);'.format(db_name))
+            print('Added covering index to circuits')
+        else:
+            print('circuits is up to date')
+        return
+
+    txn.execute('DROP TABLE IF EXISTS {}.circuits_migrated;'.format(db_name))
+    for statement in storage.schema('circuits', 'circuits_migrated'):
+        txn.execute(statement)
+    txn.execute('INSERT INTO {0}.circuits_migrated (entry_relay, middle_relay, exit_relay, strategy, geo_code) '
+        'SELECT e.fid, m.fid, x.fid, c.strategy, c.geo_code FROM {0}.circuits c '
+        'JOIN {0}.fingerprints e ON e.fp = c.entry_relay '
+        'JOIN {0}.fingerprints m ON m.fp = c.middle_relay '
+        'JOIN {0}.fingerprints x ON x.fp = c.exit_relay;'.format(db_name))
+    migrated = txn.rowcount
+
+    storage.replace_table(txn, 'circuits', 'circuits_migrated')
+    print('Migrated {} circuits to relay fids'.format(migrated))
+
+@defer.inlineCallbacks
+def migrate(dbpool):
+    """
+    Bring the tables of an existing MySQL database to the compact schema:
+    CHAR(40) fingerprints with the Guard flag and circuits that reference
+    fingerprints.fid.
+    Every step checks the current schema first, running the migration again
+    does nothing. SQLite databases are always created with the current
+    schema.
+    """
+    if dbpool.dialect != 'mysql':
+        print('Nothing to migrate in a {} database'.format(dbpool.dialect))
+        return
+
+    for step in (migrate_fingerprints, migrate_guard_flag, migrate_circuits):
+        try:
+            yield dbpool.runInteraction(step, dbpool)
+        except Exception as err:
+            print('Migration step {} failed: '.format(step.__name__), err)
+            return
+
+@click.command()
+@click.option('--db-name', default=None, type=str, help='Name of DB')
+@click.option('--db-user', default=None, type=str, help='Username DB')
+@click.option('--db-passwd', default=None, type=str, help='Password DB')
+@click.option('--db-port', default=None, type=int, help='DB connection port')
+@click.option('--db-host', default=None, type=str, help='DB connection host')
+@click.option('--db-file', default=None, type=str, help='SQLite database file, used instead of the MySQL server')
+def main(db_name, db_user, db_passwd, db_port, db_host, db_file):
+    from twisted.internet import reactor
+
+    dbpool = open_storage(db_name, db_user, db_passwd, db_port, db_host, db_file)
+
+    def run():
+        d = migrate(dbpool)
+        d.addCallback(lambda ign: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer, task
+from twisted.internet.defer import returnValue
+
+import random
+import time
+
+class RelayHealth():
+    """
+    Failure and success counts of every relay the scanner built circuits
+    with. Counts decay exponentially with half_life seconds, so a relay that
+    was overloaded yesterday recovers, while a relay that keeps failing stays
+    down. The counts are loaded from the relay_health table at the start of
+    a run, updated in memory and merged back every persist_interval seconds,
+    get_circuits.py reads the same table. Only the counts added since the
+    last merge are written: they are added to the stored counts (both decayed
+    to the later update time) in a transaction with a locking read, so
+    several hosts or instances can share the table.
+
+    A relay is unreliable once it has at least min_failures (decayed)
+    failures and fails in more than max_failure_rate of its circuits, it is
+    skipped by the circuit pool and get_circuits.py. Below that every relay
+    has a weight of 1 - failure rate, used to down-weight relays when
+    circuits are formed.
+
+    Arguments:
+        dbpool: connection to database
+        db_name: database name
+        half_life: seconds after which the counts have decayed to half
+        min_failures: failures before a relay may be considered unreliable
+        max_failure_rate: failure rate above which a relay is unreliable
+        persist_interval: seconds between merges into the table
+    """
+    def __init__(self, dbpool, db_name, half_life=6 * 3600, min_failures=3, max_failure_rate=0.5, persist_interval=60):
+        self.dbpool = dbpool
+        self.db_name = db_name
+        self.half_life = half_life
+        self.min_failures = min_failures
+        self.max_failure_rate = max_failure_rate
+        self.persist_interval = persist_interval
+
+        self.relays = {}
+        self.pending = {}
+        self.loop = None
+
+    def _decay(self, counts, now):
+        """
+        (failures, successes) of a (failures, successes, updated) row decayed
+        to now.
+        """
+        failures, successes, updated = counts
+        decay = 0.5 ** (max(now - updated, 0) / float(self.half_life))
+        return failures * decay, successes * decay
+
+    def _counts(self, fp, now=None):
+        """
+        (failures, successes) of a relay decayed to now.
+        """
+        try:
+            counts = self.relays[fp]
+        except KeyError:
+            return 0.0, 0.0
+
+        return self._decay(counts, now or time.time())
+
+    def _add_pending(self, fp, failures, successes, now):
+        old_failures, old_successes = self._decay(self.pending.get(fp, (0.0, 0.0, now)), now)
+        self.pending[fp] = (old_failures + failures, old_successes + successes, now)
+
+    def _update(self, fp, failures, successes):
+        now = time.time()
+        old_failures, old_successes = self._counts(fp, now)
+        self.relays[fp] = (old_failures + failures, old_successes + successes, now)
+        self._add_pending(fp, failures, successes, now)
+
+    def failed(self, fp):
+        self._update(fp.lstrip('$'), 1, 0)
+
+    def succeeded(self, fps):
+        for fp in fps:
+            self._update(fp.lstrip('$'), 0, 1)
+
+    def failure_rate(self, fp):
+        failures, successes = self._counts(fp.lstrip('$'))
+        if failures + successes == 0:
+            return 0.0
+        return failures / (failures + successes)
+
+    def unreliable(self, fp):
+        failures, successes = self._counts(fp.lstrip('$'))
+        return failures >= self.min_failures and failures / (failures + successes) > self.max_failure_rate
+
+    def weight(self, fp):
+        """
+        Weight of a relay for the selection of circuits, 0 if it is
+        unreliable.
+        """
+        if self.unreliable(fp):
+            return 0.0
+        return 1.0 - self.failure_rate(fp)
+
+    def weights(self, fps):
+        return dict((fp, self.weight(fp)) for fp in fps if fp.lstrip('$') in self.relays)
+
+    @defer.inlineCallbacks
+    def load(self):
+        rows = yield self.dbpool.runQuery('SELECT fp, failures, successes, updated FROM {}.relay_health;'.format(self.db_name))
+        for fp, failures, successes, updated in rows:
+            self.relays[fp] = (failures, successes, updated)
+        print('Loaded health of {} relays'.format(len(self.relays)))
+
+    def start(self, reactor):
+        self.loop = task.LoopingCall(self.persist)
+        self.loop.clock = reactor
+        self.loop.start(self.persist_interval, now=False)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        return self.persist()
+
+    def persist(self):
+        if not self.pending:
+            return defer.succeed(None)
+
+        pending, self.pending = self.pending, {}
+
+        d = self.dbpool.runInteraction(self._merge, pending)
+        d.addErrback(self._restore, pending)
+        return d
+
+    def _merge(self, txn, pending):
+        select = 'SELECT failures, successes, updated FROM {}.relay_health WHERE fp = %s{};'.format(
+            self.db_name, self.dbpool.for_update)
+
+        rows = []
+        for fp, counts in pending.iteritems():
+            failures, successes, updated = counts
+            txn.execute(select, (fp,))
+            row = txn.fetchone()
+            if row is not None:
+                updated = max(updated, row[2])
+                failures, successes = self._decay(counts, updated)
+                stored_failures, stored_successes = self._decay(row, updated)
+                failures += stored_failures
+                successes += stored_successes
+            rows.append((fp, failures, successes, updated))
+
+        txn.executemany(self.dbpool.upsert('relay_health', ('fp', 'failures', 'successes', 'updated'), ('fp',)), rows)
+
+    def _restore(self, failure, pending):
+        print('Unable to write relay health to db: ', failure.getErrorMessage())
+        for fp, counts in pending.iteritems():
+            now = max(counts[2], self.pending.get(fp, counts)[2])
+            failures, successes = self._decay(counts, now)
+            self._add_pending(fp, failures, successes, now)
+
+def weighted_order(fps, weights):
+    """
+    Random order of fps in which relays with a lower weight tend to come
+    later (weighted random sampling without replacement, Efraimidis and
+    Spirakis). Relays without a weight count as 1, relays with weight 0 are
+    left out.
+    """
+    keys = []
+    for fp in fps:
+        weight = weights.get(fp, 1.0)
+        if weight > 0:
+            keys.append((random.random() ** (1.0 / weight), fp))
+
+    keys.sort(reverse=True)
+    return [fp for key, fp in keys]
+
+@defer.inlineCallbacks
+def read_relay_weights(dbpool, db_name, fps):
+    """
+    Relay weights of the fps from the relay_health table, an empty dict if
+    the table cannot be read.
+    """
+    health = RelayHealth(dbpool, db_name)
+    try:
+        yield health.load()
+    except Exception as err:
+        print('Could not read relay health: ', err)
+        returnValue({})
+
+    returnValue(health.weights(fps))
@@ -0,0 +1,168 @@
+#!/usr/bin/env/python
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
+import json
+import os
+import shutil
+
+TABLES = {
+    'circuit_statistics': ('build_offset', 'strategy', 'geo_code', 'period'),
+    'request_statistics': ('request_offset', 'strategy', 'geo_code', 'period'),
+    'request_phases': ('circuit', 'request', 'attach_offset', 'ttfb_offset', 'body_offset', 'strategy', 'geo_code', 'period'),
+    'circuit_failures': ('strategy', 'geo_code', 'period', 'rate', 'repetitions'),
+}
+
+class ResultWriter():
+    """
+    Write-behind buffer for measurement results. Rows are collected per table
+    and written during the run in one transaction per flush, with one
+    multi-row executemany insert per table. A flush starts when batch_size
+    rows are buffered or every flush_interval seconds, only one flush runs at
+    a time.
+
+    The buffer holds at most max_rows rows: add() returns a Deferred that only
+    fires once the buffer is below that bound again, callers that wait for it
+    are slowed down to the speed of the database.
+
+    If a flush fails (database gone, tor hiccup on the same host, ...) the rows
+    are appended to the spill file as json lines instead of being lost.
+    replay() writes a spill file to the database later.
+
+    Arguments:
+        dbpool: connection to database
+        db_name: database name
+        batch_size: number of buffered rows that starts a flush
+        flush_interval: seconds between timed flushes
+        max_rows: upper bound of buffered rows
+        spill_path: append-only file for rows that could not be written
+    """
+    def __init__(self, dbpool, db_name, batch_size=500, flush_interval=5, max_rows=10000, spill_path='results.spill'):
+        self.dbpool = dbpool
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.spill_path = spill_path
+
+        # statements are built once, the database can keep them prepared
+        self.inserts = dict((table, 'INSERT INTO {}.{} ({}) VALUES ({});'.format(
+            db_name, table, ', '.join(columns), ', '.join(['%s'] * len(columns)))) for table, columns in TABLES.items())
+
+        self.buffers = dict((table, []) for table in TABLES)
+        self.size = 0
+        self.flushing = None
+        self.waiting = []
+        self.loop = None
+
+        self.written = 0
+        self.spilled = 0
+
+    def start(self, reactor):
+        self.loop = task.LoopingCall(self.flush)
+        self.loop.clock = reactor
+        self.loop.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        return self.drain()
+
+    @defer.inlineCallbacks
+    def drain(self):
+        while self.size > 0 or self.flushing is not None:
+            yield self.flush()
+
+    def add(self, table, row):
+        self.buffers[table].append(tuple(row))
+        self.size += 1
+
+        if self.size >= self.batch_size:
+            self.flush()
+
+        if self.size < self.max_rows:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def flush(self):
+        if self.flushing is not None:
+            return self.flushing
+        if self.size == 0:
+            return defer.succeed(None)
+
+        batches = [(table, rows) for table, rows in self.buffers.items() if rows]
+        self.buffers = dict((table, []) for table in TABLES)
+        self.size = 0
+
+        d = self.flushing = self.dbpool.runInteraction(self._write, batches)
+        d.addErrback(self._spill, batches)
+        d.addBoth(self._flushed)
+        return d
+
+    def _write(self, txn, batches):
+        for table, rows in batches:
+            txn.executemany(self.inserts[table], rows)
+
+        self.written += sum(len(rows) for table, rows in batches)
+
+    def _spill(self, failure, batches):
+        print('Unable to write results to db, spilling to {}: '.format(self.spill_path), failure.getErrorMessage())
+
+        with open(self.spill_path, 'ab') as spill_file:
+            for table, rows in batches:
+                for row in rows:
+                    spill_file.write(json.dumps({'table': table, 'row': row}) + '\n')
+                self.spilled += len(rows)
+
+    def _flushed(self, result):
+        self.flushing = None
+
+        if self.size < self.max_rows:
+            waiting, self.waiting = self.waiting, []
+            for d in waiting:
+                d.callback(None)
+
+        if self.size >= self.batch_size:
+            self.flush()
+
+    @defer.inlineCallbacks
+    def replay(self, spill_path=None):
+        """
+        Write the rows of a spill file to the database. The file is renamed
+        before it is read, rows that still cannot be written are spilled
+        again to the current spill file. A replay file left over by an
+        interrupted replay is written as well, the spill file is appended to
+        it instead of replacing it.
+        """
+        spill_path = spill_path or self.spill_path
+        replay_path = spill_path + '.replay'
+        if not os.path.exists(replay_path):
+            if not os.path.exists(spill_path):
+                return
+            os.rename(spill_path, replay_path)
+        elif os.path.exists(spill_path):
+            with open(spill_path, 'rb') as spill_file, open(replay_path, 'ab') as replay_file:
+                shutil.copyfileobj(spill_file, replay_file)
+            os.remove(spill_path)
+
+        batches = dict((table, []) for table in TABLES)
+        with open(replay_path, 'rb') as replay_file:
+            for line in replay_file:
+                try:
+                    entry = json.loads(line)
+                    batches[entry['table']].append(tuple(entry['row']))
+                except (ValueError, KeyError):
+                    print('Skipping malformed spill line: ', line)
+
+        batches = [(table, rows) for table, rows in batches.items() if rows]
+        try:
+            yield self.dbpool.runInteraction(self._write, batches)
+            print('Replayed {} rows from {}'.format(sum(len(rows) for table, rows in batches), spill_path))
+        except Exception:
+            self._spill(Failure(), batches)
+
+        os.remove(replay_path)
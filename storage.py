@@ -0,0 +1,335 @@
+#!/usr/bin/env/python
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer
+from twisted.internet.defer import returnValue
+
+# columns and indexes of every table, written for MySQL and adapted for SQLite
+SCHEMAS = {
+    'fingerprints': ([
+        'fid INT NOT NULL AUTO_INCREMENT PRIMARY KEY',
+        'fp CHAR(40) NOT NULL UNIQUE',
+        'address VARCHAR(45) NOT NULL',
+        'continent_code CHAR(2) NOT NULL',
+        'country_code CHAR(2) NOT NULL',
+        'bandwidth DOUBLE NOT NULL',
+        'above_avg_bw BOOLEAN NOT NULL',
+        'flag VARCHAR(5)',
+        'guard BOOLEAN NOT NULL DEFAULT 0',
+        'valid_after DATETIME NOT NULL',
+    ], []),
+    'bandwidth_totals': ([
+        'flag VARCHAR(5) NOT NULL PRIMARY KEY',
+        'total DOUBLE NOT NULL',
+        'relays INT NOT NULL',
+    ], []),
+    'fingerprints_history': ([
+        'valid_after DATETIME NOT NULL',
+        'fp VARCHAR(255) NOT NULL',
+        'address VARCHAR(45) NOT NULL',
+        'continent_code CHAR(2) NOT NULL',
+        'country_code CHAR(2) NOT NULL',
+        'bandwidth DOUBLE NOT NULL',
+        'above_avg_bw BOOLEAN NOT NULL',
+        'flag VARCHAR(5)',
+        'PRIMARY KEY (valid_after, fp)',
+    ], []),
+    'circuits': ([
+        'cid INT NOT NULL AUTO_INCREMENT PRIMARY KEY',
+        'entry_relay INT NOT NULL',
+        'middle_relay INT NOT NULL',
+        'exit_relay INT NOT NULL',
+        'strategy VARCHAR(32) NOT NULL',
+        'geo_code CHAR(2) NOT NULL',
+    ], [('strategy_geo_code', ('strategy', 'geo_code', 'entry_relay', 'middle_relay', 'exit_relay'))]),
+    'circuit_statistics': ([
+        'cid INT NOT NULL AUTO_INCREMENT PRIMARY KEY',
+        'build_offset VARCHAR(255) NOT NULL',
+        'strategy VARCHAR(255) NOT NULL',
+        'geo_code CHAR(2) NOT NULL',
+        'period CHAR(2) NOT NULL',
+    ], []),
+    'request_statistics': ([
+        'cid INT NOT NULL AUTO_INCREMENT PRIMARY KEY',
+        'request_offset VARCHAR(255) NOT NULL',
+        'strategy VARCHAR(255) NOT NULL',
+        'geo_code CHAR(2) NOT NULL',
+        'period CHAR(2) NOT NULL',
+    ], []),
+    'request_phases': ([
+        'rid INT NOT NULL AUTO_INCREMENT PRIMARY KEY',
+        'circuit INT NOT NULL',
+        'request INT NOT NULL',
+        'attach_offset DOUBLE NOT NULL',
+        'ttfb_offset DOUBLE NOT NULL',
+        'body_offset DOUBLE NOT NULL',
+        'strategy VARCHAR(255) NOT NULL',
+        'geo_code CHAR(2) NOT NULL',
+        'period CHAR(2) NOT NULL',
+    ], []),
+    'circuit_failures': ([
+        'cid INT NOT NULL AUTO_INCREMENT PRIMARY KEY',
+        'strategy VARCHAR(255) NOT NULL',
+        'geo_code CHAR(2) NOT NULL',
+        'period CHAR(2) NOT NULL',
+        'rate DOUBLE NOT NULL',
+        'repetitions DOUBLE NOT NULL',
+    ], []),
+    'relay_health': ([
+        'fp CHAR(40) NOT NULL PRIMARY KEY',
+        'failures DOUBLE NOT NULL',
+        'successes DOUBLE NOT NULL',
+        'updated DOUBLE NOT NULL',
+    ], []),
+    'latency_summaries': ([
+        'strategy VARCHAR(255) NOT NULL',
+        'geo_code CHAR(2) NOT NULL',
+        'period CHAR(2) NOT NULL',
+        'metric VARCHAR(16) NOT NULL',
+        'histogram MEDIUMTEXT NOT NULL',
+        'samples INT NOT NULL',
+        'mean DOUBLE',
+        'p50 DOUBLE',
+        'p95 DOUBLE',
+        'p99 DOUBLE',
+        'PRIMARY KEY (strategy, geo_code, period, metric)',
+    ], []),
+}
+
+class Storage():
+    """
+    Database of the scanner. A Storage is used like the adbapi
+    ConnectionPool it wraps (runQuery, runOperation, runInteraction) and
+    knows the statements that differ between MySQL and SQLite: upserts,
+    locking reads and the replacement of a whole table. Queries are written
+    for MySQL with %s parameters and <db_name>.<table> names, the SQLite
+    backend adapts the parameters. The tables of SCHEMAS are created with
+    their indexes when the first connection is opened.
+
+    Arguments:
+        dbpool: ConnectionPool of the backend
+        db_name: database name used in the queries
+    """
+    dialect = None
+    for_update = ' FOR UPDATE'
+
+    def __init__(self, dbpool, db_name):
+        self.dbpool = dbpool
+        self.db_name = db_name
+
+    def sql(self, statement):
+        return statement
+
+    def cursor(self, txn):
+        return txn
+
+    def runQuery(self, sql, *args, **kw):
+        return self.dbpool.runQuery(self.sql(sql), *args, **kw)
+
+    def runOperation(self, sql, *args, **kw):
+        return self.dbpool.runOperation(self.sql(sql), *args, **kw)
+
+    def runInteraction(self, interaction, *args, **kw):
+        return self.dbpool.runInteraction(self._interaction, interaction, *args, **kw)
+
+    def _interaction(self, txn, interaction, *args, **kw):
+        return interaction(self.cursor(txn), *args, **kw)
+
+    def close(self):
+        self.dbpool.close()
+
+    def table(self, name):
+        return '{}.{}'.format(self.db_name, name)
+
+    def schema(self, name, table=None, indexes=True):
+        """
+        CREATE TABLE statements of the table name of SCHEMAS, created as
+        table if given.
+        """
+        raise NotImplementedError
+
+    def create_tables(self, cursor):
+        for name in sorted(SCHEMAS):
+            for statement in self.schema(name):
+                cursor.execute(statement)
+
+    def upsert(self, table, columns, keys, add=()):
+        """
+        INSERT statement for rows of columns that updates the row with the
+        same keys if there is one: columns in add are added to the stored
+        value, the other columns are replaced.
+        """
+        raise NotImplementedError
+
+    def copy_table(self, txn, table, copy):
+        """
+        Create copy as an empty table with the columns of table, dropping an
+        earlier copy.
+        """
+        raise NotImplementedError
+
+    def replace_table(self, txn, table, replacement):
+        """
+        Replace the rows of table with the rows of replacement in one step,
+        readers see either all old or all new rows. replacement is dropped.
+        """
+        raise NotImplementedError
+
+    def table_version(self, table):
+        """
+        Value that changes whenever table was replaced, deferred.
+        """
+        raise NotImplementedError
+
+class MySQLStorage(Storage):
+    """
+    MySQL (InnoDB) server, connected with MySQLdb.
+    """
+    dialect = 'mysql'
+
+    def __init__(self, db_name, db_user=None, db_passwd=None, db_port=None, db_host=None):
+        self.created = False
+        dbpool = adbapi.ConnectionPool('MySQLdb', host=db_host, db=db_name, user=db_user, passwd=db_passwd, port=db_port,
+            cp_openfun=self._open)
+        Storage.__init__(self, dbpool, db_name)
+
+    def _open(self, connection):
+        if self.created:
+            return
+        cursor = connection.cursor()
+        self.create_tables(cursor)
+        cursor.close()
+        connection.commit()
+        self.created = True
+
+    def schema(self, name, table=None, indexes=True):
+        columns, keys = SCHEMAS[name]
+        definitions = list(columns)
+        if indexes:
+            definitions.extend('KEY {} ({})'.format(key, ', '.join(key_columns)) for key, key_columns in keys)
+        return ['CREATE TABLE IF NOT EXISTS {} (\n    {}\n) ENGINE=InnoDB;'.format(self.table(table or name), ',\n    '.join(definitions))]
+
+    def upsert(self, table, columns, keys, add=()):
+        updates = ', '.join(('{0}={0}+VALUES({0})' if column in add else '{0}=VALUES({0})').format(column)
+            for column in columns if column not in keys)
+        return 'INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {};'.format(
+            self.table(table), ', '.join(columns), ', '.join(['%s'] * len(columns)), updates)
+
+    def copy_table(self, txn, table, copy):
+        txn.execute('DROP TABLE IF EXISTS {};'.format(self.table(copy)))
+        txn.execute('CREATE TABLE {} LIKE {};'.format(self.table(copy), self.table(table)))
+
+    def replace_table(self, txn, table, replacement):
+        # RENAME TABLE swaps both tables in one atomic step, a <table>_old
+        # left over by an aborted swap would make it fail
+        txn.execute('DROP TABLE IF EXISTS {}_old;'.format(self.table(table)))
+        txn.execute('RENAME TABLE {0} TO {0}_old, {1} TO {0};'.format(self.table(table), self.table(replacement)))
+        txn.execute('DROP TABLE {}_old;'.format(self.table(table)))
+
+    @defer.inlineCallbacks
+    def table_version(self, table):
+        rows = yield self.dbpool.runQuery(
+            'SELECT CREATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s;',
+            (self.db_name, table))
+        returnValue(rows[0][0] if rows else None)
+
+class SQLiteCursor():
+    """
+    Cursor of a SQLite connection that takes the %s parameters of the MySQL
+    queries.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def execute(self, sql, *args):
+        return self.cursor.execute(sql.replace('%s', '?'), *args)
+
+    def executemany(self, sql, rows):
+        return self.cursor.executemany(sql.replace('%s', '?'), rows)
+
+class SQLiteStorage(Storage):
+    """
+    Embedded SQLite database in a local file, no server to run. The file is
+    opened in WAL mode, so readers in other processes (connect_tor.py while
+    get_circuits.py rebuilds the circuits) are not blocked by the writer.
+    All statements of a process run on one connection in a single database
+    thread, SQLite has only one writer anyway, and its statement cache keeps
+    the recurring inserts and lookups prepared. Tables are qualified with
+    the schema name main.
+
+    SQLite has no CREATE TIME of a table, replace_table counts the
+    replacements of a table in table_versions instead.
+
+    Arguments:
+        path: database file, created if missing
+        timeout: seconds to wait for the lock of another writer
+    """
+    dialect = 'sqlite'
+    for_update = ''
+
+    def __init__(self, path, timeout=30.0):
+        dbpool = adbapi.ConnectionPool('sqlite3', path, timeout=timeout, check_same_thread=False, cached_statements=256,
+            cp_min=1, cp_max=1, cp_openfun=self._open)
+        Storage.__init__(self, dbpool, 'main')
+        self.path = path
+
+    def _open(self, connection):
+        # byte strings like MySQLdb returns them, txtorcon takes no unicode fingerprints
+        connection.text_factory = str
+        connection.execute('PRAGMA journal_mode=WAL;')
+        connection.execute('PRAGMA synchronous=NORMAL;')
+        self.create_tables(connection)
+        connection.execute('CREATE TABLE IF NOT EXISTS main.table_versions (name VARCHAR(64) NOT NULL PRIMARY KEY, version INT NOT NULL);')
+        connection.commit()
+
+    def sql(self, statement):
+        return statement.replace('%s', '?')
+
+    def cursor(self, txn):
+        return SQLiteCursor(txn)
+
+    def schema(self, name, table=None, indexes=True):
+        table = table or name
+        columns, keys = SCHEMAS[name]
+        columns = [column.replace('INT NOT NULL AUTO_INCREMENT PRIMARY KEY', 'INTEGER PRIMARY KEY AUTOINCREMENT') for column in columns]
+        statements = ['CREATE TABLE IF NOT EXISTS {} (\n    {}\n);'.format(self.table(table), ',\n    '.join(columns))]
+        if indexes:
+            statements.extend('CREATE INDEX IF NOT EXISTS {}.{}_{} ON {} ({});'.format(self.db_name, table, key, table, ', '.join(key_columns))
+                for key, key_columns in keys)
+        return statements
+
+    def upsert(self, table, columns, keys, add=()):
+        updates = ', '.join(('{0}={0}+excluded.{0}' if column in add else '{0}=excluded.{0}').format(column)
+            for column in columns if column not in keys)
+        return 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {};'.format(
+            self.table(table), ', '.join(columns), ', '.join(['%s'] * len(columns)), ', '.join(keys), updates)
+
+    def copy_table(self, txn, table, copy):
+        # the copy is only a staging table, it gets no indexes
+        txn.execute('DROP TABLE IF EXISTS {};'.format(self.table(copy)))
+        for statement in self.schema(table, copy, indexes=False):
+            txn.execute(statement)
+
+    def replace_table(self, txn, table, replacement):
+        # one write transaction, readers keep their snapshot of the old rows until it commits
+        txn.execute('DELETE FROM {};'.format(self.table(table)))
+        txn.execute('INSERT INTO {} SELECT * FROM {};'.format(self.table(table), self.table(replacement)))
+        txn.execute(self.upsert('table_versions', ('name', 'version'), ('name',), add=('version',)), (table, 1))
+        txn.execute('DROP TABLE {};'.format(self.table(replacement)))
+
+    @defer.inlineCallbacks
+    def table_version(self, table):
+        rows = yield self.runQuery('SELECT version FROM main.table_versions WHERE name = %s;', (table,))
+        returnValue(rows[0][0] if rows else None)
+
+def open_storage(db_name=None, db_user=None, db_passwd=None, db_port=None, db_host=None, db_file=None):
+    """
+    SQLiteStorage of db_file if it is given, MySQLStorage of the server
+    otherwise.
+    """
+    if db_file is not None:
+        return SQLiteStorage(db_file)
+    return MySQLStorage(db_name, db_user, db_passwd, db_port, db_host)
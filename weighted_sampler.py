@@ -0,0 +1,194 @@
+#!/usr/bin/env/python
+
+import numpy as np
+
+POSITIONS = ['guard', 'middle', 'exit']
+
+# bandwidth-weights of the consensus per position and relay class. relay_flag
+# in get_consensus.py counts exits with the Guard flag as exits, relay_classes
+# splits them off as guard_exit. Only relays with the Guard flag are guards.
+POSITION_WEIGHTS = {
+    'guard': {'guard': 'Wgg', 'guard_exit': 'Wgd'},
+    'middle': {'guard': 'Wmg', 'relay': 'Wmm', 'exit': 'Wme', 'guard_exit': 'Wmd'},
+    'exit': {'exit': 'Wee', 'guard_exit': 'Wed'},
+}
+
+WEIGHT_SCALE = 10000.0
+
+def read_bandwidth_weights(consensus_path):
+    """
+    The bandwidth-weights line of a consensus as a dict, e.g. {'Wgg': 5916}.
+    Empty if the consensus does not have the line.
+    """
+    from consensus_archive import load_consensus
+
+    for line in load_consensus(consensus_path):
+        if line.startswith(b'bandwidth-weights '):
+            return dict((key, int(value)) for key, value in (item.split(b'=') for item in line.split()[1:]))
+    return {}
+
+def relay_classes(flags, guards):
+    """
+    Class of every relay for POSITION_WEIGHTS: the guard/relay/exit flag, and
+    guard_exit for exits that also have the Guard flag.
+    """
+    flags = np.asarray(flags)
+    return np.where((flags == 'exit') & (np.asarray(guards) != 0), 'guard_exit', flags)
+
+def position_weights(classes, position, bandwidth_weights=None):
+    """
+    Weight factor of every relay for one position of the circuit, 0 where a
+    relay cannot be used in that position. Without bandwidth weights every
+    allowed relay gets the factor 1, like an unweighted path selection by
+    bandwidth.
+    """
+    factors = np.zeros(len(classes))
+    for relay_class, weight_name in POSITION_WEIGHTS[position].items():
+        factor = 1.0
+        if bandwidth_weights:
+            factor = bandwidth_weights.get(weight_name, WEIGHT_SCALE) / WEIGHT_SCALE
+        factors[classes == relay_class] = factor
+    return factors
+
+class AliasTable():
+    """
+    Walker's alias method (Vose's construction) for one discrete distribution.
+    Building the table is O(n), every draw is one uniform index and one
+    uniform float, so samples are generated in vectorized batches.
+
+    Arguments:
+        weights: non-negative weights, at least one of them > 0
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        total = weights.sum()
+        if len(weights) == 0 or total <= 0:
+            raise ValueError('Cannot sample from an empty distribution')
+
+        size = len(weights)
+        scaled = weights * size / total
+        self.prob = np.ones(size)
+        self.alias = np.arange(size)
+
+        small = list(np.nonzero(scaled < 1.0)[0])
+        large = list(np.nonzero(scaled >= 1.0)[0])
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, count, rng):
+        index = rng.randint(0, len(self.prob), size=count)
+        keep = rng.random_sample(count) < self.prob[index]
+        return np.where(keep, index, self.alias[index])
+
+class PathSampler():
+    """
+    Bandwidth weighted circuits of one partition of relays (the whole network
+    or one continent or country). One alias table per position is built from
+    the relay bandwidths and the position weights of the consensus. Samples
+    are drawn in batches of guard, middle and exit indexes, batches with the
+    same relay twice, two relays of one /16 network or of one family are
+    dropped with a vectorized mask and drawn again.
+
+    Arguments:
+        fids: relay ids
+        bandwidths: consensus bandwidths of the relays
+        flags: 'guard', 'relay' or 'exit' per relay
+        guards: 1 for relays with the Guard flag of the consensus
+        prefixes: /16 network of every relay as integer
+        families: family id per relay, None if every relay is its own family
+        bandwidth_weights: bandwidth-weights of the consensus
+    """
+    def __init__(self, fids, bandwidths, flags, guards, prefixes, families=None, bandwidth_weights=None):
+        self.fids = np.asarray(fids, dtype=np.int64)
+        self.prefixes = np.asarray(prefixes, dtype=np.int64)
+        self.families = None
+        if families is not None:
+            self.families = np.asarray(families, dtype=np.int64)
+
+        bandwidths = np.asarray(bandwidths, dtype=np.float64)
+        classes = relay_classes(flags, guards)
+
+        self.tables = []
+        self.indexes = []
+        for position in POSITIONS:
+            weights = bandwidths * position_weights(classes, position, bandwidth_weights)
+            candidates = np.nonzero(weights > 0)[0]
+            self.indexes.append(candidates)
+            self.tables.append(AliasTable(weights[candidates]))
+
+    def _distinct(self, values, guards, middles, exits):
+        return ((values[guards] != values[middles]) &
+            (values[guards] != values[exits]) &
+            (values[middles] != values[exits]))
+
+    def sample_indexes(self, count, rng, max_rounds=100):
+        """
+        count x 3 array of relay indexes (guard, middle, exit).
+        """
+        circuits = []
+        missing = count
+        for attempt in xrange(max_rounds):
+            if missing <= 0:
+                break
+            batch = int(missing * 1.25) + 16
+            guards, middles, exits = [indexes[table.sample(batch, rng)]
+                for indexes, table in zip(self.indexes, self.tables)]
+
+            valid = self._distinct(self.fids, guards, middles, exits)
+            valid &= self._distinct(self.prefixes, guards, middles, exits)
+            if self.families is not None:
+                valid &= self._distinct(self.families, guards, middles, exits)
+
+            batch_circuits = np.column_stack((guards[valid], middles[valid], exits[valid]))[:missing]
+            circuits.append(batch_circuits)
+            missing -= len(batch_circuits)
+
+        if missing > 0:
+            print('Could only sample {} of {} circuits'.format(count - missing, count))
+        if not circuits:
+            return np.zeros((0, 3), dtype=np.int64)
+        return np.concatenate(circuits)
+
+    def sample(self, count, rng):
+        """
+        count x 3 array of relay fids (guard, middle, exit).
+        """
+        return self.fids[self.sample_indexes(count, rng)]
+
+def partition_samplers(table, strategy, geo_codes, bandwidth_weights=None):
+    """
+    PathSampler of every geo code of a RelayTable, for strategy None one
+    sampler of the whole network under the geo code ''. Partitions without a
+    guard, middle or exit candidate are left out.
+    """
+    fids = np.frombuffer(table.fids, dtype=np.uint32)
+    bandwidths = np.frombuffer(table.bandwidths, dtype=np.float64)
+    prefixes = np.frombuffer(table.prefixes, dtype=np.uint32)
+    flags = np.asarray(table.flags)
+    guards = np.frombuffer(table.guards, dtype=np.uint8)
+
+    if strategy is None:
+        partitions = [('', np.arange(len(fids)))]
+    else:
+        partitions = [(geo_code, np.asarray(table.indexes(strategy, geo_code), dtype=np.int64)) for geo_code in geo_codes]
+
+    samplers = {}
+    for geo_code, index in partitions:
+        try:
+            samplers[geo_code] = PathSampler(fids[index], bandwidths[index], flags[index], guards[index], prefixes[index],
+                bandwidth_weights=bandwidth_weights)
+        except ValueError as err:
+            print('No weighted circuits for {} {}: '.format(strategy, geo_code), err)
+
+    return samplers